@@ -0,0 +1,8 @@
+"""Allows running the converter headless with `python -m app <directory>`"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from cli import main
+
+sys.exit(main())
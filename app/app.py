@@ -2,18 +2,22 @@ import os
 import sys
 import tkinter as tk
 from tkinter import filedialog, NORMAL, DISABLED
-from PIL import Image
 import threading
 import subprocess
 
 # Add the app directory to the Python path
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
-from gui_components import RoundedButton, StyledLabel, StyledProgressBar, Config
+from config import get_config
+from gui_components import RoundedButton, StyledLabel, StyledProgressBar
+from progress import ProgressTracker, describe_progress
+
+# How often the window refreshes progress while converting
+PROGRESS_POLL_MS = 100
 
 class BmpToPngConverter:
     def __init__(self, root):        
         self.root = root
-        self.config = Config()
+        self.config = get_config()
         
         self.root.title(self.config.get('app', 'title'))
         try:
@@ -32,6 +36,9 @@ class BmpToPngConverter:
         self.is_processing = False
         self.total_files = 0
         self.processed_files = 0
+        self.skipped_files = 0
+        self.progress = None
+        self.cancel_requested = threading.Event()
     
     def setup_ui(self):
         main_frame = tk.Frame(self.root, bg=self.config.get('colors', 'background'))
@@ -61,6 +68,10 @@ class BmpToPngConverter:
         self.convert_btn = RoundedButton(bottom_frame, "Convert", self.start_conversion)
         self.convert_btn.pack(side=tk.RIGHT)
         
+        self.cancel_btn = RoundedButton(bottom_frame, "Cancel", self.cancel_conversion)
+        self.cancel_btn.pack(side=tk.RIGHT, padx=(0, 5))
+        self.cancel_btn.config(state=DISABLED)
+        
         credits_label = StyledLabel(bottom_frame, text="Created by Vexx")
         credits_label.pack(side=tk.LEFT)
         
@@ -91,9 +102,13 @@ class BmpToPngConverter:
                 self.convert_btn.config(state=DISABLED)
                 return
             
-            bmp_files = [f for f in os.listdir(self.selected_directory) 
-                        if f.lower().endswith('.bmp')]
-            self.total_files = len(bmp_files)
+            # Imported on first use so the window opens before Pillow is loaded
+            from converter import ConversionOptions
+            from scanner import count_bmp_files
+            
+            options = ConversionOptions.from_config(self.config)
+            output_dir = os.path.join(self.selected_directory, options.output_folder)
+            self.total_files = count_bmp_files(self.selected_directory, options.recursive, exclude=(output_dir,))
             
             if self.total_files > 0:
                 self.file_counter_label.config(text=f"Found {self.total_files} BMP files")
@@ -121,88 +136,64 @@ class BmpToPngConverter:
         os.makedirs(output_dir, exist_ok=True)
         
         self.processed_files = 0
+        self.skipped_files = 0
         self.progress_bar["value"] = 0
         self.progress_bar["maximum"] = self.total_files
         
         self.convert_btn.config(state=DISABLED)
+        self.cancel_btn.config(state=NORMAL)
         self.is_processing = True
         self.status_label.config(text="Converting...")
         
+        # The conversion thread only updates the tracker; the window polls it at a fixed rate
+        self.progress = ProgressTracker(self.total_files)
+        self.cancel_requested.clear()
         threading.Thread(target=self.convert_files, daemon=True).start()
+        self.root.after(PROGRESS_POLL_MS, self.poll_progress)
+    
+    def cancel_conversion(self):
+        if not self.is_processing:
+            return
+        self.cancel_requested.set()
+        self.cancel_btn.config(state=DISABLED)
+        self.status_label.config(text="Cancelling...")
     
     def convert_files(self):
         try:
-            bmp_files = [f for f in os.listdir(self.selected_directory) 
-                        if f.lower().endswith('.bmp')]
+            from converter import ConversionOptions, convert_directory, describe_stats, print_file_error
             
-            output_dir = os.path.join(self.selected_directory, self.config.get('conversion', 'output_folder'))
+            options = ConversionOptions.from_config(self.config)
+            
+            events = convert_directory(self.selected_directory, options)
+            try:
+                for event in events:
+                    self.progress.update(event)
+                    if event.kind == 'done':
+                        if event.processed:
+                            print(describe_stats(event.stats, options.encoder_profile))
+                    elif event.kind == 'file' and event.error is not None:
+                        print_file_error(event.name, event.input_path, event.error)
+                    if self.cancel_requested.is_set():
+                        break
+            finally:
+                # Lets the converter finish the files already in progress and save its manifest
+                events.close()
+            
+            snapshot = self.progress.snapshot()
+            self.total_files = snapshot['total']
+            self.processed_files = snapshot['processed']
+            self.skipped_files = snapshot['skipped']
+            
+            if self.cancel_requested.is_set():
+                print(f"Conversion cancelled after {self.processed_files} of {self.total_files} files")
+                self.root.after(0, self.conversion_cancelled)
+                return
             
-            for bmp_file in bmp_files:
-                try:
-                    color_hex = self.config.get('conversion', 'transparent_color').lstrip('#')
-                    color_rgb = tuple(int(color_hex[i:i+2], 16) for i in (0, 2, 4))
-                    
-                    # Normalize paths to use correct system separators
-                    input_path = os.path.normpath(os.path.join(self.selected_directory, bmp_file))
-                    output_path = os.path.normpath(os.path.join(output_dir, os.path.splitext(bmp_file)[0] + '.png'))
-                    
-                    # Check if input file exists and is readable
-                    if not os.path.exists(input_path):
-                        raise FileNotFoundError(f"Input file does not exist: {input_path}")
-                    
-                    # Check for empty files
-                    file_size = os.path.getsize(input_path)
-                    if file_size == 0:
-                        raise IOError(f"File is empty (0 bytes)")
-                    
-                    try:
-                        # Try to open the file first to verify it's a valid image
-                        with open(input_path, 'rb') as test_file:
-                            header = test_file.read(2)
-                            if not header:
-                                raise IOError("File is empty or unreadable")
-                            if header != b'BM':  # BMP file header check
-                                raise IOError("Not a valid BMP file (incorrect header)")
-                    except Exception as e:
-                        raise IOError(f"Cannot read file: {str(e)}")
-                    
-                    # Now try to process the image
-                    img = Image.open(input_path)
-                    img = img.convert("RGBA")
-                    
-                    data = img.getdata()
-                    new_data = []
-                    for item in data:
-                        if item[0] == color_rgb[0] and item[1] == color_rgb[1] and item[2] == color_rgb[2]:
-                            new_data.append((255, 255, 255, 0))
-                        else:
-                            new_data.append(item)
-                    
-                    img.putdata(new_data)
-                    img.save(output_path, "PNG")
-                    
-                    self.processed_files += 1
-                    self.root.after(0, self.update_progress)
-                    
-                except Exception as e:
-                    print(f"\nError processing file {bmp_file}:")
-                    print(f"Input path: {input_path}")
-                    print(f"Error details: {str(e)}")
-                    print("File status:")
-                    print(f"- File exists: {os.path.exists(input_path)}")
-                    try:
-                        size = os.path.getsize(input_path)
-                        print(f"- File size: {size} bytes")
-                        if size == 0:
-                            print("  → This file is empty and cannot be processed")
-                        elif size < 54:  # Minimum size for a valid BMP header
-                            print("  → File is too small to be a valid BMP")
-                    except:
-                        print("- Could not get file size")
-                    print("Continuing with next file...\n")
+            if self.skipped_files:
+                print(f"Skipped {self.skipped_files} unchanged file(s)")
             
-            if self.processed_files < self.total_files:
-                failed_files = self.total_files - self.processed_files
+            if self.processed_files + self.skipped_files < self.total_files:
+                failed_files = self.total_files - self.processed_files - self.skipped_files
                 print(f"\nConversion completed with {failed_files} error(s):")
                 print(f"Successfully converted {self.processed_files} of {self.total_files} files")
                 print("Check the error messages above for details about failed conversions\n")
@@ -214,15 +205,30 @@ class BmpToPngConverter:
             print(f"\n{error_msg}\n")
             self.root.after(0, lambda: self.show_error(error_msg))
     
-    def update_progress(self):
-        self.progress_bar["value"] = self.processed_files
-        self.file_counter_label.config(text=f"Processed {self.processed_files} of {self.total_files} files")
+    def poll_progress(self):
+        if not self.is_processing:
+            return
+        snapshot = self.progress.snapshot()
+        self.progress_bar["maximum"] = max(snapshot['total'], 1)
+        self.progress_bar["value"] = snapshot['done']
+        self.file_counter_label.config(text=describe_progress(snapshot))
+        self.root.after(PROGRESS_POLL_MS, self.poll_progress)
+    
+    def conversion_cancelled(self):
+        self.is_processing = False
+        self.convert_btn.config(state=NORMAL)
+        self.cancel_btn.config(state=DISABLED)
+        self.progress_bar["value"] = self.processed_files + self.skipped_files
+        self.status_label.config(text="Conversion cancelled")
+        self.file_counter_label.config(text=f"Converted {self.processed_files} of {self.total_files} files before cancelling")
     
     def conversion_completed(self):
         self.is_processing = False
         self.convert_btn.config(state=NORMAL)
+        self.cancel_btn.config(state=DISABLED)
+        self.progress_bar["value"] = self.processed_files + self.skipped_files
         
-        if self.processed_files < self.total_files:
+        if self.processed_files + self.skipped_files < self.total_files:
             self.status_label.config(text="Conversion completed with errors")
             print(f"Partially completed: {self.processed_files} of {self.total_files} files converted")
         else:
@@ -232,7 +238,10 @@ class BmpToPngConverter:
         output_dir = os.path.join(self.selected_directory, self.config.get('conversion', 'output_folder'))
         folder_name = os.path.basename(output_dir)
         self.dir_label.config(text=folder_name)
-        self.file_counter_label.config(text=f"Converted {self.processed_files} of {self.total_files} files")
+        if self.skipped_files:
+            self.file_counter_label.config(text=f"Converted {self.processed_files}, skipped {self.skipped_files} unchanged of {self.total_files}")
+        else:
+            self.file_counter_label.config(text=f"Converted {self.processed_files} of {self.total_files} files")
         
         if os.name == 'nt':
             os.startfile(output_dir)
@@ -242,6 +251,7 @@ class BmpToPngConverter:
     def show_error(self, error_message):
         self.is_processing = False
         self.convert_btn.config(state=NORMAL)
+        self.cancel_btn.config(state=DISABLED)
         
         # Print detailed error to console
         print(f"\nError Details:\n{error_message}\n")
@@ -258,7 +268,10 @@ class BmpToPngConverter:
         
         self.status_label.config(text=f"Error: {gui_message}")
 
-if __name__ == "__main__":
+def main():
     root = tk.Tk()
     app = BmpToPngConverter(root)
-    root.mainloop()
\ No newline at end of file
+    root.mainloop()
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
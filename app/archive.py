@@ -0,0 +1,181 @@
+"""
+Zip and tar archives as conversion input and output
+Reads BMP members straight out of an archive and can write the PNGs into another one, without extracting anything to disk
+"""
+import io
+import ntpath
+import os
+import posixpath
+import tarfile
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+
+from converter import (ConversionEvent, ensure_parent_dir, file_stats, inspect_data, open_output, output_path_for,
+                       render_job, resolve_workers, run_budgeted, whole_image_memory)
+from telemetry import StageTimer
+
+ARCHIVE_EXTENSIONS = ('.zip', '.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz')
+# Raised when an input archive is damaged or not really a zip/tar file
+ARCHIVE_ERRORS = (zipfile.BadZipFile, tarfile.TarError, EOFError)
+# tarfile write modes by extension; reading detects the compression itself
+TAR_WRITE_MODES = {
+    '.tar': 'w',
+    '.tar.gz': 'w:gz',
+    '.tgz': 'w:gz',
+    '.tar.bz2': 'w:bz2',
+    '.tbz2': 'w:bz2',
+    '.tar.xz': 'w:xz',
+    '.txz': 'w:xz',
+}
+
+def _extension(path):
+    lower = path.lower()
+    return next((ext for ext in sorted(ARCHIVE_EXTENSIONS, key=len, reverse=True) if lower.endswith(ext)), None)
+
+def is_archive(path):
+    """True if path names a zip or tar file we can read"""
+    return os.path.isfile(path) and _extension(path) is not None
+
+def safe_member_name(name):
+    """Normalise an archive member name, raising IOError for names that escape the output folder"""
+    name = posixpath.normpath(name.replace('\\', '/')).lstrip('/')
+    if name.startswith('../') or name == '..' or name == '.':
+        raise IOError(f"Unsafe path in archive: {name}")
+    # 'C:/x' or 'C:x' would make os.path.join drop the output folder on Windows, and
+    # ':' also names NTFS alternate data streams
+    if ntpath.splitdrive(name)[0] or ':' in name:
+        raise IOError(f"Unsafe path in archive: {name}")
+    return name
+
+def iter_bmp_members(archive_path):
+    """Yield (name, data) for every .bmp member, reading one member at a time
+
+    Zip members are read through the central directory; tar files (compressed or not)
+    are read as a single forward stream, so even huge bundles are never seeked.
+    """
+    if _extension(archive_path) == '.zip':
+        with zipfile.ZipFile(archive_path) as archive:
+            for info in archive.infolist():
+                if not info.is_dir() and info.filename.lower().endswith('.bmp'):
+                    yield info.filename, archive.read(info)
+        return
+
+    with tarfile.open(archive_path, 'r|*') as archive:
+        for member in archive:
+            if member.isfile() and member.name.lower().endswith('.bmp'):
+                yield member.name, archive.extractfile(member).read()
+
+class ArchiveWriter:
+    """Writes PNGs into a zip or tar file, which only appears under its name once complete"""
+    def __init__(self, path):
+        extension = _extension(path)
+        if extension is None:
+            raise ValueError(f"Unsupported output archive type: {path}")
+        self.path = path
+        self.temp_path = path + ".tmp"
+        if extension == '.zip':
+            # PNG data is already deflated, so store it as is
+            self.archive = zipfile.ZipFile(self.temp_path, 'w', zipfile.ZIP_STORED)
+        else:
+            self.archive = tarfile.open(self.temp_path, TAR_WRITE_MODES[extension])
+
+    def write(self, name, data):
+        if isinstance(self.archive, zipfile.ZipFile):
+            self.archive.writestr(name, data)
+        else:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = time.time()
+            self.archive.addfile(info, io.BytesIO(data))
+
+    def close(self, keep=True):
+        self.archive.close()
+        if keep:
+            os.replace(self.temp_path, self.path)
+        else:
+            os.remove(self.temp_path)
+
+def convert_member(data, options):
+    """Convert one BMP held in memory, returning the PNG bytes and the stats dict"""
+    timer = StageTimer()
+    info = inspect_data(data, timer)
+    png, stages = render_job(data, info, options)
+    timer.stages.update(stages)
+    return png, file_stats(len(data), len(png), timer)
+
+def convert_archive(archive_path, options, output_archive=None):
+    """Convert every BMP inside a zip or tar file, yielding ConversionEvents
+
+    PNGs go into output_archive when given, otherwise into the output folder next to
+    the archive, mirroring the member paths. Members are converted on the process
+    pool as they are read, with at most two per worker held in memory at a time and,
+    with max_memory_mb, only as many as fit in the budget.
+    """
+    output_dir = os.path.join(os.path.dirname(os.path.abspath(archive_path)), options.output_folder)
+    writer = ArchiveWriter(output_archive) if output_archive else None
+    yield ConversionEvent('start')
+
+    counts = {'total': 0, 'processed': 0, 'failed': 0, 'skipped': 0}
+    totals = {'input_bytes': 0, 'output_bytes': 0, 'encode_seconds': 0.0}
+    workers = resolve_workers(options.workers)
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+
+    def finish(name, result, error):
+        """Store one member's PNG and build its event"""
+        stats = None
+        output_path = None
+        if error is None:
+            png, stats = result
+            try:
+                member_name = safe_member_name(name)
+                png_name = posixpath.splitext(member_name)[0] + ".png"
+                started = time.perf_counter()
+                if writer is not None:
+                    writer.write(png_name, png)
+                    output_path = f"{output_archive}/{png_name}"
+                else:
+                    output_path = output_path_for(output_dir, member_name)
+                    ensure_parent_dir(output_path)
+                    with open_output(output_path) as f:
+                        f.write(png)
+                stats['stages']['write'] = time.perf_counter() - started
+            except Exception as e:
+                error = e
+        if error is None:
+            counts['processed'] += 1
+            for key in totals:
+                totals[key] += stats[key]
+        else:
+            counts['failed'] += 1
+        return ConversionEvent('file', name=name, input_path=f"{archive_path}/{name}", output_path=output_path,
+                               error=error, stats=stats if error is None else None, **counts)
+
+    def tasks():
+        for name, data in iter_bmp_members(archive_path):
+            counts['total'] += 1
+            yield name, whole_image_memory(data, options), convert_member, (data, options)
+
+    completed = False
+    try:
+        if executor is None:
+            for name, _, _, (data, _) in tasks():
+                try:
+                    result, error = convert_member(data, options), None
+                except Exception as e:
+                    result, error = None, e
+                yield finish(name, result, error)
+        else:
+            # Members are only read as workers free up, so at most two per worker are held
+            # in memory, and with max_memory_mb only while they fit in the budget
+            for name, error, result in run_budgeted(executor, tasks(), options, workers):
+                yield finish(name, result, error)
+        completed = True
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+        if writer is not None:
+            # An interrupted run leaves no half-written archive behind
+            writer.close(keep=completed)
+
+    yield ConversionEvent('done', stats=totals, **counts)
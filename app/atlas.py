@@ -0,0 +1,254 @@
+"""
+Sprite-atlas output
+Packs the keyed images of a folder into a few large PNGs with a skyline packer and writes a JSON index of the frames
+"""
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from PIL import Image
+
+from bmp_reader import open_bmp
+from converter import (ConversionEvent, inspect_source, open_output, resolve_workers, run_budgeted,
+                       whole_image_memory)
+from encoder import encode_png
+from keying import apply_color_key
+from scanner import scan_bmp_files
+from telemetry import StageTimer
+
+ATLAS_NAME = "atlas"
+
+class SkylinePacker:
+    """Bottom-left skyline rectangle packer for one atlas page
+
+    The skyline is the list of (x, y, width) segments forming the top edge of what has
+    been placed so far. A rectangle goes where its top edge ends lowest, ties going
+    to the leftmost spot, which keeps the page dense for sprites sorted by height.
+    """
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.skyline = [(0, 0, width)]
+        self.used_width = 0
+        self.used_height = 0
+
+    def _fit(self, index, width, height):
+        """y at which a width x height rectangle fits starting at skyline segment index, or None"""
+        x = self.skyline[index][0]
+        if x + width > self.width:
+            return None
+        y = 0
+        remaining = width
+        while remaining > 0:
+            _, segment_y, segment_width = self.skyline[index]
+            y = max(y, segment_y)
+            if y + height > self.height:
+                return None
+            remaining -= segment_width
+            index += 1
+        return y
+
+    def insert(self, width, height):
+        """Place a rectangle, returning its (x, y) or None if the page is full"""
+        best = None
+        for index in range(len(self.skyline)):
+            y = self._fit(index, width, height)
+            if y is not None:
+                x = self.skyline[index][0]
+                if best is None or (y + height, x) < (best[1] + height, best[0]):
+                    best = (x, y, index)
+        if best is None:
+            return None
+
+        x, y, index = best
+        self.skyline.insert(index, (x, y + height, width))
+        # Cut back or drop the segments the new one now covers
+        right = x + width
+        next_index = index + 1
+        while next_index < len(self.skyline):
+            segment_x, segment_y, segment_width = self.skyline[next_index]
+            if segment_x >= right:
+                break
+            if segment_x + segment_width <= right:
+                del self.skyline[next_index]
+            else:
+                self.skyline[next_index] = (right, segment_y, segment_x + segment_width - right)
+                break
+        # Merge neighbours at the same height
+        merged = [self.skyline[0]]
+        for segment in self.skyline[1:]:
+            last = merged[-1]
+            if last[1] == segment[1]:
+                merged[-1] = (last[0], last[1], last[2] + segment[2])
+            else:
+                merged.append(segment)
+        self.skyline = merged
+        self.used_width = max(self.used_width, right)
+        self.used_height = max(self.used_height, y + height)
+        return x, y
+
+class Frame:
+    """A keyed image waiting to be placed on an atlas page"""
+    def __init__(self, name, source_size, offset, size, pixels):
+        self.name = name
+        self.source_size = source_size
+        self.offset = offset
+        self.size = size
+        self.pixels = pixels
+        # The same bytes in a different shape are a different image
+        self.digest = (tuple(size), hashlib.sha256(pixels).hexdigest()) if pixels else None
+        self.page = None
+        self.position = None
+
+def load_frame(input_path, options, file_size=None, trim=True):
+    """Decode and key one BMP, returning (source_size, offset, size, RGBA bytes, stats)
+
+    With trim, fully transparent rows and columns around the image are cut off and
+    offset says where the rest sat in the original.
+    """
+    timer = StageTimer()
+    file_size, info = inspect_source(input_path, file_size, timer)
+    with ExitStack() as stack:
+        with timer.stage('decode'):
+            img = stack.enter_context(open_bmp(input_path, info))
+            img.load()
+        with timer.stage('keying'):
+            img = apply_color_key(img, options.key_colors, options.background_only)
+            box = (0, 0) + img.size
+            if trim:
+                box = img.getchannel("A").getbbox() or (0, 0, 0, 0)
+            pixels = img.crop(box).tobytes() if box[2] > box[0] else b''
+    stats = {'input_bytes': file_size, 'output_bytes': 0, 'encode_seconds': 0.0, 'stages': timer.stages}
+    return img.size, box[:2], (box[2] - box[0], box[3] - box[1]), pixels, stats
+
+def pack_frames(frames, max_size, padding):
+    """Place every frame on as few max_size pages as possible, returning the packers
+
+    Frames with identical pixels and size share one rectangle. Raises ValueError if a frame
+    cannot fit on an empty page.
+    """
+    pages = []
+    placed = {}
+    # Tallest first suits the skyline heuristic
+    for frame in sorted(frames, key=lambda frame: (frame.size[1], frame.size[0]), reverse=True):
+        if not frame.pixels:
+            continue
+        if frame.digest in placed:
+            frame.page, frame.position = placed[frame.digest]
+            continue
+        width, height = frame.size[0] + padding, frame.size[1] + padding
+        if width > max_size or height > max_size:
+            raise ValueError(f"{frame.name} is {frame.size[0]}x{frame.size[1]}, larger than the "
+                             f"{max_size}x{max_size} atlas size")
+        for page_index, packer in enumerate(pages):
+            position = packer.insert(width, height)
+            if position is not None:
+                break
+        else:
+            pages.append(SkylinePacker(max_size, max_size))
+            page_index = len(pages) - 1
+            position = pages[-1].insert(width, height)
+        frame.page, frame.position = page_index, position
+        placed[frame.digest] = (page_index, position)
+    return pages
+
+def page_file_name(index, page_count):
+    return f"{ATLAS_NAME}.png" if page_count == 1 else f"{ATLAS_NAME}_{index}.png"
+
+def frame_index(frames, pages):
+    """JSON-friendly index of every frame's rectangle, in the common 'hash' atlas layout"""
+    index = {
+        'pages': [{'image': page_file_name(i, len(pages)), 'size': {'w': page.used_width, 'h': page.used_height}}
+                  for i, page in enumerate(pages)],
+        'frames': {},
+    }
+    for frame in sorted(frames, key=lambda frame: frame.name):
+        x, y = frame.position or (0, 0)
+        index['frames'][frame.name] = {
+            'page': frame.page,
+            'frame': {'x': x, 'y': y, 'w': frame.size[0], 'h': frame.size[1]},
+            'trimmed': frame.size != frame.source_size,
+            'spriteSourceSize': {'x': frame.offset[0], 'y': frame.offset[1], 'w': frame.size[0], 'h': frame.size[1]},
+            'sourceSize': {'w': frame.source_size[0], 'h': frame.source_size[1]},
+        }
+    return index
+
+def serial_results(tasks):
+    """run_budgeted's (key, error, result) for each task, run one by one in this process"""
+    for key, _cost, fn, args in tasks:
+        try:
+            yield key, None, fn(*args)
+        except Exception as e:
+            yield key, e, None
+
+def convert_to_atlas(directory, options):
+    """Key every BMP in directory and pack them into atlas PNGs plus atlas.json, yielding ConversionEvents
+
+    A 'file' event follows each image as it is keyed; the pages are written once all
+    of them are in, before the 'done' event.
+    """
+    output_dir = os.path.join(directory, options.output_folder)
+    os.makedirs(output_dir, exist_ok=True)
+    yield ConversionEvent('start')
+
+    counts = {'total': 0, 'processed': 0, 'failed': 0, 'skipped': 0}
+    totals = {'input_bytes': 0, 'output_bytes': 0, 'encode_seconds': 0.0}
+    entries = list(scan_bmp_files(directory, options.recursive, exclude=(output_dir,)))
+    counts['total'] = len(entries)
+    workers = resolve_workers(options.workers)
+    frames = []
+
+    with ExitStack() as stack:
+        tasks = ((index, whole_image_memory(entry.path, options), load_frame,
+                  (entry.path, options, None, options.atlas_trim)) for index, entry in enumerate(entries))
+        if workers > 1:
+            # Keyed frames stay in this process until packed; max_memory_mb only bounds the decoding
+            executor = stack.enter_context(ProcessPoolExecutor(max_workers=workers))
+            results = run_budgeted(executor, tasks, options, workers)
+        else:
+            results = serial_results(tasks)
+
+        for index, error, result in results:
+            entry = entries[index]
+            stats = None
+            try:
+                if error is not None:
+                    raise error
+                source_size, offset, size, pixels, stats = result
+                if max(size) + options.atlas_padding > options.atlas_max_size:
+                    raise ValueError(f"Image is {size[0]}x{size[1]}, larger than the "
+                                     f"{options.atlas_max_size}x{options.atlas_max_size} atlas size")
+                frames.append((index, Frame(entry.name, source_size, offset, size, pixels)))
+                counts['processed'] += 1
+                totals['input_bytes'] += stats['input_bytes']
+                error = None
+            except Exception as e:
+                counts['failed'] += 1
+                error = e
+            yield ConversionEvent('file', name=entry.name, input_path=entry.path, error=error, stats=stats, **counts)
+
+    # Pack in scan order whatever order the workers finished in, so the layout is repeatable
+    frames = [frame for _, frame in sorted(frames, key=lambda item: item[0])]
+
+    pages = pack_frames(frames, options.atlas_max_size, options.atlas_padding)
+    for page_index, packer in enumerate(pages):
+        atlas = Image.new("RGBA", (max(1, packer.used_width), max(1, packer.used_height)), (0, 0, 0, 0))
+        pasted = set()
+        for frame in frames:
+            if frame.page != page_index or frame.digest in pasted:
+                continue
+            pasted.add(frame.digest)
+            atlas.paste(Image.frombytes("RGBA", frame.size, frame.pixels), frame.position)
+        started = time.perf_counter()
+        data = encode_png(atlas, options.encoder_profile)
+        totals['encode_seconds'] += time.perf_counter() - started
+        totals['output_bytes'] += len(data)
+        with open_output(os.path.join(output_dir, page_file_name(page_index, len(pages)))) as f:
+            f.write(data)
+
+    with open_output(os.path.join(output_dir, ATLAS_NAME + ".json")) as f:
+        f.write(json.dumps(frame_index(frames, pages), indent=1).encode())
+
+    yield ConversionEvent('done', stats=totals, **counts)
@@ -0,0 +1,219 @@
+"""
+BMP header parsing and direct pixel access
+Reads uncompressed BMPs straight from a memory map, or a band of rows at a time for very large images
+"""
+import io
+import mmap
+import struct
+from contextlib import contextmanager
+from PIL import Image
+
+FILE_HEADER_SIZE = 14
+BI_RGB = 0
+BI_RLE8 = 1
+BI_RLE4 = 2
+BI_BITFIELDS = 3
+
+# Pillow raw modes for the direct-color layouts we can read row by row,
+# keyed the same way as Pillow's own BMP plugin so the pixels come out identical
+BITFIELD_RAW_MODES = {
+    (32, (0xFF0000, 0xFF00, 0xFF, 0x0)): "BGRX",
+    (32, (0xFF000000, 0xFF0000, 0xFF00, 0x0)): "XBGR",
+    (32, (0xFF000000, 0xFF00, 0xFF, 0x0)): "BGXR",
+    (32, (0xFF000000, 0xFF0000, 0xFF00, 0xFF)): "ABGR",
+    (32, (0xFF, 0xFF00, 0xFF0000, 0xFF000000)): "RGBA",
+    (32, (0xFF0000, 0xFF00, 0xFF, 0xFF000000)): "BGRA",
+    (32, (0xFF000000, 0xFF00, 0xFF, 0xFF0000)): "BGAR",
+    (32, (0x0, 0x0, 0x0, 0x0)): "BGRA",
+    (24, (0xFF0000, 0xFF00, 0xFF)): "BGR",
+    (16, (0xF800, 0x7E0, 0x1F)): "BGR;16",
+    (16, (0x7C00, 0x3E0, 0x1F)): "BGR;15",
+}
+RGB_RAW_MODES = {
+    16: "BGR;15",
+    24: "BGR",
+    32: "BGRX",
+}
+
+class BmpInfo:
+    """Layout of a BMP file as described by its headers"""
+    def __init__(self, width, height, top_down, bits, compression, pixel_offset,
+                 header_size, colors=0, masks=None, file_size=None):
+        self.width = width
+        self.height = height
+        self.top_down = top_down
+        self.bits = bits
+        self.compression = compression
+        self.pixel_offset = pixel_offset
+        self.header_size = header_size
+        self.colors = colors
+        self.masks = masks
+        self.file_size = file_size
+
+    @property
+    def row_stride(self):
+        """Bytes per stored row, padded to a multiple of 4"""
+        return ((self.width * self.bits + 31) >> 3) & ~3
+
+    @property
+    def raw_mode(self):
+        """Pillow raw mode for reading the rows directly, or None if Pillow has to decode the file"""
+        if self.compression == BI_RGB:
+            return RGB_RAW_MODES.get(self.bits)
+        if self.compression == BI_BITFIELDS and self.masks is not None:
+            masks = self.masks if self.bits == 32 else self.masks[:3]
+            return BITFIELD_RAW_MODES.get((self.bits, masks))
+        return None
+
+    @property
+    def mode(self):
+        """Pillow image mode the rows decode to"""
+        return "RGBA" if "A" in (self.raw_mode or "") else "RGB"
+
+    @property
+    def pixel_data_size(self):
+        """Bytes of pixel data for uncompressed layouts, None when compressed"""
+        if self.compression in (BI_RGB, BI_BITFIELDS):
+            return self.row_stride * self.height
+        return None
+
+def parse_bmp_header(data, file_size=None):
+    """Parse the file and DIB headers at the start of data into a BmpInfo
+
+    Raises IOError describing what is wrong when the headers are not a usable BMP.
+    """
+    if len(data) < 2 or data[:2] != b'BM':
+        raise IOError("Not a valid BMP file (incorrect header)")
+    if len(data) < FILE_HEADER_SIZE + 4:
+        raise IOError("File is too small to be a valid BMP")
+
+    pixel_offset = struct.unpack_from("<I", data, 10)[0]
+    header_size = struct.unpack_from("<I", data, FILE_HEADER_SIZE)[0]
+    if len(data) < FILE_HEADER_SIZE + header_size:
+        raise IOError(f"BMP header is truncated ({header_size}-byte DIB header)")
+
+    masks = None
+    colors = 0
+    if header_size == 12:
+        # BITMAPCOREHEADER
+        width, height, _planes, bits = struct.unpack_from("<HHHH", data, FILE_HEADER_SIZE + 4)
+        compression = BI_RGB
+    elif header_size in (40, 52, 56, 64, 108, 124):
+        width, height, _planes, bits, compression = struct.unpack_from("<iiHHI", data, FILE_HEADER_SIZE + 4)
+        colors = struct.unpack_from("<I", data, FILE_HEADER_SIZE + 32)[0]
+        if compression == BI_BITFIELDS:
+            if header_size >= 56:
+                masks = struct.unpack_from("<IIII", data, FILE_HEADER_SIZE + 40)
+            elif header_size == 52:
+                masks = struct.unpack_from("<III", data, FILE_HEADER_SIZE + 40) + (0,)
+            else:
+                # 40-byte headers keep the three masks right after the header
+                if len(data) < FILE_HEADER_SIZE + header_size + 12:
+                    raise IOError("BMP header is truncated (missing bitfield masks)")
+                masks = struct.unpack_from("<III", data, FILE_HEADER_SIZE + header_size) + (0,)
+    else:
+        raise IOError(f"Unsupported BMP header type ({header_size} bytes)")
+
+    top_down = height < 0
+    height = abs(height)
+    if width <= 0 or height == 0:
+        raise IOError(f"Invalid BMP dimensions ({width}x{height})")
+    if bits not in (1, 4, 8, 16, 24, 32):
+        raise IOError(f"Unsupported BMP pixel depth ({bits})")
+
+    info = BmpInfo(width, height, top_down, bits, compression, pixel_offset,
+                   header_size, colors, masks, file_size)
+    if file_size is not None:
+        if pixel_offset >= file_size:
+            raise IOError(f"Pixel data offset {pixel_offset} lies beyond the end of the file ({file_size} bytes)")
+        expected = info.pixel_data_size
+        if expected is not None and pixel_offset + expected > file_size:
+            raise IOError(f"BMP pixel data is truncated (expected {expected} bytes, "
+                          f"file has {file_size - pixel_offset})")
+    return info
+
+def read_bmp_info(path, file_size=None):
+    """Read and parse the headers of the BMP file at path, checking them against its size"""
+    with open(path, 'rb') as f:
+        # Largest DIB header plus the trailing bitfield masks
+        data = f.read(FILE_HEADER_SIZE + 124 + 12)
+        if file_size is None:
+            f.seek(0, 2)
+            file_size = f.tell()
+    if not data:
+        raise IOError("File is empty or unreadable")
+    return parse_bmp_header(data, file_size)
+
+@contextmanager
+def open_bmp(path, info):
+    """Open the BMP described by info as a Pillow image for the duration of the block
+
+    Uncompressed direct-color files are decoded straight out of a read-only memory
+    map; when the stored layout already matches Pillow's (32-bit RGBA) the image is
+    a view of the mapped file with no copy at all. Anything else, such as palette
+    or RLE files, falls back to Pillow's own BMP decoder.
+    """
+    if info.raw_mode is None:
+        with Image.open(path) as img:
+            yield img
+        return
+
+    with open(path, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        view = memoryview(mapped)[info.pixel_offset:info.pixel_offset + info.pixel_data_size]
+        try:
+            img = _frombuffer(info, view)
+            try:
+                yield img
+            finally:
+                # Drop Pillow's reference to the mapping before it is closed
+                img.close()
+        finally:
+            view.release()
+    finally:
+        mapped.close()
+
+def _frombuffer(info, pixels):
+    """Wrap the stored pixel array as a Pillow image without copying it"""
+    return Image.frombuffer(info.mode, (info.width, info.height), pixels, "raw",
+                            info.raw_mode, info.row_stride, 1 if info.top_down else -1)
+
+def decode_bmp(data, info):
+    """Decode a BMP file that has already been read into memory as data
+
+    Uncompressed direct-color layouts are wrapped in place like open_bmp does;
+    everything else goes through Pillow's BMP decoder.
+    """
+    if info.raw_mode is None:
+        img = Image.open(io.BytesIO(data))
+        img.load()
+        return img
+    end = info.pixel_offset + info.pixel_data_size
+    if len(data) < end:
+        raise IOError("BMP pixel data is truncated")
+    return _frombuffer(info, memoryview(data)[info.pixel_offset:end])
+
+def iter_strips(path, info, rows_per_strip):
+    """Yield the image as top-to-bottom strips of at most rows_per_strip rows
+
+    Only works for layouts with a raw_mode. BMP rows are fixed-stride and normally
+    stored bottom-up, so each strip is one contiguous read from the pixel array.
+    """
+    raw_mode = info.raw_mode
+    if raw_mode is None:
+        raise IOError("BMP layout cannot be read in strips")
+    stride = info.row_stride
+    if info.file_size is not None and info.pixel_offset + stride * info.height > info.file_size:
+        raise IOError("BMP pixel data is truncated")
+
+    with open(path, 'rb') as f:
+        for top in range(0, info.height, rows_per_strip):
+            rows = min(rows_per_strip, info.height - top)
+            first_stored_row = top if info.top_down else info.height - top - rows
+            f.seek(info.pixel_offset + first_stored_row * stride)
+            data = f.read(rows * stride)
+            if len(data) < rows * stride:
+                raise IOError("BMP pixel data is truncated")
+            yield Image.frombytes(info.mode, (info.width, rows), data, "raw",
+                                  raw_mode, stride, 1 if info.top_down else -1)
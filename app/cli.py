@@ -0,0 +1,225 @@
+"""
+Command line front-end for BMP to PNG Converter
+Runs the same conversion as the GUI without importing tkinter
+"""
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from config import get_config
+from converter import ConversionOptions, convert_directory, describe_stats, print_file_error
+from archive import ARCHIVE_ERRORS, convert_archive, is_archive
+from encoder import ENCODER_PROFILES
+from telemetry import PROFILE_MODES
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="bmp2png",
+        description="Convert every BMP file in a folder to PNG, making one color transparent."
+    )
+    parser.add_argument("directory", nargs="?",
+                        help="folder containing the BMP files, or a zip/tar archive of them")
+    parser.add_argument("--output-archive", metavar="PATH",
+                        help="when converting an archive, write the PNGs into this zip/tar file instead of a folder")
+    parser.add_argument("-o", "--output-folder", help="name of the output folder created inside the directory")
+    parser.add_argument("-c", "--color", dest="transparent_color", help="color to make transparent, e.g. #000000")
+    parser.add_argument("-b", "--background-only", action="store_true", default=None,
+                        help="only make key-colored areas touching the image border transparent")
+    parser.add_argument("-w", "--workers", type=int, help="number of worker processes (0 = all CPUs)")
+    parser.add_argument("-p", "--profile", dest="encoder_profile", choices=ENCODER_PROFILES,
+                        help="PNG encoder profile: fast, balanced or smallest")
+    parser.add_argument("-r", "--recursive", action="store_true", default=None,
+                        help="also convert BMP files in sub-folders, mirroring them under the output folder")
+    parser.add_argument("--atlas", action="store_true", default=None,
+                        help="pack the images into atlas PNGs with an atlas.json frame index instead of one PNG per file")
+    parser.add_argument("--report", dest="run_report", action="store_true", default=None,
+                        help="write per-file stage timings (JSON Lines) and a percentile summary next to the output folder")
+    parser.add_argument("--profile-sample", dest="profile_sample_rate", type=float, metavar="RATE",
+                        help="profile this fraction of the files (0-1), saving results in <output folder>_profiles")
+    parser.add_argument("--profile-mode", choices=PROFILE_MODES, help="profiler used for sampled files")
+    parser.add_argument("--watch", action="store_true",
+                        help="keep running and convert BMP files as they are added or changed")
+    parser.add_argument("--coordinator", action="store_true",
+                        help="hand the folder's files out to --worker processes instead of converting them here")
+    parser.add_argument("--listen", metavar="HOST:PORT", help="address the coordinator listens on")
+    parser.add_argument("--worker", metavar="HOST:PORT",
+                        help="convert files leased from the coordinator at this address; "
+                             "directory is this machine's path to the shared folder")
+    parser.add_argument("--serve", nargs="?", const="", metavar="HOST:PORT",
+                        help="run the HTTP conversion service instead of converting a folder")
+    parser.add_argument("--full", action="store_true", help="reconvert every file, ignoring the incremental manifest")
+    parser.add_argument("-q", "--quiet", action="store_true", help="only print errors")
+    return parser
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.directory is None and args.serve is None:
+        parser.error("a directory is required unless running with --serve")
+
+    if args.serve is not None:
+        return serve(args)
+
+    from_archive = is_archive(args.directory)
+    if not from_archive and not os.path.isdir(args.directory):
+        print(f"Directory not found: {args.directory}", file=sys.stderr)
+        return 2
+    if args.output_archive and not from_archive:
+        print("--output-archive needs an archive as input", file=sys.stderr)
+        return 2
+
+    options = ConversionOptions.from_config(
+        get_config(),
+        transparent_color=args.transparent_color,
+        background_only=args.background_only,
+        atlas=args.atlas,
+        output_folder=args.output_folder,
+        workers=args.workers,
+        incremental=False if args.full else None,
+        recursive=args.recursive,
+        encoder_profile=args.encoder_profile,
+        run_report=args.run_report,
+        profile_sample_rate=args.profile_sample_rate,
+        profile_mode=args.profile_mode,
+    )
+
+    if args.watch:
+        return watch(args, options)
+    if args.worker:
+        return work(args, options)
+
+    coordinator = None
+    if args.coordinator:
+        coordinator = make_coordinator(args, options)
+        events = coordinator.run()
+        if not args.quiet:
+            print(f"Coordinating on {args.listen or get_config().get('cluster', 'listen', default='127.0.0.1:8765')}; "
+                  f"start workers with --worker")
+    elif from_archive:
+        events = convert_archive(args.directory, options, args.output_archive)
+    else:
+        events = convert_directory(args.directory, options)
+
+    processed = failed = skipped = total = 0
+    try:
+        for event in events:
+            total, processed, failed, skipped = event.total, event.processed, event.failed, event.skipped
+            if event.kind == 'start' and not args.quiet:
+                print(f"Scanning {args.directory} for BMP files...")
+            elif event.kind == 'indexed' and not args.quiet:
+                print(f"{event.stats['files']} files to convert ({event.stats['pixels'] / 1e6:.1f} megapixels), "
+                      f"{skipped} unchanged, {failed} rejected")
+            elif event.kind == 'file':
+                if event.error is not None:
+                    print_file_error(event.name, event.input_path, event.error)
+                elif not args.quiet:
+                    duplicate_of = (event.stats or {}).get('duplicate_of')
+                    worker = (event.stats or {}).get('worker')
+                    suffix = f" (same as {duplicate_of})" if duplicate_of else f" ({worker})" if worker else ""
+                    print(f"[{processed + failed + skipped}/{total}] {event.name}{suffix}")
+            elif event.kind == 'done' and not args.quiet and processed:
+                print(describe_stats(event.stats, options.encoder_profile))
+    except ARCHIVE_ERRORS as e:
+        print(f"Cannot read archive {args.directory}: {e}", file=sys.stderr)
+        return 2
+
+    if not args.quiet:
+        print(f"Converted {processed} of {total} files, skipped {skipped} unchanged")
+        if coordinator is not None:
+            for worker, stats in coordinator.worker_summary().items():
+                print(f"  {worker}: {stats['files']} files, {stats['files_per_second']} files/s, "
+                      f"{stats['mb_per_second']} MB/s, {stats['leases_expired']} leases expired")
+    return 1 if failed else 0
+
+def serve(args):
+    """Run the HTTP conversion service until interrupted"""
+    from cluster import parse_address
+    from server import serve as run_server
+
+    config = get_config()
+    options = ConversionOptions.from_config(
+        config,
+        transparent_color=args.transparent_color,
+        background_only=args.background_only,
+        encoder_profile=args.encoder_profile,
+    )
+    host, port = parse_address(args.serve or config.get('server', 'listen', default='127.0.0.1:8080'), 8080)
+    if not args.quiet:
+        print(f"Serving conversions on http://{host}:{port}/convert (Ctrl+C to stop)...")
+    try:
+        run_server(options, host, port, args.workers if args.workers is not None else options.workers,
+                   max_queue=config.get('server', 'max_queue', default=64),
+                   max_body_mb=config.get('server', 'max_body_mb', default=256),
+                   max_buffered_mb=config.get('server', 'max_buffered_mb', default=1024))
+    except KeyboardInterrupt:
+        pass
+    except OSError as e:
+        print(f"Cannot listen on {host}:{port}: {e}", file=sys.stderr)
+        return 2
+    return 0
+
+def make_coordinator(args, options):
+    from cluster import Coordinator, parse_address
+
+    config = get_config()
+    host, port = parse_address(args.listen or config.get('cluster', 'listen', default='127.0.0.1:8765'))
+    return Coordinator(
+        args.directory, options, host, port,
+        batch_size=config.get('cluster', 'batch_size', default=8),
+        lease_seconds=config.get('cluster', 'lease_seconds', default=60),
+    )
+
+def work(args, options):
+    """Convert files leased from a coordinator until it has none left"""
+    from cluster import run_worker
+
+    def report(name, error, stats):
+        if error is not None:
+            print_file_error(name, os.path.join(args.directory, name), error)
+        elif not args.quiet:
+            print(f"Converted {name}")
+
+    try:
+        converted = run_worker(args.worker, args.directory, options.workers, on_result=report)
+    except IOError as e:
+        print(str(e), file=sys.stderr)
+        return 2
+    except KeyboardInterrupt:
+        return 0
+    if not args.quiet:
+        print(f"Converted {converted} files for {args.worker}")
+    return 0
+
+def watch(args, options):
+    """Convert the folder, then keep converting files as they appear until interrupted"""
+    from watcher import FolderWatcher
+
+    config = get_config()
+
+    def report(event):
+        if event.kind == 'file':
+            if event.error is not None:
+                print_file_error(event.name, event.input_path, event.error)
+            elif not args.quiet:
+                print(f"Converted {event.name}")
+        elif event.kind == 'done' and not args.quiet:
+            print(f"Caught up: converted {event.processed} of {event.total} files, skipped {event.skipped} unchanged")
+
+    watcher = FolderWatcher(
+        args.directory, options, report,
+        debounce=config.get('watch', 'debounce_seconds', default=0.25),
+        poll_interval=config.get('watch', 'poll_interval', default=0.5),
+        save_every=config.get('watch', 'save_every_files', default=100),
+        save_interval=config.get('watch', 'save_interval_seconds', default=30.0),
+    )
+    if not args.quiet:
+        print(f"Watching {args.directory} for BMP files (Ctrl+C to stop)...")
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
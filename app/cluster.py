@@ -0,0 +1,402 @@
+"""
+Sharded conversion across several machines
+A coordinator scans the folder and leases batches of files over HTTP to workers, which convert them into the shared output folder
+"""
+import json
+import os
+import queue
+import socket
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from converter import (ConversionEvent, ConversionOptions, convert_parallel, convert_serial, output_path_for,
+                       resolve_workers)
+from dedupe import HashStore
+from manifest import Manifest
+from scanner import scan_bmp_files
+
+# Seconds a worker waits before asking again while every remaining file is leased out
+RETRY_SECONDS = 1.0
+# Failed requests a worker retries before giving up on the coordinator
+CONNECT_ATTEMPTS = 5
+
+def parse_address(address, default_port=8765):
+    """Split 'host:port' (or just 'host') into a (host, port) tuple"""
+    host, _, port = address.rpartition(':')
+    if not host:
+        return port or '127.0.0.1', default_port
+    return host, int(port)
+
+def options_from_settings(settings, output_folder, strip_budget_mb, max_memory_mb=0):
+    """Rebuild ConversionOptions on a worker from a coordinator's output_settings()"""
+    return ConversionOptions(
+        transparent_color=settings['transparent_color'],
+        key_colors=settings.get('key_colors'),
+        background_only=settings.get('background_only', False),
+        keep_palette=settings.get('keep_palette', True),
+        encoder_profile=settings['encoder_profile'],
+        output_folder=output_folder,
+        strip_budget_mb=strip_budget_mb,
+        max_memory_mb=max_memory_mb,
+    )
+
+class Lease:
+    """A batch of files handed to one worker until deadline"""
+    def __init__(self, lease_id, worker, names, lease_seconds):
+        self.id = lease_id
+        self.worker = worker
+        self.names = set(names)
+        self.lease_seconds = lease_seconds
+        self.renew()
+
+    def renew(self):
+        self.deadline = time.monotonic() + self.lease_seconds
+
+class WorkerStats:
+    """Files and bytes one worker has converted, for throughput reporting"""
+    def __init__(self):
+        self.first_seen = time.monotonic()
+        self.last_seen = self.first_seen
+        self.files = 0
+        self.failed = 0
+        self.input_bytes = 0
+        self.leases_expired = 0
+
+    def describe(self):
+        elapsed = max(self.last_seen - self.first_seen, 1e-6)
+        return {
+            'files': self.files,
+            'failed': self.failed,
+            'leases_expired': self.leases_expired,
+            'files_per_second': round(self.files / elapsed, 2),
+            'mb_per_second': round(self.input_bytes / elapsed / (1024 * 1024), 2),
+        }
+
+class Coordinator:
+    """Hands out the BMP files of one folder to workers in leased batches
+
+    A lease that is not renewed or completed within lease_seconds is taken back and
+    its unfinished files go to the front of the queue for the next worker that asks.
+    The first result reported for a file wins; outputs are written atomically, so a
+    file converted twice after a reassigned lease is harmless.
+    """
+    def __init__(self, directory, options, host='127.0.0.1', port=8765, batch_size=8, lease_seconds=60):
+        self.directory = directory
+        self.options = options
+        self.host = host
+        self.port = port
+        self.batch_size = max(1, batch_size)
+        self.lease_seconds = lease_seconds
+        self.output_dir = os.path.join(directory, options.output_folder)
+        self.lock = threading.Lock()
+        self.pending = deque()
+        self.sizes = {}
+        self.leases = {}
+        self.next_lease = 1
+        self.finished = set()
+        self.workers = {}
+        self.results = queue.Queue()
+        self.scanning = True
+        self.server = None
+
+    @property
+    def address(self):
+        """'host:port' the coordinator is listening on, once run() has started"""
+        host, port = self.server.server_address[:2]
+        return f"{host}:{port}"
+
+    def worker_summary(self):
+        """Throughput of every worker seen so far, keyed by worker name"""
+        with self.lock:
+            return {worker: stats.describe() for worker, stats in sorted(self.workers.items())}
+
+    def _worker(self, name):
+        stats = self.workers.get(name)
+        if stats is None:
+            stats = self.workers[name] = WorkerStats()
+        stats.last_seen = time.monotonic()
+        return stats
+
+    def _expire_leases(self):
+        """Requeue the unfinished files of every lease past its deadline; call with the lock held"""
+        now = time.monotonic()
+        for lease in [lease for lease in self.leases.values() if lease.deadline < now]:
+            del self.leases[lease.id]
+            self._worker(lease.worker).leases_expired += 1
+            self.pending.extendleft(sorted(lease.names - self.finished, reverse=True))
+
+    def lease(self, request):
+        with self.lock:
+            self._worker(request['worker'])
+            self._expire_leases()
+            if not self.pending:
+                if not self.scanning and len(self.finished) >= len(self.sizes):
+                    return {'done': True}
+                return {'files': [], 'retry': RETRY_SECONDS}
+            names = [self.pending.popleft() for _ in range(min(self.batch_size, len(self.pending)))]
+            lease = Lease(self.next_lease, request['worker'], names, self.lease_seconds)
+            self.leases[lease.id] = lease
+            self.next_lease += 1
+        return {
+            'lease': lease.id,
+            'lease_seconds': self.lease_seconds,
+            'files': [{'name': name, 'size': self.sizes[name]} for name in names],
+            'settings': self.options.output_settings(),
+            'output_folder': self.options.output_folder,
+            'strip_budget_mb': self.options.strip_budget_mb,
+            'max_memory_mb': self.options.max_memory_mb,
+        }
+
+    def renew(self, request):
+        with self.lock:
+            self._worker(request['worker'])
+            lease = self.leases.get(request['lease'])
+            if lease is None:
+                return {'ok': False}
+            lease.renew()
+            return {'ok': True}
+
+    def complete(self, request):
+        with self.lock:
+            stats = self._worker(request['worker'])
+            lease = self.leases.pop(request['lease'], None)
+            for result in request['results']:
+                name = result['name']
+                if name in self.finished or name not in self.sizes:
+                    continue
+                self.finished.add(name)
+                if lease is not None:
+                    lease.names.discard(name)
+                elif name in self.pending:
+                    # A late result from an expired lease; no need to convert it again
+                    self.pending.remove(name)
+                if result['error'] is None:
+                    stats.files += 1
+                    stats.input_bytes += result['stats']['input_bytes']
+                else:
+                    stats.failed += 1
+                self.results.put((request['worker'], result))
+            if lease is not None and lease.names - self.finished:
+                # Files the worker did not report go back in the queue
+                self.pending.extendleft(sorted(lease.names - self.finished, reverse=True))
+        return {'ok': True}
+
+    def status(self):
+        with self.lock:
+            return {
+                'total': len(self.sizes),
+                'finished': len(self.finished),
+                'pending': len(self.pending),
+                'leased': sum(len(lease.names) for lease in self.leases.values()),
+                'workers': {worker: stats.describe() for worker, stats in sorted(self.workers.items())},
+            }
+
+    def _make_handler(self):
+        coordinator = self
+        routes = {'/lease': coordinator.lease, '/renew': coordinator.renew, '/complete': coordinator.complete}
+
+        class Handler(BaseHTTPRequestHandler):
+            def _reply(self, code, body):
+                data = json.dumps(body).encode()
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                if self.path == '/status':
+                    self._reply(200, coordinator.status())
+                else:
+                    self._reply(404, {'error': 'not found'})
+
+            def do_POST(self):
+                route = routes.get(self.path)
+                if route is None:
+                    self._reply(404, {'error': 'not found'})
+                    return
+                try:
+                    request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                    self._reply(200, route(request))
+                except (ValueError, KeyError, TypeError) as e:
+                    self._reply(400, {'error': str(e)})
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def run(self):
+        """Scan the folder, serve leases until every file is done and yield ConversionEvents
+
+        Files already up to date in the manifest are skipped here and never handed out.
+        Workers can start on the first files while the scan is still running. Each
+        'file' event's stats carry the name of the worker that converted it.
+        """
+        os.makedirs(self.output_dir, exist_ok=True)
+        manifest = Manifest.load(self.output_dir) if self.options.incremental else None
+        settings = self.options.output_settings()
+        # Workers don't hash their inputs, so PNGs they rewrite are dropped from the duplicate store
+        hashes = HashStore.load(self.output_dir, settings) if self.options.dedupe else None
+        counts = {'total': 0, 'processed': 0, 'failed': 0, 'skipped': 0}
+        totals = {'input_bytes': 0, 'output_bytes': 0, 'encode_seconds': 0.0}
+
+        self.server = ThreadingHTTPServer((self.host, self.port), self._make_handler())
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            yield ConversionEvent('start')
+            for entry in scan_bmp_files(self.directory, self.options.recursive, exclude=(self.output_dir,)):
+                counts['total'] += 1
+                output_path = output_path_for(self.output_dir, entry.name)
+                try:
+                    stat = entry.stat
+                    up_to_date = manifest is not None and manifest.check(entry.name, entry.path, output_path,
+                                                                         settings, stat)[0]
+                except OSError:
+                    stat, up_to_date = None, False
+                if up_to_date:
+                    counts['skipped'] += 1
+                    yield ConversionEvent('skip', name=entry.name, input_path=entry.path, output_path=output_path,
+                                          **counts)
+                    continue
+                with self.lock:
+                    self.sizes[entry.name] = stat.st_size if stat is not None else None
+                    self.pending.append(entry.name)
+            with self.lock:
+                self.scanning = False
+
+            remaining = len(self.sizes)
+            while remaining:
+                try:
+                    worker, result = self.results.get(timeout=1.0)
+                except queue.Empty:
+                    with self.lock:
+                        self._expire_leases()
+                    continue
+                remaining -= 1
+                name = result['name']
+                input_path = os.path.join(self.directory, *name.split('/'))
+                output_path = output_path_for(self.output_dir, name)
+                error = IOError(result['error']) if result['error'] is not None else None
+                stats = result['stats']
+                if error is None:
+                    counts['processed'] += 1
+                    for key in totals:
+                        totals[key] += stats[key]
+                    stats['worker'] = worker
+                    if hashes is not None:
+                        hashes.forget_name(name)
+                    if manifest is not None:
+                        try:
+                            manifest.record(name, input_path, settings)
+                        except OSError:
+                            pass
+                else:
+                    counts['failed'] += 1
+                yield ConversionEvent('file', name=name, input_path=input_path, output_path=output_path,
+                                      error=error, stats=stats if error is None else None, **counts)
+            # Let workers polling right now hear that the run is over
+            time.sleep(RETRY_SECONDS)
+        finally:
+            self.server.shutdown()
+            self.server.server_close()
+            thread.join()
+            if manifest is not None:
+                manifest.save()
+            if hashes is not None:
+                hashes.save()
+
+        yield ConversionEvent('done', stats=totals, **counts)
+
+class CoordinatorClient:
+    """JSON-over-HTTP calls from a worker to its coordinator"""
+    def __init__(self, url, timeout=30):
+        self.url = url.rstrip('/') if '://' in url else 'http://' + url.rstrip('/')
+        self.timeout = timeout
+
+    def post(self, path, body):
+        request = urllib.request.Request(self.url + path, data=json.dumps(body).encode(),
+                                         headers={'Content-Type': 'application/json'})
+        for attempt in range(CONNECT_ATTEMPTS):
+            try:
+                with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                    return json.loads(response.read())
+            except (urllib.error.URLError, ConnectionError, socket.timeout) as e:
+                if attempt == CONNECT_ATTEMPTS - 1:
+                    raise IOError(f"Cannot reach coordinator at {self.url}: {e}")
+                time.sleep(RETRY_SECONDS)
+
+def _keep_renewing(client, worker, lease_id, interval, stop):
+    while not stop.wait(interval):
+        try:
+            if not client.post('/renew', {'worker': worker, 'lease': lease_id}).get('ok'):
+                return
+        except IOError:
+            return
+
+def run_worker(url, directory, workers=0, name=None, on_result=None):
+    """Convert batches leased from the coordinator at url until it reports the run is done
+
+    directory is this machine's path to the shared input folder. on_result, if given,
+    is called with (name, error, stats) for every converted file. Returns the number
+    of files converted.
+    """
+    client = CoordinatorClient(url)
+    name = name or f"{socket.gethostname()}-{os.getpid()}"
+    workers = resolve_workers(workers)
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    converted = 0
+    connected = False
+    try:
+        while True:
+            try:
+                reply = client.post('/lease', {'worker': name})
+            except IOError:
+                if not connected:
+                    raise
+                # The coordinator finished and shut down between our requests
+                break
+            connected = True
+            if reply.get('done'):
+                break
+            if not reply['files']:
+                time.sleep(reply.get('retry', RETRY_SECONDS))
+                continue
+
+            options = options_from_settings(reply['settings'], reply['output_folder'], reply['strip_budget_mb'],
+                                            reply.get('max_memory_mb', 0))
+            options.workers = workers
+            output_dir = os.path.join(directory, options.output_folder)
+            stop = threading.Event()
+            renewer = threading.Thread(target=_keep_renewing, daemon=True,
+                                       args=(client, name, reply['lease'], reply['lease_seconds'] / 3, stop))
+            renewer.start()
+            try:
+                jobs = [(job['name'], os.path.join(directory, *job['name'].split('/')),
+                         output_path_for(output_dir, job['name']), job['size'], None, None)
+                        for job in reply['files']]
+                # The batch shares the pool under the same memory budget as a local run
+                if executor is not None:
+                    finished = convert_parallel(jobs, options, executor)
+                else:
+                    finished = convert_serial(jobs, options)
+                results = []
+                for job_name, _, _, error, stats in finished:
+                    if error is None:
+                        converted += 1
+                    if on_result is not None:
+                        on_result(job_name, error, stats)
+                    results.append({'name': job_name, 'error': str(error) if error else None, 'stats': stats})
+            finally:
+                stop.set()
+            client.post('/complete', {'worker': name, 'lease': reply['lease'], 'results': results})
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+    return converted
@@ -0,0 +1,29 @@
+import json
+import os
+
+class Config:
+    def __init__(self):
+        config_path = os.path.join(os.path.dirname(__file__), 'config.json')
+        with open(config_path, 'r') as f:
+            self.config = json.load(f)
+    
+    def get(self, *keys, default=None):
+        value = self.config
+        for key in keys:
+            if isinstance(value, dict):
+                value = value.get(key, default)
+            else:
+                return default
+        return value
+    
+    def get_template(self, component_type):
+        return self.get('components', component_type, 'template', default={})
+
+_shared_config = None
+
+def get_config():
+    """Return the Config shared by the whole application, reading config.json on first use"""
+    global _shared_config
+    if _shared_config is None:
+        _shared_config = Config()
+    return _shared_config
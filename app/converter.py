@@ -0,0 +1,950 @@
+"""
+Headless conversion core shared by the GUI, the command line and the worker processes
+Nothing in here imports tkinter, so it can run on machines without a display
+"""
+import copy
+import glob
+import os
+import queue
+import tempfile
+import threading
+import time
+from collections import deque
+from contextlib import ExitStack, contextmanager
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from bmp_reader import decode_bmp, iter_strips, open_bmp, parse_bmp_header, read_bmp_info
+from dedupe import HashStore, link_or_copy
+from encoder import DEFAULT_PROFILE, STREAM_COMPRESS_LEVELS, check_profile, encode_png
+from keying import (BorderRegions, KeyColor, apply_color_key, key_palette, key_region, parse_hex_color,
+                    parse_key_colors)
+from manifest import Manifest, hash_file
+from png_writer import PngStreamWriter
+from scanner import HeaderIndex, scan_bmp_files
+from telemetry import PROFILE_MODES, RunReport, StageTimer, run_profiled, should_profile
+
+# Outputs are written under this suffix and renamed once complete
+PARTIAL_SUFFIX = ".part"
+# Partial files untouched for this long were left by a killed run rather than a writer still going
+STALE_PARTIAL_SECONDS = 15 * 60
+# Only readable by setting it, so read once here rather than from worker threads
+UMASK = os.umask(0)
+os.umask(UMASK)
+# Keying and filtering a strip holds roughly this many RGBA-sized copies of it at once
+STRIP_WORKING_COPIES = 8
+# Peak memory of converting a whole image in memory, per pixel; measured at 16-19
+# bytes for 24/32-bit sources with the various keying modes, rounded up for headroom
+PEAK_BYTES_PER_PIXEL = 20
+# BorderRegions keeps a 4-byte label per run of keyed pixels, at worst one run every
+# two pixels; measured at 2.5 bytes per pixel on a checkerboard, rounded up
+REGION_BYTES_PER_PIXEL = 3
+MEGABYTE = 1024 * 1024
+
+class ConversionOptions:
+    """Settings for a conversion run, usually built from the 'conversion' section of config.json"""
+    def __init__(self, transparent_color=(0, 0, 0), output_folder="PNG_exports", workers=0, incremental=False,
+                 recursive=False, strip_budget_mb=64, encoder_profile=DEFAULT_PROFILE, run_report=False,
+                 profile_sample_rate=0.0, profile_mode='cprofile', pipeline=False, read_ahead=4, write_behind=4,
+                 key_colors=None, background_only=False, dedupe=False, atlas=False, atlas_max_size=4096,
+                 atlas_padding=1, atlas_trim=True, prescan=False, max_memory_mb=0, keep_palette=True):
+        if isinstance(transparent_color, str):
+            transparent_color = parse_hex_color(transparent_color)
+        self.transparent_color = tuple(transparent_color)
+        # Without a key list, transparent_color is the only (exact) key
+        self.key_colors = parse_key_colors(key_colors) if key_colors else (KeyColor(self.transparent_color),)
+        self.background_only = background_only
+        self.keep_palette = keep_palette
+        self.dedupe = dedupe
+        self.atlas = atlas
+        self.atlas_max_size = atlas_max_size
+        self.atlas_padding = atlas_padding
+        self.atlas_trim = atlas_trim
+        self.output_folder = output_folder
+        self.workers = workers
+        self.incremental = incremental
+        self.recursive = recursive
+        self.strip_budget_mb = strip_budget_mb
+        self.max_memory_mb = max_memory_mb
+        self.encoder_profile = check_profile(encoder_profile)
+        self.run_report = run_report
+        self.profile_sample_rate = profile_sample_rate
+        if profile_mode not in PROFILE_MODES:
+            raise ValueError(f"Unknown profile mode '{profile_mode}' (expected one of: {', '.join(PROFILE_MODES)})")
+        self.profile_mode = profile_mode
+        self.pipeline = pipeline
+        self.prescan = prescan
+        self.read_ahead = read_ahead
+        self.write_behind = write_behind
+
+    @classmethod
+    def from_config(cls, config, **overrides):
+        """Build options from a Config object, letting keyword arguments take precedence"""
+        settings = {
+            'transparent_color': config.get('conversion', 'transparent_color', default='#000000'),
+            'output_folder': config.get('conversion', 'output_folder', default='PNG_exports'),
+            'workers': config.get('conversion', 'workers', default=0),
+            'incremental': config.get('conversion', 'incremental', default=False),
+            'recursive': config.get('conversion', 'recursive', default=False),
+            'strip_budget_mb': config.get('conversion', 'strip_budget_mb', default=64),
+            'max_memory_mb': config.get('conversion', 'max_memory_mb', default=0),
+            'encoder_profile': config.get('conversion', 'encoder_profile', default=DEFAULT_PROFILE),
+            'run_report': config.get('conversion', 'run_report', default=False),
+            'profile_sample_rate': config.get('conversion', 'profile_sample_rate', default=0.0),
+            'profile_mode': config.get('conversion', 'profile_mode', default='cprofile'),
+            'pipeline': config.get('conversion', 'pipeline', default=False),
+            'prescan': config.get('conversion', 'prescan', default=False),
+            'read_ahead': config.get('conversion', 'read_ahead', default=4),
+            'write_behind': config.get('conversion', 'write_behind', default=4),
+            'key_colors': config.get('conversion', 'key_colors', default=None),
+            'background_only': config.get('conversion', 'background_only', default=False),
+            'keep_palette': config.get('conversion', 'keep_palette', default=True),
+            'dedupe': config.get('conversion', 'dedupe', default=False),
+            'atlas': config.get('atlas', 'enabled', default=False),
+            'atlas_max_size': config.get('atlas', 'max_size', default=4096),
+            'atlas_padding': config.get('atlas', 'padding', default=1),
+            'atlas_trim': config.get('atlas', 'trim', default=True),
+        }
+        if overrides.get('transparent_color') is not None:
+            # A color picked for this run replaces the configured key list
+            settings['key_colors'] = None
+        settings.update({key: value for key, value in overrides.items() if value is not None})
+        return cls(**settings)
+
+    def output_settings(self):
+        """JSON-friendly description of every setting that affects the written PNGs"""
+        settings = {
+            'transparent_color': '#%02X%02X%02X' % self.transparent_color,
+            'encoder_profile': self.encoder_profile,
+        }
+        if self.key_colors != (KeyColor(self.transparent_color),):
+            settings['key_colors'] = [key.describe() for key in self.key_colors]
+        if self.background_only:
+            settings['background_only'] = True
+        if not self.keep_palette:
+            settings['keep_palette'] = False
+        return settings
+
+class ConversionEvent:
+    """Progress notification yielded by convert_directory
+
+    kind is 'start' once the file list is known, 'skip' for each file whose output is
+    already up to date, 'indexed' when a header pre-scan has finished, 'file' after
+    each file finishes (error is None on success) and 'done' when the run is over.
+    stats holds the byte counts and encode time from convert_file for a 'file' event,
+    the scan time for a 'skip', the file count and total pixels about to be converted
+    for 'indexed' and the run totals for 'done'.
+    """
+    def __init__(self, kind, total=0, processed=0, failed=0, skipped=0, name=None,
+                 input_path=None, output_path=None, error=None, stats=None):
+        self.kind = kind
+        self.total = total
+        self.processed = processed
+        self.failed = failed
+        self.skipped = skipped
+        self.name = name
+        self.input_path = input_path
+        self.output_path = output_path
+        self.error = error
+        self.stats = stats
+
+def resolve_workers(workers):
+    """Turn the configured worker count into a usable number (0 or None means all CPUs)"""
+    if not workers or workers < 1:
+        return os.cpu_count() or 1
+    return workers
+
+def output_path_for(output_dir, bmp_file):
+    """Return the PNG path a BMP file will be written to"""
+    return os.path.normpath(os.path.join(output_dir, os.path.splitext(bmp_file)[0] + '.png'))
+
+def ensure_parent_dir(path):
+    """Create the folder path will be written into, if it has one"""
+    folder = os.path.dirname(path)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+
+def inspect_source(input_path, file_size, timer, info=None):
+    """Run the 'validation' stage for one file, returning its size and parsed BmpInfo
+
+    When a pre-scan already parsed the headers, pass them as info to skip re-reading them.
+    """
+    if info is not None:
+        return info.file_size, info
+    with timer.stage('validation'):
+        if file_size is None:
+            # Check if input file exists and is readable
+            if not os.path.exists(input_path):
+                raise FileNotFoundError(f"Input file does not exist: {input_path}")
+            file_size = os.path.getsize(input_path)
+
+        # Check for empty files
+        if file_size == 0:
+            raise IOError(f"File is empty (0 bytes)")
+
+        try:
+            # Parse the headers first so broken files are rejected with a precise reason
+            info = read_bmp_info(input_path, file_size)
+        except Exception as e:
+            raise IOError(f"Cannot read file: {str(e)}")
+    return file_size, info
+
+def inspect_data(data, timer):
+    """Run the 'validation' stage for a BMP already held in memory, returning its BmpInfo"""
+    with timer.stage('validation'):
+        if not data:
+            raise IOError(f"File is empty (0 bytes)")
+        try:
+            return parse_bmp_header(data, len(data))
+        except Exception as e:
+            raise IOError(f"Cannot read file: {str(e)}")
+
+@contextmanager
+def open_output(output_path):
+    """Open an output file for writing, moving it into place only once it is complete
+
+    The data goes to a uniquely named PARTIAL_SUFFIX file next to output_path and is
+    renamed over output_path when the block finishes, so a crash or error never leaves
+    a truncated PNG under the real name, and two writers of the same output never
+    share a temp file. Renaming also replaces the name rather than the file, so other
+    names hardlinked to the old PNG (see dedupe) keep their contents. Partial files of
+    the same output left behind by a killed run are removed once it is written.
+    """
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(output_path) or os.curdir,
+                                     prefix=os.path.basename(output_path) + ".", suffix=PARTIAL_SUFFIX)
+    f = os.fdopen(fd, 'wb')
+    try:
+        # mkstemp makes the file private to this user; give it the permissions open() would have
+        os.chmod(temp_path, 0o666 & ~UMASK)
+        yield f
+    except BaseException:
+        f.close()
+        os.remove(temp_path)
+        raise
+    f.close()
+    os.replace(temp_path, output_path)
+    remove_stale_partials(output_path)
+
+def remove_stale_partials(output_path):
+    """Delete PARTIAL_SUFFIX files of output_path not written to for STALE_PARTIAL_SECONDS"""
+    pattern = glob.escape(output_path) + ".*" + PARTIAL_SUFFIX
+    cutoff = time.time() - STALE_PARTIAL_SECONDS
+    for path in glob.glob(pattern):
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            # Already gone, or finished by another writer in the meantime
+            pass
+
+def needs_strips(info, options):
+    """True when the decoded image would not fit in the strip budget and must be streamed"""
+    strip_budget = int(options.strip_budget_mb * 1024 * 1024)
+    return bool(strip_budget) and info.raw_mode is not None and info.width * info.height * 4 > strip_budget
+
+def estimate_memory(info, options):
+    """Rough peak bytes converting the image described by info will need"""
+    if needs_strips(info, options):
+        # The strip path works within its budget, plus the region labels for background_only
+        extra = info.width * info.height * REGION_BYTES_PER_PIXEL if options.background_only else 0
+        return int(options.strip_budget_mb * MEGABYTE) + extra
+    return info.width * info.height * PEAK_BYTES_PER_PIXEL
+
+def plan_memory(input_path, file_size, info, options):
+    """Return (estimated peak bytes, options to convert with) for one file under max_memory_mb
+
+    An uncompressed image too big for the whole budget is sent down the strip path
+    with a strip budget that fits. Others, such as RLE files, keep their estimate and
+    are left to run on their own. Without a budget the estimate is 0.
+    """
+    if not options.max_memory_mb:
+        return 0, options
+    if info is None:
+        try:
+            info = read_bmp_info(input_path, file_size)
+        except Exception:
+            # Converting it will report the problem properly
+            return 0, options
+    cost = estimate_memory(info, options)
+    limit = options.max_memory_mb * MEGABYTE
+    if cost > limit and info.raw_mode is not None:
+        options = copy.copy(options)
+        # Small enough to force strips, and to leave room in the budget
+        options.strip_budget_mb = min(options.strip_budget_mb, options.max_memory_mb / 4,
+                                      (info.width * info.height * 4 - 1) / MEGABYTE)
+        cost = estimate_memory(info, options)
+    return cost, options
+
+def whole_image_memory(source, options):
+    """Rough peak bytes converting source whole will need, for paths that never use strips
+
+    source is a BMP file's path or its bytes. Like plan_memory, this is 0 without
+    max_memory_mb or when the headers cannot be read.
+    """
+    if not options.max_memory_mb:
+        return 0
+    try:
+        if isinstance(source, (bytes, bytearray)):
+            info = parse_bmp_header(source, len(source))
+        else:
+            info = read_bmp_info(source)
+    except Exception:
+        return 0
+    return info.width * info.height * PEAK_BYTES_PER_PIXEL
+
+class MemoryBudget:
+    """Estimated peak memory of the jobs in flight, checked against max_memory_mb
+
+    A job is admitted while it fits in what is left. One bigger than the whole budget
+    is only admitted when nothing else is running, so it runs alone instead of failing.
+    """
+    def __init__(self, limit_mb):
+        self.limit = int(limit_mb * MEGABYTE)
+        self.used = 0
+
+    def fits(self, cost):
+        return not self.limit or not self.used or self.used + cost <= self.limit
+
+    def take(self, cost):
+        self.used += cost
+
+    def release(self, cost):
+        self.used -= cost
+
+def key_and_encode(img, options, timer):
+    """Run the 'keying' and 'encode' stages on a decoded image, returning the PNG bytes
+
+    Indexed images are keyed through their palette and written as indexed PNGs,
+    unless keep_palette is off or background_only needs to tell pixels of one
+    palette entry apart.
+    """
+    with timer.stage('keying'):
+        keyed = None
+        if options.keep_palette and not options.background_only:
+            keyed = key_palette(img, options.key_colors)
+        if keyed is None:
+            keyed = apply_color_key(img, options.key_colors, options.background_only)
+    with timer.stage('encode'):
+        return encode_png(keyed, options.encoder_profile)
+
+def file_stats(file_size, output_bytes, timer):
+    """Per-file result dict shared by every conversion path"""
+    return {
+        'input_bytes': file_size,
+        'output_bytes': output_bytes,
+        'encode_seconds': timer.stages.get('encode', 0.0),
+        'stages': timer.stages,
+    }
+
+def convert_file(input_path, output_path, options, file_size=None, info=None):
+    """Convert a single BMP file to PNG, making the configured color transparent
+
+    file_size can be passed when the caller already has it from a directory scan,
+    which saves re-checking the file before opening it, and likewise its BmpInfo from
+    a header pre-scan. Returns a dict with the
+    input and output sizes in bytes, the seconds spent encoding the PNG and the
+    seconds spent in each stage (see telemetry.STAGES).
+    """
+    timer = StageTimer()
+    file_size, info = inspect_source(input_path, file_size, timer, info)
+    ensure_parent_dir(output_path)
+
+    # Big uncompressed files are keyed strip by strip to keep memory bounded
+    if needs_strips(info, options):
+        convert_in_strips(input_path, output_path, info, options, timer)
+    else:
+        # Now try to process the image
+        with ExitStack() as stack:
+            with timer.stage('decode'):
+                img = stack.enter_context(open_bmp(input_path, info))
+                img.load()
+            data = key_and_encode(img, options, timer)
+        with timer.stage('write'):
+            with open_output(output_path) as f:
+                f.write(data)
+
+    return file_stats(file_size, os.path.getsize(output_path), timer)
+
+def convert_in_strips(input_path, output_path, info, options, timer):
+    """Convert an uncompressed BMP while keeping the working set to about strip_budget_mb
+
+    Every profile uses the streaming encoder here, only its compression level changes.
+    Strip timings are added to timer; the encoder writes as it goes, so file writes
+    are counted as part of 'encode'.
+    """
+    strip_budget = int(options.strip_budget_mb * 1024 * 1024)
+    rows_per_strip = max(1, strip_budget // (info.width * 4 * STRIP_WORKING_COPIES))
+    regions = None
+    if options.background_only:
+        # Whether a keyed area reaches the border can depend on rows further down,
+        # so label the whole image in a first pass over the strips
+        regions = BorderRegions(info.width, info.height)
+        strips = iter_strips(input_path, info, rows_per_strip)
+        while True:
+            with timer.stage('decode'):
+                strip = next(strips, None)
+            if strip is None:
+                break
+            with timer.stage('keying'):
+                regions.add(key_region(strip, options.key_colors))
+
+    with open_output(output_path) as f:
+        writer = PngStreamWriter(f, info.width, info.height, STREAM_COMPRESS_LEVELS[options.encoder_profile])
+        strips = iter_strips(input_path, info, rows_per_strip)
+        top = 0
+        while True:
+            with timer.stage('decode'):
+                strip = next(strips, None)
+            if strip is None:
+                break
+            with timer.stage('keying'):
+                strip = apply_color_key(strip, options.key_colors, options.background_only, regions, top)
+            top += strip.height
+            with timer.stage('encode'):
+                writer.write_strip(strip)
+        with timer.stage('encode'):
+            writer.close()
+
+def run_job(input_path, output_path, options, file_size=None, profile_path=None, info=None):
+    """convert_file, run under the configured profiler when profile_path is set"""
+    if profile_path is None:
+        return convert_file(input_path, output_path, options, file_size, info)
+    return run_profiled(options.profile_mode, profile_path, convert_file, input_path, output_path, options,
+                        file_size, info)
+
+def convert_serial(jobs, options):
+    """Run each (name, input_path, output_path, file_size, profile_path, info) job in this process"""
+    for name, input_path, output_path, file_size, profile_path, info in jobs:
+        try:
+            _, job_options = plan_memory(input_path, file_size, info, options)
+            stats = run_job(input_path, output_path, job_options, file_size, profile_path, info)
+            yield name, input_path, output_path, None, stats
+        except Exception as e:
+            yield name, input_path, output_path, e, None
+
+def run_budgeted(executor, tasks, options, workers):
+    """Run (key, cost, fn, args) tasks on executor, yielding (key, error, result) as each finishes
+
+    Tasks are pulled from the iterable only as workers free up, at most two per worker
+    at a time, and with max_memory_mb only while their estimated cost fits in the
+    budget (see MemoryBudget).
+    """
+    tasks = iter(tasks)
+    budget = MemoryBudget(options.max_memory_mb)
+    in_flight = {}
+    held = None
+    exhausted = False
+    while True:
+        # Keep a couple of tasks queued per worker so no process waits on the caller
+        while not exhausted and len(in_flight) < workers * 2:
+            if held is None:
+                held = next(tasks, None)
+                if held is None:
+                    exhausted = True
+                    break
+            key, cost, fn, args = held
+            if not budget.fits(cost):
+                # Wait for running tasks to give back enough of the budget
+                break
+            held = None
+            budget.take(cost)
+            in_flight[executor.submit(fn, *args)] = (key, cost)
+        if not in_flight:
+            break
+        done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+        for future in done:
+            key, cost = in_flight.pop(future)
+            budget.release(cost)
+            error = future.exception()
+            yield key, error, None if error else future.result()
+
+def convert_parallel(jobs, options, executor=None):
+    """Run each (name, input_path, output_path, file_size, profile_path, info) job on a process pool
+
+    Jobs are pulled from the iterable only as workers free up, so a streaming scan keeps
+    feeding the pool, and with max_memory_mb only while their estimated memory fits in
+    the budget. Yields (name, input_path, output_path, error, stats) as each file
+    finishes, with error set to None on success. Pass executor to use an existing pool
+    of options.workers processes instead of starting one.
+    """
+    workers = resolve_workers(options.workers)
+
+    def tasks():
+        for name, input_path, output_path, file_size, profile_path, info in jobs:
+            cost, job_options = plan_memory(input_path, file_size, info, options)
+            yield ((name, input_path, output_path), cost, run_job,
+                   (input_path, output_path, job_options, file_size, profile_path, info))
+
+    with ExitStack() as stack:
+        if executor is None:
+            executor = stack.enter_context(ProcessPoolExecutor(max_workers=workers))
+        for (name, input_path, output_path), error, stats in run_budgeted(executor, tasks(), options, workers):
+            yield name, input_path, output_path, error, stats
+
+# Marks the end of a pipeline queue
+END_OF_QUEUE = object()
+
+def render_job(data, info, options):
+    """Compute stage of the pipeline: decode, key and encode a BMP held in memory"""
+    timer = StageTimer()
+    with timer.stage('decode'):
+        img = decode_bmp(data, info)
+    return key_and_encode(img, options, timer), timer.stages
+
+def _put(q, item, stop):
+    """Put item on a bounded queue, giving up if the pipeline is being torn down"""
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def _get(q, stop):
+    """Take the next item from a queue, returning END_OF_QUEUE if the pipeline is torn down"""
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    return END_OF_QUEUE
+
+class PipelineItem:
+    """One file travelling through the pipeline stages"""
+    def __init__(self, job):
+        self.name, self.input_path, self.output_path, self.file_size, self.profile_path, self.info = job
+        self.timer = StageTimer()
+        # Estimated peak memory and the options to convert with, see plan_memory
+        self.memory = 0
+        self.options = None
+        self.data = None
+        self.error = None
+        self.stats = None
+
+    @property
+    def finished(self):
+        return self.error is not None or self.stats is not None
+
+def _read_stage(jobs, read_queue, options, stop):
+    """Validate each file and read it into memory ahead of the compute stage"""
+    try:
+        for job in jobs:
+            item = PipelineItem(job)
+            # Profiled files and files too big to hold in memory are converted whole by the compute stage
+            if item.profile_path is None:
+                try:
+                    item.file_size, item.info = inspect_source(item.input_path, item.file_size, item.timer,
+                                                               item.info)
+                    item.memory, item.options = plan_memory(item.input_path, item.file_size, item.info, options)
+                    if not needs_strips(item.info, item.options):
+                        with item.timer.stage('read'):
+                            with open(item.input_path, 'rb') as f:
+                                item.data = f.read()
+                except Exception as e:
+                    item.error = e
+            if not _put(read_queue, item, stop):
+                return
+    except Exception as e:
+        # The scan itself failed; hand the error to the consumer
+        _put(read_queue, e, stop)
+    _put(read_queue, END_OF_QUEUE, stop)
+
+def _finish_compute(item, result=None, error=None):
+    """Store the compute stage's outcome on item"""
+    if error is not None:
+        item.error = error
+    elif item.data is None:
+        # run_job already wrote the file and returned its stats
+        item.stats = result
+    else:
+        item.data, stages = result
+        item.timer.stages.update(stages)
+
+def _compute_stage(read_queue, write_queue, options, stop):
+    """Decode, key and encode files from read_queue, in this thread or on a process pool"""
+    workers = resolve_workers(options.workers)
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    budget = MemoryBudget(options.max_memory_mb)
+    in_flight = {}
+    held = None
+    exhausted = False
+    try:
+        while True:
+            # Keep a couple of files queued per worker; block on the reader only when idle
+            while not exhausted and len(in_flight) < max(1, workers * 2):
+                if held is not None:
+                    item, held = held, None
+                else:
+                    try:
+                        item = _get(read_queue, stop) if not in_flight else read_queue.get_nowait()
+                    except queue.Empty:
+                        break
+                if item is END_OF_QUEUE:
+                    exhausted = True
+                    break
+                if isinstance(item, Exception):
+                    _put(write_queue, item, stop)
+                    continue
+                if item.error is not None:
+                    if not _put(write_queue, item, stop):
+                        return
+                    continue
+                job_options = item.options or options
+                if item.data is None:
+                    args = (run_job, item.input_path, item.output_path, job_options, item.file_size,
+                            item.profile_path, item.info)
+                else:
+                    args = (render_job, item.data, item.info, job_options)
+                if executor is None:
+                    try:
+                        _finish_compute(item, args[0](*args[1:]))
+                    except Exception as e:
+                        _finish_compute(item, error=e)
+                    if not _put(write_queue, item, stop):
+                        return
+                elif not budget.fits(item.memory):
+                    # Wait for running files to give back enough of the budget
+                    held = item
+                    break
+                else:
+                    budget.take(item.memory)
+                    in_flight[executor.submit(*args)] = item
+            if not in_flight:
+                if (exhausted and held is None) or stop.is_set():
+                    break
+                continue
+            # Wake up now and then to top up from the reader while workers are busy
+            done, _ = wait(in_flight, timeout=None if exhausted else 0.05, return_when=FIRST_COMPLETED)
+            for future in done:
+                item = in_flight.pop(future)
+                budget.release(item.memory)
+                error = future.exception()
+                _finish_compute(item, None if error else future.result(), error)
+                if not _put(write_queue, item, stop):
+                    return
+    except Exception as e:
+        # e.g. BrokenProcessPool from submit() after a worker died; hand it to the consumer
+        _put(write_queue, e, stop)
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+        # Always sent, so the writer and the consumer never wait on a stage that is gone
+        _put(write_queue, END_OF_QUEUE, stop)
+
+def _write_stage(write_queue, done_queue, stop):
+    """Write encoded PNGs to disk and pass every item on to the consumer"""
+    while True:
+        item = _get(write_queue, stop)
+        if item is END_OF_QUEUE or isinstance(item, Exception):
+            done_queue.put(item)
+            if item is END_OF_QUEUE:
+                return
+            continue
+        if not item.finished:
+            try:
+                with item.timer.stage('write'):
+                    ensure_parent_dir(item.output_path)
+                    with open_output(item.output_path) as f:
+                        f.write(item.data)
+                item.stats = file_stats(item.file_size, len(item.data), item.timer)
+            except Exception as e:
+                item.error = e
+            item.data = None
+        done_queue.put(item)
+
+def convert_pipelined(jobs, options):
+    """Run each (name, input_path, output_path, file_size, profile_path, info) job through staged threads
+
+    A reader thread validates files and reads them into memory up to read_ahead files
+    ahead, the compute stage decodes, keys and encodes them (on a process pool when
+    there is more than one worker) and a writer thread saves up to write_behind PNGs
+    behind it. The bounded queues between the stages give backpressure, so on slow
+    storage the run goes as fast as its slowest stage rather than the sum of all of
+    them. Yields (name, input_path, output_path, error, stats) like convert_parallel.
+    """
+    read_queue = queue.Queue(maxsize=max(1, options.read_ahead))
+    write_queue = queue.Queue(maxsize=max(1, options.write_behind))
+    done_queue = queue.Queue()
+    stop = threading.Event()
+    threads = [
+        threading.Thread(target=_read_stage, args=(jobs, read_queue, options, stop), daemon=True),
+        threading.Thread(target=_compute_stage, args=(read_queue, write_queue, options, stop), daemon=True),
+        threading.Thread(target=_write_stage, args=(write_queue, done_queue, stop), daemon=True),
+    ]
+    for thread in threads:
+        thread.start()
+    try:
+        while True:
+            item = done_queue.get()
+            if item is END_OF_QUEUE:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item.name, item.input_path, item.output_path, item.error, item.stats
+    finally:
+        # Also reached when the consumer stops early; let every stage wind down
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+def convert_directory(directory, options):
+    """Convert every BMP file in directory into its output folder, yielding ConversionEvents
+
+    Files are converted as the scan finds them, so the 'start' event does not know the
+    total yet; each event's total is the number of files discovered so far and the
+    'done' event carries the final count. With options.dedupe, files whose contents
+    were already converted (in this run or an earlier one) get a hardlink or copy of
+    that PNG instead; their 'file' event stats carry 'duplicate_of'. With options.atlas
+    the images are packed into atlas pages instead (see atlas.convert_to_atlas).
+    """
+    if options.atlas:
+        # Imported here because the atlas module builds on this one
+        from atlas import convert_to_atlas
+        yield from convert_to_atlas(directory, options)
+        return
+
+    output_dir = os.path.join(directory, options.output_folder)
+    os.makedirs(output_dir, exist_ok=True)
+    yield ConversionEvent('start')
+
+    manifest = Manifest.load(output_dir) if options.incremental else None
+    settings = options.output_settings()
+    hashes = HashStore.load(output_dir, settings) if options.dedupe else None
+    report = None
+    if options.run_report:
+        # Reports sit next to the output folder so they never get mixed up with the PNGs
+        report_base = output_dir.rstrip(os.sep) + "_report"
+        report = RunReport(report_base + ".jsonl", report_base + ".json", settings)
+    profile_dir = output_dir.rstrip(os.sep) + "_profiles"
+    scan_seconds = {}
+    counts = {'total': 0, 'processed': 0, 'failed': 0, 'skipped': 0}
+    ready = deque()
+    totals = {'input_bytes': 0, 'output_bytes': 0, 'encode_seconds': 0.0}
+    pending = {}
+    # Content hash of every file being converted, and duplicates waiting for it to finish
+    converting = {}
+    waiting = {}
+    dedupe_lock = threading.Lock()
+
+    def event(kind, **fields):
+        return ConversionEvent(kind, total=counts['total'], processed=counts['processed'],
+                               failed=counts['failed'], skipped=counts['skipped'], **fields)
+
+    def find_duplicate(name, input_path, output_path, content_hash, file_size, started):
+        """Queue name as a duplicate if its contents were or are being converted, returning True if so"""
+        with dedupe_lock:
+            source = hashes.lookup(content_hash)
+            if source is not None and source != name:
+                if hashes.holds(source, output_path_for(output_dir, source)):
+                    ready.append(('duplicate', name, input_path, output_path, file_size, source, started))
+                    return True
+                hashes.forget(content_hash)
+            if content_hash in converting.values():
+                waiting.setdefault(content_hash, []).append((name, input_path, output_path, file_size, started))
+                return True
+            converting[name] = content_hash
+            return False
+
+    def materialize(name, input_path, output_path, file_size, source, started):
+        """Give a duplicate the PNG already converted for source and build its event"""
+        timer = StageTimer()
+        timer.add('scan', time.perf_counter() - started)
+        try:
+            with timer.stage('write'):
+                link_or_copy(output_path_for(output_dir, source), output_path)
+            stats = file_stats(file_size, os.path.getsize(output_path), timer)
+            stats['duplicate_of'] = source
+        except OSError as e:
+            return finish(name, input_path, output_path, e, None)
+        return finish(name, input_path, output_path, None, stats)
+
+    def finish(name, input_path, output_path, error, stats):
+        """Count, record and report one finished file, returning its 'file' event"""
+        if error is None:
+            counts['processed'] += 1
+            for key in totals:
+                totals[key] += stats[key]
+            if index is not None:
+                stats['pixels'] = index.pixels(name)
+            if name in pending:
+                content_hash, stat = pending.pop(name)
+                try:
+                    manifest.record(name, input_path, settings, content_hash, stat)
+                except OSError:
+                    # The source vanished after converting; it will simply be redone next run
+                    pass
+        else:
+            counts['failed'] += 1
+            pending.pop(name, None)
+        if report is not None:
+            status = 'failed' if error is not None else 'deduplicated' if 'duplicate_of' in stats else 'converted'
+            report.add(name, status, stats, error)
+        return event('file', name=name, input_path=input_path, output_path=output_path,
+                     error=error, stats=stats)
+
+    def flush_ready():
+        while ready:
+            kind, *fields = ready.popleft()
+            if kind == 'skip':
+                skip_event = fields[0]
+                if report is not None:
+                    report.add(skip_event.name, 'skipped', skip_event.stats)
+                yield skip_event
+            elif kind == 'rejected':
+                yield finish(*fields, None)
+            else:
+                yield materialize(*fields)
+
+    def candidates():
+        """Yield (entry, stat, content_hash, output_path, profile_path, scan_time) for every
+        file the manifest does not skip; stat is None if the file could not be stat'ed"""
+        # With the pipeline enabled this runs on the reader thread, so it only queues
+        # skips and duplicates in ready and leaves counting and reporting to the consumer
+        entries = scan_bmp_files(directory, options.recursive, exclude=(output_dir,))
+        while True:
+            # Time spent listing and stat'ing (plus the manifest check) is the file's 'scan' stage
+            started = time.perf_counter()
+            entry = next(entries, None)
+            if entry is None:
+                break
+            counts['total'] += 1
+            output_path = output_path_for(output_dir, entry.name)
+            profile_path = None
+            if should_profile(entry.name, options.profile_sample_rate):
+                profile_path = os.path.join(profile_dir, entry.name)
+            try:
+                stat = entry.stat
+            except OSError:
+                yield entry, None, None, output_path, profile_path, 0.0
+                continue
+            content_hash = None
+            if manifest is not None:
+                try:
+                    up_to_date, content_hash = manifest.check(entry.name, entry.path, output_path, settings, stat)
+                except OSError:
+                    up_to_date, content_hash = False, None
+                if up_to_date:
+                    counts['skipped'] += 1
+                    if hashes is not None:
+                        with dedupe_lock:
+                            hashes.record(manifest.entries[entry.name]['sha256'], entry.name, output_path)
+                    ready.append(('skip', event('skip', name=entry.name, input_path=entry.path,
+                                                output_path=output_path,
+                                                stats={'stages': {'scan': time.perf_counter() - started}})))
+                    continue
+            yield entry, stat, content_hash, output_path, profile_path, time.perf_counter() - started
+
+    def jobs(found):
+        for entry, stat, content_hash, output_path, profile_path, scan_time, info in found:
+            if stat is None:
+                # Let convert_file produce its usual error report
+                yield entry.name, entry.path, output_path, None, profile_path, None
+                continue
+            # Carry on the clock from where the scan of this file left off
+            started = time.perf_counter() - scan_time
+            if hashes is not None and stat.st_size:
+                try:
+                    content_hash = content_hash or hash_file(entry.path)
+                except OSError:
+                    pass
+                else:
+                    if find_duplicate(entry.name, entry.path, output_path, content_hash, stat.st_size, started):
+                        if manifest is not None:
+                            pending[entry.name] = (content_hash, stat)
+                        continue
+            if manifest is not None:
+                pending[entry.name] = (content_hash, stat)
+            scan_seconds[entry.name] = time.perf_counter() - started
+            yield entry.name, entry.path, output_path, stat.st_size, profile_path, info
+
+    index = None
+    if options.prescan:
+        # Read every header before converting anything: broken files fail straight away,
+        # the pixel total is known for progress, and the biggest images go first so the
+        # workers finish together instead of one grinding through a late giant alone
+        index = HeaderIndex()
+        found = []
+        for entry, stat, content_hash, output_path, profile_path, scan_time in candidates():
+            if stat is not None:
+                started = time.perf_counter()
+                info = index.add(entry.name, entry.path, stat.st_size)
+                scan_time += time.perf_counter() - started
+                if info is None:
+                    ready.append(('rejected', entry.name, entry.path, output_path,
+                                  IOError(index.rejected[entry.name])))
+                    continue
+                found.append((entry, stat, content_hash, output_path, profile_path, scan_time, info))
+            else:
+                found.append((entry, stat, content_hash, output_path, profile_path, scan_time, None))
+        found.sort(key=lambda item: index.pixels(item[0].name), reverse=True)
+        yield from flush_ready()
+        yield event('indexed', stats={'files': len(found), 'pixels': index.total_pixels})
+    else:
+        found = (candidate + (None,) for candidate in candidates())
+
+    if options.pipeline:
+        results = convert_pipelined(jobs(found), options)
+    elif resolve_workers(options.workers) > 1:
+        results = convert_parallel(jobs(found), options)
+    else:
+        results = convert_serial(jobs(found), options)
+
+    try:
+        for name, input_path, output_path, error, stats in results:
+            yield from flush_ready()
+            scan_time = scan_seconds.pop(name, None)
+            if error is None and scan_time is not None:
+                stats['stages']['scan'] = scan_time
+            duplicates = ()
+            if hashes is not None:
+                with dedupe_lock:
+                    content_hash = converting.pop(name, None)
+                    if content_hash is not None:
+                        duplicates = waiting.pop(content_hash, ())
+                        if error is None:
+                            hashes.record(content_hash, name, output_path)
+            yield finish(name, input_path, output_path, error, stats)
+            for duplicate, dup_input, dup_output, file_size, started in duplicates:
+                if error is None:
+                    yield materialize(duplicate, dup_input, dup_output, file_size, name, started)
+                else:
+                    # Same bytes, same failure
+                    yield finish(duplicate, dup_input, dup_output, error, None)
+        yield from flush_ready()
+    finally:
+        # Reached early when the consumer cancels; stop the workers before saving what finished
+        results.close()
+        if manifest is not None:
+            manifest.save()
+        if hashes is not None:
+            hashes.save()
+        if report is not None:
+            report.close()
+
+    yield event('done', stats=totals)
+
+def describe_stats(stats, profile):
+    """One-line summary of a run's totals for the console"""
+    megabyte = 1024 * 1024
+    saved = stats['input_bytes'] - stats['output_bytes']
+    return (f"Encoder profile '{profile}': wrote {stats['output_bytes'] / megabyte:.1f} MB of PNG "
+            f"from {stats['input_bytes'] / megabyte:.1f} MB of BMP (saved {saved / megabyte:.1f} MB), "
+            f"{stats['encode_seconds']:.2f} s encoding")
+
+def print_file_error(bmp_file, input_path, error):
+    """Print the detailed console report for a file that failed to convert"""
+    print(f"\nError processing file {bmp_file}:")
+    print(f"Input path: {input_path}")
+    print(f"Error details: {str(error)}")
+    print("File status:")
+    print(f"- File exists: {os.path.exists(input_path)}")
+    try:
+        size = os.path.getsize(input_path)
+        print(f"- File size: {size} bytes")
+        if size == 0:
+            print("  → This file is empty and cannot be processed")
+        elif size < 54:  # Minimum size for a valid BMP header
+            print("  → File is too small to be a valid BMP")
+    except:
+        print("- Could not get file size")
+    print("Continuing with next file...\n")
@@ -0,0 +1,97 @@
+"""
+Duplicate input detection stored inside the output folder
+Maps the SHA-256 of each converted BMP to the PNG made from it, so identical inputs are only converted once
+"""
+import json
+import os
+import shutil
+
+HASH_STORE_NAME = ".bmp2png_hashes.json"
+HASH_STORE_VERSION = 2
+
+def link_or_copy(source, destination):
+    """Make destination a hardlink to source, copying instead where links are not supported"""
+    folder = os.path.dirname(destination)
+    if folder:
+        os.makedirs(folder, exist_ok=True)
+    if os.path.lexists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        # Different drive, FAT volumes, or links not permitted
+        shutil.copyfile(source, destination)
+
+class HashStore:
+    """Content hash -> name of the file whose PNG holds the converted result
+
+    Only valid for one set of output settings; a store written with different
+    settings is discarded on load. The size and mtime of each PNG are kept too, so
+    a PNG rewritten or replaced since it was recorded is not handed out as a copy.
+    """
+    def __init__(self, output_dir, settings, entries=None, outputs=None):
+        self.path = os.path.join(output_dir, HASH_STORE_NAME)
+        self.settings = settings
+        self.entries = entries or {}
+        self.outputs = outputs or {}
+        self.names = {name: content_hash for content_hash, name in self.entries.items()}
+
+    @classmethod
+    def load(cls, output_dir, settings):
+        """Read the store from output_dir, starting empty if it is missing, unreadable or stale"""
+        path = os.path.join(output_dir, HASH_STORE_NAME)
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+            if data.get('version') == HASH_STORE_VERSION and data.get('settings') == settings:
+                return cls(output_dir, settings, data.get('hashes', {}), data.get('outputs', {}))
+        except (OSError, ValueError, AttributeError):
+            pass
+        return cls(output_dir, settings)
+
+    def save(self):
+        """Write the store, replacing the previous one only once the new file is complete"""
+        temp_path = self.path + ".tmp"
+        with open(temp_path, 'w') as f:
+            json.dump({'version': HASH_STORE_VERSION, 'settings': self.settings, 'hashes': self.entries,
+                       'outputs': self.outputs}, f, indent=1, sort_keys=True)
+        os.replace(temp_path, self.path)
+
+    def lookup(self, content_hash):
+        """Name recorded for content_hash, or None"""
+        return self.entries.get(content_hash)
+
+    def holds(self, name, output_path):
+        """True if output_path is still the PNG that was recorded for name"""
+        try:
+            stat = os.stat(output_path)
+        except OSError:
+            return False
+        return self.outputs.get(name) == [stat.st_size, stat.st_mtime_ns]
+
+    def record(self, content_hash, name, output_path):
+        """Remember that output_path, the PNG for name, holds the conversion of content_hash"""
+        try:
+            stat = os.stat(output_path)
+        except OSError:
+            self.forget_name(name)
+            return
+        # name's PNG now holds this content, so it no longer stands for what it held before
+        previous = self.names.get(name)
+        if previous is not None and previous != content_hash and self.entries.get(previous) == name:
+            del self.entries[previous]
+        self.entries[content_hash] = name
+        self.names[name] = content_hash
+        self.outputs[name] = [stat.st_size, stat.st_mtime_ns]
+
+    def forget(self, content_hash):
+        name = self.entries.pop(content_hash, None)
+        if name is not None and self.names.get(name) == content_hash:
+            self.forget_name(name)
+
+    def forget_name(self, name):
+        """Drop whatever name's PNG was recorded as holding, e.g. after it was rewritten"""
+        content_hash = self.names.pop(name, None)
+        if content_hash is not None and self.entries.get(content_hash) == name:
+            del self.entries[content_hash]
+        self.outputs.pop(name, None)
@@ -0,0 +1,175 @@
+"""
+PNG encoder profiles
+Trades encoding speed against output size: 'fast', 'balanced' (Pillow's defaults) and 'smallest'
+"""
+import io
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+
+from keying import match_mask
+from png_writer import PngStreamWriter
+
+ENCODER_PROFILES = ('fast', 'balanced', 'smallest')
+DEFAULT_PROFILE = 'balanced'
+
+# Palette images up to this many pixels are also tried as RGBA; above it the one byte
+# per pixel of indexed data always outweighs the at most 1 KB of PLTE and tRNS
+PALETTE_FALLBACK_PIXELS = 64 * 1024
+
+# zlib level used by each profile when writing a streamed (strip by strip) PNG
+STREAM_COMPRESS_LEVELS = {
+    'fast': 1,
+    'balanced': 6,
+    'smallest': 9,
+}
+
+def check_profile(profile):
+    """Raise ValueError for an unknown profile name"""
+    if profile not in ENCODER_PROFILES:
+        raise ValueError(f"Unknown encoder profile '{profile}' (expected one of: {', '.join(ENCODER_PROFILES)})")
+    return profile
+
+def _unused_colors(used):
+    """Yield RGB values not in used, to stand in for colors that differ only in alpha"""
+    for value in range(1 << 24):
+        rgb = (value >> 16, (value >> 8) & 0xFF, value & 0xFF)
+        if rgb not in used:
+            yield rgb
+
+def to_indexed(img):
+    """Return an exact palette ('P') copy of an RGBA image, or None if that is not possible
+
+    Needs 256 colors or fewer. Alpha goes into the PNG tRNS chunk through the image's
+    'transparency' info, so keyed pixels and opaque pixels of the same RGB (such as
+    transparent and solid white) get separate palette entries.
+    """
+    colors = img.getcolors(256)
+    if colors is None:
+        return None
+
+    rgb_image = img.convert("RGB")
+    used = {(r, g, b) for _, (r, g, b, _) in colors}
+    spare = _unused_colors(used)
+    seen = set()
+    palette = []
+    lookup = []
+    alphas = bytearray()
+    for _, (r, g, b, a) in colors:
+        rgb = (r, g, b)
+        if rgb in seen:
+            # quantize() only sees RGB, so give this entry a stand-in color to match on
+            stand_in = next(spare)
+            rgb_image.paste(stand_in, mask=match_mask(img, (r, g, b, a)))
+            lookup.extend(stand_in)
+        else:
+            seen.add(rgb)
+            lookup.extend(rgb)
+        palette.extend(rgb)
+        alphas.append(a)
+
+    # Pad with copies of the first entry so no spare palette slot can be picked instead
+    palette_img = Image.new("P", (1, 1))
+    palette_img.putpalette(lookup + lookup[:3] * (256 - len(colors)))
+    indexed = rgb_image.quantize(palette=palette_img, dither=Image.Dither.NONE)
+    indexed.putpalette(palette)
+    transparency = bytes(alphas).rstrip(b'\xff')
+    if transparency:
+        indexed.info['transparency'] = transparency
+
+    # quantize() searches for the nearest color, so make sure every pixel round-trips exactly
+    if indexed.convert("RGBA").tobytes() != img.tobytes():
+        return None
+    return indexed
+
+def _encode_pillow(img, **params):
+    buffer = io.BytesIO()
+    img.save(buffer, "PNG", **params)
+    return buffer.getvalue()
+
+def _encode_stream(img, compress_level):
+    buffer = io.BytesIO()
+    writer = PngStreamWriter(buffer, img.width, img.height, compress_level)
+    writer.write_strip(img)
+    writer.close()
+    return buffer.getvalue()
+
+def _encode_indexed(img):
+    indexed = to_indexed(img)
+    if indexed is None:
+        return None
+    return _encode_pillow(indexed, compress_level=9)
+
+def compact_palette(img):
+    """Return a 'P' image with the same pixels whose palette only holds the entries in use
+
+    Partly transparent entries go first, so the tRNS chunk only needs to cover them,
+    and PLTE shrinks to the colors used, which also lets small palettes drop to 1, 2
+    or 4 bits per pixel.
+    """
+    palette = img.getpalette() or []
+    transparency = img.info.get('transparency')
+    if isinstance(transparency, int):
+        transparency = bytes(255 if index != transparency else 0 for index in range(transparency + 1))
+    transparency = bytes(transparency or b'')
+
+    def alpha(index):
+        return transparency[index] if index < len(transparency) else 255
+
+    order = sorted((index for _, index in img.getcolors(256)), key=lambda index: (alpha(index) == 255, index))
+    if order == list(range(len(palette) // 3)):
+        return img
+    lut = [0] * 256
+    for new_index, index in enumerate(order):
+        lut[index] = new_index
+    indices = Image.frombytes("L", img.size, img.tobytes()).point(lut)
+    compact = Image.frombytes("P", img.size, indices.tobytes())
+    compact.putpalette(bytes(palette[index * 3 + band] if index * 3 + band < len(palette) else 0
+                             for index in order for band in range(3)))
+    alphas = bytes(alpha(index) for index in order).rstrip(b'\xff')
+    if alphas:
+        compact.info['transparency'] = alphas
+    return compact
+
+def _encode_palette(img, profile):
+    """Encode a 'P' image as an indexed PNG, at 1, 2, 4 or 8 bits depending on its palette size
+
+    Small images are also encoded as RGBA, which wins when PLTE and tRNS would
+    outweigh the pixel data, and the smaller result is kept.
+    """
+    img = compact_palette(img)
+    if profile == 'fast':
+        data = _encode_pillow(img, compress_level=1)
+    elif profile == 'balanced':
+        data = _encode_pillow(img)
+    else:
+        data = min(_encode_pillow(img, compress_level=9), _encode_pillow(img, optimize=True), key=len)
+    if img.width * img.height <= PALETTE_FALLBACK_PIXELS:
+        data = min(data, encode_png(img.convert("RGBA"), profile), key=len)
+    return data
+
+def encode_png(img, profile=DEFAULT_PROFILE):
+    """Encode an RGBA or palette ('P') image as PNG bytes using the given profile
+
+    'fast' uses zlib level 1 with the fixed Up filter, 'balanced' is Pillow's default
+    encoder and 'smallest' encodes several candidates in parallel threads (including
+    an indexed PNG with tRNS when the image has 256 colors or fewer) and keeps the
+    smallest result. Palette images stay indexed, with their alpha in tRNS.
+    """
+    check_profile(profile)
+    if img.mode == "P":
+        return _encode_palette(img, profile)
+    if profile == 'fast':
+        return _encode_stream(img, 1)
+    if profile == 'balanced':
+        return _encode_pillow(img)
+
+    candidates = [
+        (_encode_pillow, (img,), {'compress_level': 9}),
+        (_encode_stream, (img, 9), {}),
+        (_encode_indexed, (img,), {}),
+    ]
+    # zlib and Pillow's encoder release the GIL, so the candidates really run side by side
+    with ThreadPoolExecutor(max_workers=len(candidates)) as executor:
+        futures = [executor.submit(function, *args, **kwargs) for function, args, kwargs in candidates]
+        results = [future.result() for future in futures]
+    return min((data for data in results if data is not None), key=len)
@@ -1,29 +1,10 @@
 import tkinter as tk
 from tkinter import ttk, colorchooser, NORMAL, DISABLED
-import json
-import os
-
-class Config:
-    def __init__(self):
-        config_path = os.path.join(os.path.dirname(__file__), 'config.json')
-        with open(config_path, 'r') as f:
-            self.config = json.load(f)
-    
-    def get(self, *keys, default=None):
-        value = self.config
-        for key in keys:
-            if isinstance(value, dict):
-                value = value.get(key, default)
-            else:
-                return default
-        return value
-    
-    def get_template(self, component_type):
-        return self.get('components', component_type, 'template', default={})
+from config import get_config
 
 class RoundedButton(tk.Canvas):
     def __init__(self, parent, text, command, **kwargs):
-        self.settings = Config()
+        self.settings = get_config()
         
         # Get button template
         template = self.settings.get_template('button')
@@ -123,7 +104,7 @@ class RoundedButton(tk.Canvas):
 
 class StyledLabel(tk.Label):
     def __init__(self, parent, text="", **kwargs):
-        config = Config()
+        config = get_config()
         template = config.get_template('label')
         
         super().__init__(
@@ -137,7 +118,7 @@ class StyledLabel(tk.Label):
 
 class StyledProgressBar(ttk.Progressbar):
     def __init__(self, parent, **kwargs):
-        config = Config()
+        config = get_config()
         template = config.get_template('progress_bar')
         
         style = ttk.Style()
@@ -162,7 +143,7 @@ class StyledProgressBar(ttk.Progressbar):
 
 class StyledEntry(tk.Entry):
     def __init__(self, parent, **kwargs):
-        config = Config()
+        config = get_config()
         template = config.get_template('entry')
         
         super().__init__(
@@ -182,7 +163,7 @@ class StyledEntry(tk.Entry):
 
 class StyledCombobox(ttk.Combobox):
     def __init__(self, parent, values, **kwargs):
-        config = Config()
+        config = get_config()
         template = config.get_template('dropdown')
         
         style = ttk.Style()
@@ -209,7 +190,7 @@ class StyledCombobox(ttk.Combobox):
 
 class ColorSelector(tk.Frame):
     def __init__(self, parent, initial_color='#000000', on_color_change=None, **kwargs):
-        config = Config()
+        config = get_config()
         template = config.get_template('color_selector')
         
         super().__init__(parent, bg=config.get('colors', 'background'), **kwargs)
@@ -0,0 +1,331 @@
+"""
+Color-key transparency for converted images
+Builds the alpha channel with Pillow band operations instead of a per-pixel Python loop
+"""
+import re
+from array import array
+from collections import namedtuple
+from functools import lru_cache
+from PIL import Image, ImageChops
+
+# Value written to every keyed pixel, matching the original getdata() loop
+KEYED_PIXEL = (255, 255, 255, 0)
+# A horizontal run of masked pixels in one row of an 'L' mask
+MASK_RUN = re.compile(b'\xff+')
+
+class KeyColor(namedtuple('KeyColor', 'rgb tolerance softness')):
+    """A color to make transparent
+
+    Pixels whose channels are all within tolerance of rgb become fully transparent.
+    With softness, alpha then ramps up linearly over the next softness steps, so
+    near-matches such as JPEG fringes fade out instead of leaving a hard edge.
+    """
+    __slots__ = ()
+
+    def __new__(cls, rgb, tolerance=0, softness=0):
+        if isinstance(rgb, str):
+            rgb = parse_hex_color(rgb)
+        if not 0 <= tolerance <= 255 or not 0 <= softness <= 255:
+            raise ValueError(f"Key tolerance and softness must be between 0 and 255 (got {tolerance}, {softness})")
+        return super().__new__(cls, tuple(rgb[:3]), int(tolerance), int(softness))
+
+    def describe(self):
+        """JSON-friendly form, as accepted by parse_key_colors"""
+        return {'color': '#%02X%02X%02X' % self.rgb, 'tolerance': self.tolerance, 'softness': self.softness}
+
+def parse_hex_color(color_hex):
+    """Convert a '#RRGGBB' string into an (r, g, b) tuple"""
+    color_hex = color_hex.lstrip('#')
+    return tuple(int(color_hex[i:i+2], 16) for i in (0, 2, 4))
+
+def parse_key_colors(entries):
+    """Build KeyColors from config entries: '#RRGGBB' strings, RGB tuples or dicts with
+    'color' and optional 'tolerance' and 'softness'"""
+    keys = []
+    for entry in entries:
+        if isinstance(entry, KeyColor):
+            keys.append(entry)
+        elif isinstance(entry, dict):
+            keys.append(KeyColor(entry['color'], entry.get('tolerance', 0), entry.get('softness', 0)))
+        else:
+            keys.append(KeyColor(entry))
+    return tuple(keys)
+
+def _as_keys(keys):
+    """Accept a single (r, g, b) color as well as a sequence of KeyColors"""
+    if len(keys) and isinstance(keys[0], int):
+        return (KeyColor(keys),)
+    return parse_key_colors(keys)
+
+def _match_table(value):
+    """256-entry lookup table that is 255 for one band value and 0 elsewhere"""
+    return [255 if i == value else 0 for i in range(256)]
+
+def _ramp(distance, tolerance, softness):
+    """Alpha for a pixel whose largest channel difference from the key is distance"""
+    if distance <= tolerance:
+        return 0
+    if distance > tolerance + softness:
+        return 255
+    return (distance - tolerance) * 255 // (softness + 1)
+
+@lru_cache(maxsize=256)
+def _channel_table(value, tolerance, softness):
+    """256-entry table giving the alpha one channel alone allows for a key channel value
+
+    The ramp only ever rises with distance, so the ramp of the largest channel
+    difference equals the largest per-channel ramp; that lets each channel be looked
+    up on its own and the results combined with a per-pixel maximum.
+    """
+    return [_ramp(abs(i - value), tolerance, softness) for i in range(256)]
+
+@lru_cache(maxsize=64)
+def _palette_alpha(palette, keys):
+    """256-entry table of alpha per palette index for an RGB palette given as bytes"""
+    table = []
+    for index in range(len(palette) // 3):
+        rgb = palette[index * 3:index * 3 + 3]
+        table.append(min(_ramp(max(abs(c - k) for c, k in zip(rgb, key.rgb)), key.tolerance, key.softness)
+                         for key in keys))
+    return table + [255] * (256 - len(table))
+
+def match_mask(img, color):
+    """Return an 'L' mask that is 255 where the pixel's first len(color) bands equal color"""
+    bands = img.split()
+    mask = bands[0].point(_match_table(color[0]))
+    for band, value in zip(bands[1:len(color)], color[1:]):
+        mask = ImageChops.multiply(mask, band.point(_match_table(value)))
+    return mask
+
+def key_mask(img, color_rgb):
+    """Return an 'L' mask that is 255 where the pixel's RGB equals color_rgb"""
+    return match_mask(img, color_rgb[:3])
+
+def _has_rgb_palette(img):
+    return img.mode == "P" and img.palette is not None and img.palette.mode == "RGB"
+
+def key_alpha(img, keys):
+    """Return the 'L' alpha the keys leave on each pixel of img (0 = fully keyed)
+
+    Palette images are looked up once per palette entry, so their cost per pixel does
+    not depend on the number of keys. Other images cost three table lookups per key.
+    """
+    keys = _as_keys(keys)
+    if _has_rgb_palette(img):
+        # Index the palette-level table with the raw palette indices
+        indices = Image.frombytes("L", img.size, img.tobytes())
+        return indices.point(_palette_alpha(bytes(img.getpalette()), keys))
+
+    bands = img.split()[:3]
+    alpha = None
+    for key in keys:
+        allowed = None
+        for band, value in zip(bands, key.rgb):
+            channel = band.point(_channel_table(value, key.tolerance, key.softness))
+            allowed = channel if allowed is None else ImageChops.lighter(allowed, channel)
+        alpha = allowed if alpha is None else ImageChops.darker(alpha, allowed)
+    return alpha
+
+class BorderRegions:
+    """Finds which parts of a mask are connected to the image border
+
+    The mask is fed top to bottom, whole or a strip at a time. Each row is split into
+    runs of masked pixels with a regex, and runs that overlap a run in the row above
+    are joined with union-find, so the work is linear in the number of runs and no
+    pixel is visited from Python. Pixels connect through their four neighbours.
+
+    Runs are numbered in the order they are found and only their union-find parents
+    are kept, in a 4-byte array, along with the first run number of each row. mask()
+    finds the runs of a row again in the same mask, so the state held between the
+    two passes of the strip path grows with the number of runs, never with copies
+    of the pixels.
+    """
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        # Label 0 stands for the border itself; every run touching an edge is joined to it
+        self.parent = array('I', [0])
+        self.row_starts = array('I')
+        self.above = ()
+        self.resolved = False
+
+    def _find(self, label):
+        parent = self.parent
+        while parent[label] != label:
+            parent[label] = parent[parent[label]]
+            label = parent[label]
+        return label
+
+    def _union(self, a, b):
+        a, b = self._find(a), self._find(b)
+        if a != b:
+            self.parent[max(a, b)] = min(a, b)
+
+    def _runs(self, data, y, first_label):
+        """(start, end, label) of every masked run in row y of data, numbered from first_label"""
+        width = self.width
+        offset = y * width
+        return [(match.start() - offset, match.end() - offset, label)
+                for label, match in enumerate(MASK_RUN.finditer(data, offset, offset + width), first_label)]
+
+    def add(self, mask):
+        """Add the next mask.height rows of an 'L' mask that is 255 where pixels are keyed"""
+        width = self.width
+        parent = self.parent
+        data = mask.tobytes()
+        for y in range(mask.height):
+            row_index = len(self.row_starts)
+            self.row_starts.append(len(parent))
+            runs = self._runs(data, y, len(parent))
+            edge_row = row_index == 0 or row_index == self.height - 1
+            for start, end, label in runs:
+                parent.append(label)
+                if edge_row or start == 0 or end == width:
+                    self._union(label, 0)
+
+            # Both run lists are sorted, so overlaps are found in a single merge pass
+            above = self.above
+            i = j = 0
+            while i < len(runs) and j < len(above):
+                start, end, label = runs[i]
+                above_start, above_end, above_label = above[j]
+                if start < above_end and above_start < end:
+                    self._union(label, above_label)
+                if end < above_end:
+                    i += 1
+                else:
+                    j += 1
+            self.above = runs
+
+    def _resolve(self):
+        """Point every label straight at its root; parents always have smaller labels,
+        so one pass in label order is enough"""
+        parent = self.parent
+        for label in range(len(parent)):
+            parent[label] = parent[parent[label]]
+        self.above = ()
+        self.resolved = True
+
+    def mask(self, mask, top=0):
+        """Narrow mask, the same rows that were added from top onwards, to the keyed
+        pixels that reach the border"""
+        if not self.resolved:
+            self._resolve()
+        parent = self.parent
+        width = self.width
+        full = b'\xff' * width
+        data = mask.tobytes()
+        out = bytearray(len(data))
+        for y in range(mask.height):
+            for start, end, label in self._runs(data, y, self.row_starts[top + y]):
+                if not parent[label]:
+                    out[y * width + start:y * width + end] = full[:end - start]
+        return Image.frombytes("L", mask.size, bytes(out))
+
+def _prepare(img, keys):
+    """Convert img to a mode the keying understands and return it with its key mask
+
+    The mask is 255 where keys touch the pixel at all. For soft keys the alpha they
+    leave is returned as well (None for hard keys, where the mask says everything).
+    """
+    if img.mode not in ("RGB", "RGBA") and not _has_rgb_palette(img):
+        img = img.convert("RGBA")
+    if len(keys) == 1 and not keys[0].tolerance and not keys[0].softness and img.mode != "P":
+        # The common single exact color only needs an equality mask
+        return img, key_mask(img, keys[0].rgb), None
+    alpha = key_alpha(img, keys)
+    if any(key.softness for key in keys):
+        return img, alpha.point([255] * 255 + [0]), alpha
+    return img, alpha.point(_match_table(0)), None
+
+def as_palette_image(img):
+    """Return img as an RGB-palette 'P' image with the same pixels, or None for truecolor images
+
+    Grayscale ('L') and bilevel ('1') images, which is how Pillow opens BMPs with a gray
+    palette, get back an equivalent gray palette.
+    """
+    if _has_rgb_palette(img):
+        return img
+    if img.mode == "1":
+        indexed = Image.frombytes("P", img.size, img.convert("L").point([0] * 255 + [1]).tobytes())
+        indexed.putpalette(b'\x00\x00\x00\xff\xff\xff')
+        return indexed
+    if img.mode == "L":
+        indexed = Image.frombytes("P", img.size, img.tobytes())
+        indexed.putpalette(bytes(value for value in range(256) for _ in range(3)))
+        return indexed
+    return None
+
+def key_palette(img, keys):
+    """Key an indexed image through its palette, returning a 'P' image or None if img is truecolor
+
+    Only the palette changes: matched entries get their alpha in the image's
+    'transparency' info, which PNG stores as a tRNS chunk, so the cost depends on
+    the palette size rather than the pixel count. Decoded to RGBA the result is
+    identical to apply_color_key's, including keyed pixels turning white.
+    """
+    indexed = as_palette_image(img)
+    if indexed is None:
+        return None
+    keys = _as_keys(keys)
+    palette = bytearray(indexed.getpalette())
+    count = len(palette) // 3
+    keyed = _palette_alpha(bytes(palette), keys)[:count]
+
+    alpha = list(keyed)
+    existing = indexed.info.get('transparency')
+    if isinstance(existing, int):
+        existing = bytes(255 if index != existing else 0 for index in range(count))
+    if existing is not None:
+        # Keep whatever transparency the source already had
+        alpha = [min(a, b) for a, b in zip(alpha, bytes(existing) + b'\xff' * count)]
+
+    # Only entries the keys themselves took to 0 turn white, as in apply_color_key;
+    # entries that were already transparent keep their color
+    for index, value in enumerate(keyed):
+        if value == 0:
+            palette[index * 3:index * 3 + 3] = bytes(KEYED_PIXEL[:3])
+
+    indexed = indexed.copy()
+    indexed.putpalette(bytes(palette))
+    transparency = bytes(alpha).rstrip(b'\xff')
+    indexed.info.pop('transparency', None)
+    if transparency:
+        indexed.info['transparency'] = transparency
+    return indexed
+
+def key_region(img, keys):
+    """'L' mask that is 255 wherever keys would change the pixel"""
+    return _prepare(img, _as_keys(keys))[1]
+
+def apply_color_key(img, keys, background_only=False, regions=None, top=0):
+    """Make every pixel matching keys transparent, returning an RGBA image
+
+    keys is a sequence of KeyColors or a single (r, g, b) color to match exactly.
+    With background_only, only keyed areas connected to the image border are made
+    transparent, so key-colored details inside a sprite survive. When img is a strip
+    of a larger image, pass the BorderRegions built over the whole image and the
+    strip's first row as top.
+    """
+    img, mask, alpha = _prepare(img, _as_keys(keys))
+    if background_only:
+        if regions is None:
+            regions = BorderRegions(img.width, img.height)
+            regions.add(mask)
+        mask = regions.mask(mask, top)
+        if alpha is not None:
+            # Pixels cut off from the border keep their original alpha
+            alpha = ImageChops.lighter(alpha, ImageChops.invert(mask))
+
+    if alpha is not None:
+        img = img.convert("RGBA") if img.mode != "RGBA" else img.copy()
+        # Keep whatever transparency the source already had
+        img.putalpha(ImageChops.darker(img.getchannel("A"), alpha))
+        mask = alpha.point(_match_table(0))
+
+    if img.mode != "RGBA" or img.readonly:
+        # Read-only images are views of a memory-mapped file and must not be written to
+        img = img.convert("RGBA")
+    # The mask only holds 0 or 255, so paste replaces keyed pixels exactly
+    img.paste(KEYED_PIXEL, mask=mask)
+    return img
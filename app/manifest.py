@@ -0,0 +1,125 @@
+"""
+Incremental conversion manifest stored inside the output folder
+Records what each PNG was built from so unchanged inputs can be skipped on the next run
+"""
+import hashlib
+import json
+import os
+import threading
+
+MANIFEST_NAME = ".bmp2png_manifest.json"
+MANIFEST_VERSION = 1
+# Append-only log of files finished since the manifest was last saved
+JOURNAL_NAME = ".bmp2png_journal.jsonl"
+
+def hash_file(path, chunk_size=1024 * 1024):
+    """Return the SHA-256 hex digest of a file's contents"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def read_journal(path):
+    """Yield (name, entry) for every complete line of a journal, stopping at a torn last line"""
+    try:
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    name, entry = json.loads(line)
+                except ValueError:
+                    # The process died while writing this line
+                    return
+                yield name, entry
+    except OSError:
+        return
+
+class Manifest:
+    """What each PNG in an output folder was converted from
+
+    The full manifest is only rewritten by save(). Every record() in between is also
+    appended to a journal file straight away, so a run that is killed part way keeps
+    the files it finished and the next run skips them on the cheap stat check.
+    """
+    def __init__(self, output_dir, entries=None):
+        self.path = os.path.join(output_dir, MANIFEST_NAME)
+        self.journal_path = os.path.join(output_dir, JOURNAL_NAME)
+        self.entries = entries or {}
+        self.journal = None
+        self.journal_lock = threading.Lock()
+
+    @classmethod
+    def load(cls, output_dir):
+        """Read the manifest from output_dir plus anything journaled since it was saved,
+        starting empty if it is missing or unreadable"""
+        path = os.path.join(output_dir, MANIFEST_NAME)
+        manifest = cls(output_dir)
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+            if data.get('version') == MANIFEST_VERSION:
+                manifest.entries = data.get('files', {})
+        except (OSError, ValueError, AttributeError):
+            pass
+        for name, entry in read_journal(manifest.journal_path):
+            manifest.entries[name] = entry
+        return manifest
+
+    def save(self):
+        """Write the manifest, replacing the previous one only once the new file is complete
+
+        The journal is folded into it and removed afterwards; if that is interrupted,
+        replaying the journal on load gives the same entries again.
+        """
+        temp_path = self.path + ".tmp"
+        with open(temp_path, 'w') as f:
+            json.dump({'version': MANIFEST_VERSION, 'files': self.entries}, f, indent=1, sort_keys=True)
+        os.replace(temp_path, self.path)
+        with self.journal_lock:
+            if self.journal is not None:
+                self.journal.close()
+                self.journal = None
+            if os.path.exists(self.journal_path):
+                os.remove(self.journal_path)
+
+    def _append(self, name, entry):
+        with self.journal_lock:
+            if self.journal is None:
+                self.journal = open(self.journal_path, 'a')
+            self.journal.write(json.dumps([name, entry], sort_keys=True) + "\n")
+            # Hand the line to the OS now so it survives the process being killed
+            self.journal.flush()
+
+    def check(self, name, input_path, output_path, settings, stat=None):
+        """Decide whether a file needs converting
+
+        Returns (up_to_date, content_hash). The hash is only computed when the size or
+        mtime changed, and is None when the cheap stat comparison already settled it.
+        """
+        stat = stat or os.stat(input_path)
+        entry = self.entries.get(name)
+        if entry is None or entry.get('settings') != settings or not os.path.exists(output_path):
+            return False, None
+        if entry.get('size') == stat.st_size and entry.get('mtime_ns') == stat.st_mtime_ns:
+            return True, None
+
+        # Touched but possibly identical, e.g. re-exported or copied files
+        if entry.get('size') != stat.st_size:
+            return False, None
+        content_hash = hash_file(input_path)
+        if content_hash != entry.get('sha256'):
+            return False, content_hash
+        self.record(name, input_path, settings, content_hash, stat)
+        return True, content_hash
+
+    def record(self, name, input_path, settings, content_hash=None, stat=None):
+        """Remember that name was converted from its current contents with settings"""
+        stat = stat or os.stat(input_path)
+        entry = {
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'sha256': content_hash or hash_file(input_path),
+            'settings': settings,
+        }
+        self.entries[name] = entry
+        self._append(name, entry)
@@ -0,0 +1,82 @@
+"""
+Incremental PNG encoder
+Writes an RGBA PNG one strip of rows at a time so the whole image never has to be in memory
+"""
+import struct
+import zlib
+from PIL import Image, ImageChops
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+COLOR_TYPE_RGBA = 6
+FILTER_UP = b'\x02'
+# Flush compressed data to the file once this much has built up
+IDAT_CHUNK_SIZE = 1024 * 1024
+
+def write_chunk(fp, chunk_type, data):
+    """Write one length-prefixed, CRC-terminated PNG chunk"""
+    fp.write(struct.pack(">I", len(data)))
+    fp.write(chunk_type)
+    fp.write(data)
+    fp.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(chunk_type)) & 0xFFFFFFFF))
+
+class PngStreamWriter:
+    """Write an RGBA image to fp as a sequence of strips
+
+    Rows use the PNG 'Up' filter, computed per strip with ImageChops so no Python
+    code runs per pixel. The last row of each strip is kept so filtering carries on
+    correctly into the next one.
+    """
+    def __init__(self, fp, width, height, compress_level=6):
+        self.fp = fp
+        self.width = width
+        self.height = height
+        self.rows_written = 0
+        self.previous_row = Image.new("RGBA", (width, 1), (0, 0, 0, 0))
+        self.compressor = zlib.compressobj(compress_level)
+        self.pending = []
+        self.pending_size = 0
+
+        fp.write(PNG_SIGNATURE)
+        write_chunk(fp, b'IHDR', struct.pack(">IIBBBBB", width, height, 8, COLOR_TYPE_RGBA, 0, 0, 0))
+
+    def write_strip(self, strip):
+        """Append an RGBA strip of the image's full width below the rows written so far"""
+        if strip.mode != "RGBA":
+            strip = strip.convert("RGBA")
+        width, rows = strip.size
+        if width != self.width or self.rows_written + rows > self.height:
+            raise ValueError("Strip does not fit the PNG being written")
+
+        # Row above each row of the strip, for the Up filter
+        above = Image.new("RGBA", (width, rows))
+        above.paste(self.previous_row, (0, 0))
+        if rows > 1:
+            above.paste(strip.crop((0, 0, width, rows - 1)), (0, 1))
+        filtered = ImageChops.subtract_modulo(strip, above).tobytes()
+        self.previous_row = strip.crop((0, rows - 1, width, rows))
+
+        stride = width * 4
+        scanlines = b''.join(FILTER_UP + filtered[i:i + stride] for i in range(0, len(filtered), stride))
+        self._add(self.compressor.compress(scanlines))
+        self.rows_written += rows
+
+    def close(self):
+        """Flush the remaining compressed data and finish the file"""
+        if self.rows_written != self.height:
+            raise ValueError(f"PNG expects {self.height} rows but {self.rows_written} were written")
+        self._add(self.compressor.flush())
+        self._flush_idat()
+        write_chunk(self.fp, b'IEND', b'')
+
+    def _add(self, data):
+        if data:
+            self.pending.append(data)
+            self.pending_size += len(data)
+            if self.pending_size >= IDAT_CHUNK_SIZE:
+                self._flush_idat()
+
+    def _flush_idat(self):
+        if self.pending:
+            write_chunk(self.fp, b'IDAT', b''.join(self.pending))
+            self.pending = []
+            self.pending_size = 0
@@ -0,0 +1,79 @@
+"""
+Progress tracking for long conversion runs
+The conversion thread records events here and the GUI reads a snapshot at its own pace
+"""
+import threading
+import time
+
+class ProgressTracker:
+    """Thread-safe run counters with throughput and ETA"""
+    def __init__(self, total=0):
+        self._lock = threading.Lock()
+        self.started = time.monotonic()
+        self.total = total
+        self.processed = 0
+        self.failed = 0
+        self.skipped = 0
+        self.input_bytes = 0
+        # Only known when the run pre-scans headers
+        self.total_pixels = 0
+        self.pixels_done = 0
+
+    def update(self, event):
+        """Record a ConversionEvent; called from the conversion thread"""
+        with self._lock:
+            if event.kind == 'start':
+                return
+            # The scan may find more files than were counted up front
+            self.total = max(self.total, event.total)
+            self.processed = event.processed
+            self.failed = event.failed
+            self.skipped = event.skipped
+            if event.kind == 'indexed':
+                self.total_pixels = event.stats['pixels']
+            if event.kind == 'file' and event.stats:
+                self.input_bytes += event.stats.get('input_bytes') or 0
+                self.pixels_done += event.stats.get('pixels') or 0
+
+    def snapshot(self):
+        """Consistent copy of the counters plus files/s, MB/s and the estimated seconds left
+
+        With a pixel total from a header pre-scan the estimate goes by pixels converted,
+        which holds up far better than file counts when image sizes vary.
+        """
+        with self._lock:
+            elapsed = max(time.monotonic() - self.started, 1e-6)
+            done = self.processed + self.failed + self.skipped
+            files_per_second = done / elapsed
+            remaining = max(self.total - done, 0)
+            eta_seconds = remaining / files_per_second if done else None
+            if self.total_pixels and self.pixels_done:
+                eta_seconds = max(self.total_pixels - self.pixels_done, 0) / (self.pixels_done / elapsed)
+            return {
+                'total': self.total,
+                'processed': self.processed,
+                'failed': self.failed,
+                'skipped': self.skipped,
+                'done': done,
+                'files_per_second': files_per_second,
+                'mb_per_second': self.input_bytes / elapsed / (1024 * 1024),
+                'megapixels': self.total_pixels / 1e6,
+                'megapixels_done': self.pixels_done / 1e6,
+                'eta_seconds': eta_seconds,
+            }
+
+def format_duration(seconds):
+    """Format seconds as M:SS, or H:MM:SS for long runs"""
+    seconds = int(round(seconds))
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    if hours:
+        return f"{hours}:{minutes:02d}:{seconds:02d}"
+    return f"{minutes}:{seconds:02d}"
+
+def describe_progress(snapshot):
+    """Short one-line progress text for the GUI"""
+    text = f"{snapshot['done']}/{snapshot['total']} · {snapshot['files_per_second']:.1f} files/s · {snapshot['mb_per_second']:.1f} MB/s"
+    if snapshot['eta_seconds'] is not None:
+        text += f" · ETA {format_duration(snapshot['eta_seconds'])}"
+    return text
@@ -0,0 +1,94 @@
+"""
+Streaming BMP directory scanner
+Walks folders with os.scandir and yields files as they are found, so work can start before the listing ends
+"""
+import os
+
+from bmp_reader import read_bmp_info
+
+class ScanEntry:
+    """A BMP file found by scan_bmp_files
+
+    name is the path relative to the scanned folder using '/' separators, which is
+    also used to mirror the file's location under the output folder.
+    """
+    def __init__(self, name, path, dir_entry):
+        self.name = name
+        self.path = path
+        self._dir_entry = dir_entry
+
+    @property
+    def stat(self):
+        # DirEntry caches the result, and on Windows it comes free with the listing
+        return self._dir_entry.stat()
+
+    @property
+    def size(self):
+        return self.stat.st_size
+
+def scan_bmp_files(directory, recursive=False, exclude=()):
+    """Yield a ScanEntry for every BMP file in directory
+
+    Sub-folders are visited when recursive is set, skipping any folder listed in exclude
+    (normally the output folder). Unreadable sub-folders are skipped, but an unreadable
+    top-level directory raises so callers can report it.
+    """
+    excluded = {os.path.normcase(os.path.abspath(path)) for path in exclude}
+    pending = [(directory, "")]
+    while pending:
+        folder, prefix = pending.pop()
+        try:
+            iterator = os.scandir(folder)
+        except OSError:
+            if folder is directory:
+                raise
+            continue
+
+        subfolders = []
+        with iterator:
+            for entry in iterator:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if recursive and os.path.normcase(os.path.abspath(entry.path)) not in excluded:
+                            subfolders.append((entry.path, prefix + entry.name + "/"))
+                    elif entry.name.lower().endswith('.bmp') and entry.is_file():
+                        yield ScanEntry(prefix + entry.name, os.path.normpath(entry.path), entry)
+                except OSError:
+                    # Broken links or files removed mid-scan
+                    continue
+
+        # Visit sub-folders in listing order once this folder is done
+        pending.extend(reversed(subfolders))
+
+def count_bmp_files(directory, recursive=False, exclude=()):
+    """Return how many BMP files scan_bmp_files would yield"""
+    return sum(1 for _ in scan_bmp_files(directory, recursive, exclude))
+
+class HeaderIndex:
+    """Parsed headers of the files a run is about to convert, keyed by name
+
+    Built with one small read per file before any decoding starts; files whose
+    headers are unusable are kept in rejected with the reason instead.
+    """
+    def __init__(self):
+        self.infos = {}
+        self.rejected = {}
+        self.total_pixels = 0
+
+    def add(self, name, path, file_size):
+        """Read and check one file's headers, returning its BmpInfo or None if rejected"""
+        if file_size == 0:
+            self.rejected[name] = "File is empty (0 bytes)"
+            return None
+        try:
+            info = read_bmp_info(path, file_size)
+        except Exception as e:
+            self.rejected[name] = f"Cannot read file: {str(e)}"
+            return None
+        self.infos[name] = info
+        self.total_pixels += info.width * info.height
+        return info
+
+    def pixels(self, name):
+        info = self.infos.get(name)
+        return info.width * info.height if info is not None else 0
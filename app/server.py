@@ -0,0 +1,358 @@
+"""
+HTTP conversion service
+Accepts BMP bytes over HTTP, converts them on a process pool with the same keying as the desktop tool and sends back PNG bytes
+"""
+import asyncio
+import email.parser
+import email.policy
+import json
+import multiprocessing
+import time
+import uuid
+from bisect import bisect_left
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from urllib.parse import parse_qs, urlsplit
+
+from archive import convert_member
+from converter import MEGABYTE, ConversionOptions, MemoryBudget, resolve_workers, whole_image_memory
+from encoder import ENCODER_PROFILES
+from keying import KeyColor
+from telemetry import percentile
+
+# Upper bounds of the latency histogram buckets, in milliseconds
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+# Latencies kept for the percentile figures
+LATENCY_WINDOW = 1000
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+           411: 'Length Required', 413: 'Payload Too Large', 422: 'Unprocessable Entity',
+           503: 'Service Unavailable'}
+
+class HttpError(Exception):
+    def __init__(self, status, message, headers=None):
+        super().__init__(message)
+        self.status = status
+        self.headers = headers or {}
+
+class LatencyHistogram:
+    """Request latencies in fixed buckets plus p50/p95/p99 over the most recent requests"""
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.total_seconds = 0.0
+        self.recent = deque(maxlen=LATENCY_WINDOW)
+
+    def observe(self, seconds):
+        self.counts[bisect_left(LATENCY_BUCKETS_MS, seconds * 1000)] += 1
+        self.total_seconds += seconds
+        self.recent.append(seconds)
+
+    def describe(self):
+        labels = [f"<={bound}ms" for bound in LATENCY_BUCKETS_MS] + ["+Inf"]
+        recent = sorted(self.recent)
+        return {
+            'count': sum(self.counts),
+            'sum_seconds': round(self.total_seconds, 6),
+            'buckets': dict(zip(labels, self.counts)),
+            'p50_ms': round(percentile(recent, 50) * 1000, 2) if recent else None,
+            'p95_ms': round(percentile(recent, 95) * 1000, 2) if recent else None,
+            'p99_ms': round(percentile(recent, 99) * 1000, 2) if recent else None,
+        }
+
+def parse_key(value):
+    """Parse a 'RRGGBB[:tolerance[:softness]]' query value into a KeyColor"""
+    color, *numbers = value.split(':')
+    return KeyColor('#' + color.lstrip('#'), *(int(number) for number in numbers))
+
+def request_options(base, query):
+    """ConversionOptions for one request: base, with the keying and profile overridden from the query
+
+    color=RRGGBB sets the single exact key, key=RRGGBB:tolerance:softness (repeatable)
+    sets a key list, background_only=1 keys only border-connected areas and
+    profile=fast|balanced|smallest picks the encoder profile.
+    """
+    try:
+        color = query.get('color', [None])[0]
+        keys = [parse_key(value) for value in query.get('key', [])]
+        profile = query.get('profile', [base.encoder_profile])[0]
+        if profile not in ENCODER_PROFILES:
+            raise ValueError(f"Unknown encoder profile '{profile}'")
+        background_only = base.background_only
+        if 'background_only' in query:
+            background_only = query['background_only'][0].lower() in ('1', 'true', 'yes')
+        return ConversionOptions(
+            transparent_color='#' + color.lstrip('#') if color else base.transparent_color,
+            key_colors=keys or (None if color else base.key_colors),
+            background_only=background_only,
+            keep_palette=base.keep_palette,
+            encoder_profile=profile,
+            strip_budget_mb=base.strip_budget_mb,
+            max_memory_mb=base.max_memory_mb,
+        )
+    except (ValueError, TypeError, IndexError) as e:
+        raise HttpError(400, f"Bad conversion options: {e}")
+
+def split_multipart(content_type, body):
+    """Return (filename, data) for every part of a multipart/form-data or multipart/mixed body"""
+    message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+        b'Content-Type: ' + content_type.encode('latin-1') + b'\r\n\r\n' + body)
+    if not message.is_multipart():
+        raise HttpError(400, "Malformed multipart body")
+    return [(part.get_filename() or f"image{index}.bmp", part.get_payload(decode=True) or b'')
+            for index, part in enumerate(message.iter_parts())]
+
+class ConversionServer:
+    """asyncio HTTP front-end to a process pool of converters
+
+    POST /convert with a BMP body returns the PNG. POST /convert with a multipart body
+    of several BMPs streams back a multipart/mixed response, one part per image in
+    the order sent, each written as soon as it and the ones before it are done.
+    Images admitted but not yet converted are capped at max_queue, and request bodies
+    held in memory at max_buffered_mb; both are checked before a body is read, and a
+    request that would go over them is turned away with 503 and Retry-After rather
+    than queued. If a worker process dies the pool is replaced and the requests it
+    took down get a 503. With max_memory_mb in options, admitted images only start
+    converting while their estimated memory fits in the budget and wait their turn
+    otherwise. GET /metrics returns the latency histogram and admission counters.
+    """
+    def __init__(self, options, host='127.0.0.1', port=8080, workers=0, max_queue=64, max_body_mb=256,
+                 max_buffered_mb=1024):
+        self.options = options
+        self.host = host
+        self.port = port
+        self.workers = resolve_workers(workers)
+        self.max_queue = max_queue
+        self.max_body = int(max_body_mb * 1024 * 1024)
+        self.max_buffered = int(max_buffered_mb * 1024 * 1024)
+        self.buffered = 0
+        self.in_flight = 0
+        self.pool_restarts = 0
+        self.memory = MemoryBudget(options.max_memory_mb)
+        self.memory_freed = None
+        self.accepted = 0
+        self.rejected = 0
+        self.latency = LatencyHistogram()
+        self.executor = None
+        self.server = None
+
+    def new_executor(self):
+        # Forked workers would inherit the sockets of connections open at the time and keep
+        # them from closing; forkserver workers start from a clean process instead
+        context = None
+        if 'forkserver' in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context('forkserver')
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+
+    async def start(self):
+        self.executor = self.new_executor()
+        self.memory_freed = asyncio.Condition()
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        return self.server
+
+    async def serve_forever(self):
+        await self.start()
+        try:
+            async with self.server:
+                await self.server.serve_forever()
+        finally:
+            self.executor.shutdown(cancel_futures=True)
+
+    def metrics(self):
+        return {
+            'in_flight': self.in_flight,
+            'max_queue': self.max_queue,
+            'workers': self.workers,
+            'accepted': self.accepted,
+            'rejected': self.rejected,
+            'buffered_bytes': self.buffered,
+            'pool_restarts': self.pool_restarts,
+            'memory_mb': round(self.memory.used / MEGABYTE, 1),
+            'latency': self.latency.describe(),
+        }
+
+    def admit(self, images):
+        """Reserve room for images conversions or raise a 503"""
+        if self.in_flight + images > self.max_queue:
+            self.rejected += 1
+            raise HttpError(503, "Conversion queue is full, try again shortly", {'Retry-After': '1'})
+        self.in_flight += images
+        self.accepted += 1
+
+    def release(self, _task=None):
+        self.in_flight -= 1
+
+    async def convert(self, data, options):
+        """Convert one BMP on the pool, returning its PNG bytes"""
+        cost = whole_image_memory(data, options)
+        async with self.memory_freed:
+            await self.memory_freed.wait_for(lambda: self.memory.fits(cost))
+            self.memory.take(cost)
+        try:
+            return await self.run_on_pool(data, options)
+        finally:
+            async with self.memory_freed:
+                self.memory.release(cost)
+                self.memory_freed.notify_all()
+
+    async def run_on_pool(self, data, options):
+        executor = self.executor
+        try:
+            png, _ = await asyncio.get_running_loop().run_in_executor(executor, convert_member, data, options)
+        except BrokenProcessPool:
+            # A worker died (crash, out of memory) and took the pool with it; every request
+            # sharing it fails the same way, but only the first one replaces it
+            if self.executor is executor:
+                self.executor = self.new_executor()
+                self.pool_restarts += 1
+                executor.shutdown(wait=False, cancel_futures=True)
+            raise HttpError(503, "A conversion worker crashed, try again shortly", {'Retry-After': '1'})
+        return png
+
+    async def handle(self, reader, writer):
+        started = time.perf_counter()
+        try:
+            try:
+                method, target, headers = await self.read_head(reader)
+                await self.route(method, target, headers, reader, writer)
+            except HttpError as e:
+                await self.respond(writer, e.status, str(e).encode() + b'\n', 'text/plain; charset=utf-8', e.headers)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                return
+            self.latency.observe(time.perf_counter() - started)
+        finally:
+            writer.close()
+
+    async def read_head(self, reader):
+        try:
+            request_line = (await reader.readline()).decode('latin-1').split()
+            method, target = request_line[0], request_line[1]
+        except (IndexError, UnicodeDecodeError):
+            raise HttpError(400, "Malformed request line")
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                return method, target, headers
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+    def body_length(self, headers):
+        """Content-Length of a request, checked against max_body"""
+        if 'content-length' not in headers:
+            raise HttpError(411, "Content-Length is required")
+        try:
+            length = int(headers['content-length'])
+        except ValueError:
+            raise HttpError(400, "Bad Content-Length")
+        if length < 0:
+            raise HttpError(400, "Bad Content-Length")
+        if length > self.max_body:
+            raise HttpError(413, f"Body is larger than {self.max_body // (1024 * 1024)} MB")
+        return length
+
+    def reserve_body(self, length):
+        """Reserve room to hold a body of length bytes in memory or raise a 503"""
+        # A lone request is always let in; max_body already caps its size
+        if self.buffered + length > self.max_buffered and self.buffered:
+            self.rejected += 1
+            raise HttpError(503, "Too many uploads in progress, try again shortly", {'Retry-After': '1'})
+        self.buffered += length
+
+    async def route(self, method, target, headers, reader, writer):
+        url = urlsplit(target)
+        if url.path == '/metrics' and method == 'GET':
+            await self.respond(writer, 200, json.dumps(self.metrics(), indent=1).encode(), 'application/json')
+        elif url.path == '/health' and method == 'GET':
+            await self.respond(writer, 200, b'ok\n', 'text/plain')
+        elif url.path == '/convert':
+            if method != 'POST':
+                raise HttpError(405, "Use POST to send BMP data")
+            options = request_options(self.options, parse_qs(url.query))
+            content_type = headers.get('content-type', '')
+            length = self.body_length(headers)
+            multipart = content_type.startswith('multipart/')
+            # Turn requests away before their bodies are read, not after they are in memory
+            if not multipart:
+                self.admit(1)
+            try:
+                self.reserve_body(length)
+                try:
+                    body = await reader.readexactly(length)
+                    if multipart:
+                        await self.convert_batch(writer, split_multipart(content_type, body), options)
+                    else:
+                        await self.convert_single(writer, body, options)
+                finally:
+                    self.buffered -= length
+            finally:
+                if not multipart:
+                    self.release()
+        else:
+            raise HttpError(404, "Not found")
+
+    async def convert_single(self, writer, data, options):
+        """Convert one BMP already admitted by route()"""
+        try:
+            png = await self.convert(data, options)
+        except HttpError:
+            raise
+        except Exception as e:
+            raise HttpError(422, f"Cannot convert image: {e}")
+        await self.respond(writer, 200, png, 'image/png')
+
+    async def convert_batch(self, writer, files, options):
+        if len(files) > self.max_queue:
+            # Waiting would never help, so don't send Retry-After
+            raise HttpError(413, f"Batch has {len(files)} images, more than the {self.max_queue} "
+                                 f"this server converts at once; split it into smaller batches")
+        self.admit(len(files))
+        # Submit everything at once so the pool works on the whole batch in parallel
+        tasks = [asyncio.ensure_future(self.convert(data, options)) for _, data in files]
+        for task in tasks:
+            # Runs even for tasks cancelled before they started
+            task.add_done_callback(self.release)
+        boundary = uuid.uuid4().hex
+        try:
+            await self.write_head(writer, 200, f'multipart/mixed; boundary={boundary}',
+                                  {'Transfer-Encoding': 'chunked'})
+            for (filename, _), task in zip(files, tasks):
+                png_name = filename.rsplit('.', 1)[0] + '.png'
+                try:
+                    part = (f'--{boundary}\r\nContent-Type: image/png\r\n'
+                            f'Content-Disposition: attachment; filename="{png_name}"\r\n\r\n').encode()
+                    part += await task + b'\r\n'
+                except Exception as e:
+                    status, message = 422, f"Cannot convert image: {e}"
+                    if isinstance(e, HttpError):
+                        status, message = e.status, str(e)
+                    part = (f'--{boundary}\r\nContent-Type: text/plain; charset=utf-8\r\n'
+                            f'Content-Disposition: attachment; filename="{png_name}"\r\n'
+                            f'X-Conversion-Error: {status}\r\n\r\n{message}\r\n').encode()
+                await self.write_chunk(writer, part)
+            await self.write_chunk(writer, f'--{boundary}--\r\n'.encode())
+            await self.write_chunk(writer, b'')
+        finally:
+            # A client that hangs up mid-batch still has its queued images dropped
+            for task in tasks:
+                task.cancel()
+
+    async def write_head(self, writer, status, content_type, headers=None):
+        lines = [f'HTTP/1.1 {status} {REASONS.get(status, "")}', f'Content-Type: {content_type}',
+                 'Connection: close']
+        lines += [f'{name}: {value}' for name, value in (headers or {}).items()]
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        await writer.drain()
+
+    async def write_chunk(self, writer, data):
+        writer.write(b'%x\r\n' % len(data) + data + b'\r\n')
+        await writer.drain()
+
+    async def respond(self, writer, status, body, content_type, headers=None):
+        await self.write_head(writer, status, content_type, dict(headers or {}, **{'Content-Length': len(body)}))
+        writer.write(body)
+        await writer.drain()
+
+def serve(options, host='127.0.0.1', port=8080, workers=0, max_queue=64, max_body_mb=256, max_buffered_mb=1024):
+    """Run the conversion service until interrupted"""
+    server = ConversionServer(options, host, port, workers, max_queue, max_body_mb, max_buffered_mb)
+    asyncio.run(server.serve_forever())
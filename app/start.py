@@ -4,11 +4,12 @@ This script checks for required dependencies and launches the main application
 """
 import os
 import sys
+import json
 import subprocess
 import importlib.util
 import time
 
-print ("""
+BANNER = """
 ╔══════════════════════════════════════════════════════════════════╗
 ║                    BMP to PNG Converter v1.0                     ║
 ║                                                                  ║
@@ -23,12 +24,15 @@ print ("""
 ║                                                                  ║
 ║  Created by: Vexx                                                ║
 ╚══════════════════════════════════════════════════════════════════╝
-""")
+"""
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 PYTHON_DIR = os.path.join(BASE_DIR, "python_embedded")
 PYTHON_EXE = os.path.join(PYTHON_DIR, "python.exe")
-MAIN_APP = os.path.join(BASE_DIR, "app.py")
+# Written once the environment has been checked, so later launches can skip the checks
+ENVIRONMENT_STAMP = os.path.join(BASE_DIR, ".environment_ok")
+# pip package name -> module it provides
+REQUIRED_PACKAGES = {"pillow": "PIL"}
 
 def log(message, error=False):
     """Print a timestamped log message"""
@@ -41,19 +45,45 @@ def log(message, error=False):
     else:
         print(f"[{timestamp}] {message}")
 
-if not os.path.exists(PYTHON_EXE):
-    log("Embedded Python not found at " + PYTHON_EXE, error=True)
-
 sys.path.insert(0, BASE_DIR)
 os.environ["PATH"] = PYTHON_DIR + os.pathsep + os.environ.get("PATH", "")
 
 def check_module(module_name):
-    """Check if a module is available"""
+    """Check if a module is available without importing it"""
     try:
-        importlib.import_module(module_name)
-        return True
-    except ImportError:
+        return importlib.util.find_spec(module_name) is not None
+    except (ImportError, ValueError):
+        return False
+
+def environment_key():
+    """Describe the interpreter and requirements the stamp was written for"""
+    return {
+        "python": sys.version,
+        "executable": sys.executable,
+        "packages": sorted(REQUIRED_PACKAGES),
+    }
+
+def environment_verified(require_gui):
+    """True if an earlier launch already set up this environment"""
+    try:
+        with open(ENVIRONMENT_STAMP, 'r') as f:
+            stamp = json.load(f)
+    except (OSError, ValueError):
+        return False
+    if stamp.get("environment") != environment_key():
         return False
+    if require_gui and not stamp.get("gui"):
+        return False
+    # Cheap sanity check in case packages were removed since the stamp was written
+    return all(check_module(module) for module in REQUIRED_PACKAGES.values())
+
+def write_environment_stamp(gui):
+    try:
+        with open(ENVIRONMENT_STAMP, 'w') as f:
+            json.dump({"environment": environment_key(), "gui": gui}, f)
+    except OSError:
+        # Read-only install; the checks simply run again next time
+        pass
 
 def install_package(package_name):
     """Install a package using pip"""
@@ -68,8 +98,11 @@ def install_package(package_name):
         log(f"Failed to install {package_name}: {e}")
         return False
 
-def setup_environment():
+def setup_environment(require_gui=True):
     """Set up the Python environment with required packages"""
+    if environment_verified(require_gui):
+        return True
+
     log("Setting up environment...")
     pth_file = None
 
@@ -104,33 +137,66 @@ def setup_environment():
         subprocess.check_call([sys.executable, get_pip_path, "--no-warn-script-location"])
         log("Pip installed successfully")
     
-    required_packages = ["pillow"]
-    for package in required_packages:
-        if not check_module(package.split("==")[0].replace("-", "_")):
+    for package, module in REQUIRED_PACKAGES.items():
+        if not check_module(module):
             if not install_package(package):
                 log(f"Failed to install required package: {package}", error=True)
+            importlib.invalidate_caches()
 
-    if not check_module("tkinter"):
+    gui = check_module("tkinter")
+    if require_gui and not gui:
         log("tkinter is not available. The GUI will not work.\ntkinter must be included with your Python installation.\nYou may need to install a full version of Python or manually copy tkinter files.", error=True)
     
+    write_environment_stamp(gui)
     return True
 
+def forget_environment():
+    """Drop the stamp so the next launch checks everything again"""
+    try:
+        os.remove(ENVIRONMENT_STAMP)
+    except OSError:
+        pass
+
 def run_main_app():
-    """Run the main application"""
+    """Run the main application in this interpreter"""
     log("Starting application...")
     
     try:
-        subprocess.check_call([sys.executable, MAIN_APP])
+        from app import main
+        main()
         return True
-    except subprocess.CalledProcessError as e:
+    except ImportError as e:
+        forget_environment()
         log(f"Application failed to start: {e}", error=True)
         return False
 
+def run_cli(args):
+    """Run the headless command line converter in this interpreter and return its exit code"""
+    log("Starting command line conversion...")
+    try:
+        from cli import main
+    except ImportError as e:
+        forget_environment()
+        log(f"Command line converter failed to start: {e}", error=True)
+        return 1
+    return main(args)
+
+# Worker processes on Windows import this script again, so everything that should
+# only happen once per launch stays below
 if __name__ == "__main__":
+    print(BANNER)
+    if not os.path.exists(PYTHON_EXE):
+        log("Embedded Python not found at " + PYTHON_EXE, error=True)
+
     log("Initializing...")
     
-    if setup_environment():
+    # Any arguments (e.g. a folder path) select the headless command line mode
+    cli_args = sys.argv[1:]
+    
+    if setup_environment(require_gui=not cli_args):
         log("Environment setup complete")
+        if cli_args:
+            sys.exit(run_cli(cli_args))
         success = run_main_app()
         if success:
             log("Application completed successfully")
@@ -0,0 +1,129 @@
+"""
+Per-stage timing and run reports
+Records how long each file spends in every conversion stage, writes one JSON line per file
+and a percentile summary at the end of the run
+"""
+import cProfile
+import json
+import os
+import time
+import tracemalloc
+import zlib
+from contextlib import contextmanager
+
+STAGES = ('scan', 'validation', 'read', 'decode', 'keying', 'encode', 'write')
+PERCENTILES = (50, 95, 99)
+PROFILE_MODES = ('cprofile', 'tracemalloc')
+
+class StageTimer:
+    """Accumulates wall-clock seconds per stage for a single file"""
+    def __init__(self):
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - started)
+
+    def add(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    rank = max(1, -(-len(sorted_values) * p // 100))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+def should_profile(name, sample_rate):
+    """Deterministically pick about sample_rate of the files, so reruns profile the same ones"""
+    if sample_rate <= 0:
+        return False
+    return zlib.crc32(name.encode('utf-8')) % 10000 < sample_rate * 10000
+
+def run_profiled(mode, report_path, function, *args, **kwargs):
+    """Call function under cProfile or tracemalloc and save the result to report_path"""
+    os.makedirs(os.path.dirname(report_path), exist_ok=True)
+    if mode == 'cprofile':
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(function, *args, **kwargs)
+        finally:
+            profiler.dump_stats(report_path + ".prof")
+
+    already_tracing = tracemalloc.is_tracing()
+    if not already_tracing:
+        tracemalloc.start()
+    try:
+        return function(*args, **kwargs)
+    finally:
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        if not already_tracing:
+            tracemalloc.stop()
+        with open(report_path + ".tracemalloc.txt", 'w') as f:
+            f.write(f"Peak traced memory: {peak} bytes\n\n")
+            for stat in snapshot.statistics('lineno')[:25]:
+                f.write(f"{stat}\n")
+
+class RunReport:
+    """Writes per-file JSON Lines as files finish and a summary when the run closes"""
+    def __init__(self, events_path, summary_path, settings=None):
+        self.events_path = events_path
+        self.summary_path = summary_path
+        self.settings = settings or {}
+        self.started = time.time()
+        self.stage_samples = {stage: [] for stage in STAGES}
+        self.counts = {'converted': 0, 'deduplicated': 0, 'failed': 0, 'skipped': 0}
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.events = open(events_path, 'w')
+
+    def add(self, name, status, stats=None, error=None):
+        """Record one file; status is 'converted', 'deduplicated', 'failed' or 'skipped'"""
+        record = {'file': name, 'status': status}
+        self.counts[status] += 1
+        if stats:
+            record['input_bytes'] = stats.get('input_bytes')
+            record['output_bytes'] = stats.get('output_bytes')
+            record['stages'] = stats.get('stages', {})
+            self.bytes_in += stats.get('input_bytes') or 0
+            self.bytes_out += stats.get('output_bytes') or 0
+            for stage, seconds in record['stages'].items():
+                self.stage_samples.setdefault(stage, []).append(seconds)
+        if error is not None:
+            record['error'] = str(error)
+        self.events.write(json.dumps(record) + "\n")
+        self.events.flush()
+
+    def summary(self):
+        stages = {}
+        for stage, samples in self.stage_samples.items():
+            if not samples:
+                continue
+            samples = sorted(samples)
+            stages[stage] = {
+                'count': len(samples),
+                'total': sum(samples),
+                'mean': sum(samples) / len(samples),
+                'max': samples[-1],
+            }
+            for p in PERCENTILES:
+                stages[stage][f'p{p}'] = percentile(samples, p)
+        return {
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+            'wall_seconds': time.time() - self.started,
+            'files': dict(self.counts),
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'settings': self.settings,
+            'stages': stages,
+        }
+
+    def close(self):
+        self.events.close()
+        with open(self.summary_path, 'w') as f:
+            json.dump(self.summary(), f, indent=1)
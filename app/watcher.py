@@ -0,0 +1,284 @@
+"""
+Watch-folder mode
+Converts BMP files as they are dropped into a folder, using inotify on Linux and polling elsewhere
+"""
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+
+from converter import ConversionEvent, convert_directory, convert_file, output_path_for
+from dedupe import HashStore
+from manifest import Manifest, hash_file
+from scanner import scan_bmp_files
+
+# inotify constants from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE_SELF
+EVENT_HEADER = struct.Struct("iIII")
+
+class InotifySource:
+    """Reports paths changed under a folder (and optionally its sub-folders) through inotify"""
+    def __init__(self, directory, recursive, exclude):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.recursive = recursive
+        self.exclude = {os.path.normcase(os.path.abspath(path)) for path in exclude}
+        self.folders = {}
+        self.overflowed = False
+        self.watch(directory)
+
+    def watch(self, folder):
+        if os.path.normcase(os.path.abspath(folder)) in self.exclude:
+            return
+        wd = self._add_watch(self.fd, os.fsencode(folder), WATCH_MASK)
+        if wd < 0:
+            # The folder may have gone away already; the top level is checked by the caller
+            return
+        self.folders[wd] = folder
+        if self.recursive:
+            try:
+                with os.scandir(folder) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            self.watch(entry.path)
+            except OSError:
+                pass
+
+    def read(self, timeout):
+        """Wait up to timeout seconds and return [(path, finished)] for BMP files that changed
+
+        finished is True once the writer has closed the file (or it was moved in whole).
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+
+        changes = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                self.overflowed = True
+                continue
+            if mask & IN_IGNORED:
+                self.folders.pop(wd, None)
+                continue
+            folder = self.folders.get(wd)
+            if folder is None or not name:
+                continue
+            path = os.path.join(folder, name)
+            if mask & IN_ISDIR:
+                if self.recursive and mask & (IN_CREATE | IN_MOVED_TO):
+                    self.watch(path)
+                    # Files may have landed before the watch existed
+                    changes.extend((entry.path, True) for entry in scan_bmp_files(path, True, self.exclude))
+            elif name.lower().endswith('.bmp'):
+                changes.append((path, bool(mask & (IN_CLOSE_WRITE | IN_MOVED_TO))))
+        return changes
+
+    def close(self):
+        os.close(self.fd)
+
+class PollingSource:
+    """Fallback change source that compares os.scandir snapshots of the folder"""
+    def __init__(self, directory, recursive, exclude, interval):
+        self.directory = directory
+        self.recursive = recursive
+        self.exclude = exclude
+        self.interval = interval
+        self.overflowed = False
+        self.snapshot = self._snapshot()
+
+    def _snapshot(self):
+        snapshot = {}
+        for entry in scan_bmp_files(self.directory, self.recursive, self.exclude):
+            try:
+                snapshot[entry.path] = (entry.stat.st_size, entry.stat.st_mtime_ns)
+            except OSError:
+                continue
+        return snapshot
+
+    def read(self, timeout):
+        time.sleep(min(timeout, self.interval))
+        snapshot = self._snapshot()
+        # Polling can't see the writer close the file; the debounce window covers that
+        changes = [(path, False) for path, state in snapshot.items() if self.snapshot.get(path) != state]
+        self.snapshot = snapshot
+        return changes
+
+    def close(self):
+        pass
+
+class FolderWatcher:
+    """Converts new or modified BMP files in a folder until stopped
+
+    Changes are debounced: a file is converted once it has been quiet for debounce
+    seconds, so files that are still being copied in are not picked up half-written.
+    on_event is called with the same ConversionEvents convert_directory yields.
+    Rewriting the manifest gets slow on big folders, so it is only saved every
+    save_every files or save_interval seconds and on shutdown; the manifest's journal
+    covers the files in between.
+    """
+    def __init__(self, directory, options, on_event=None, debounce=0.25, poll_interval=0.5, use_inotify=None,
+                 save_every=100, save_interval=30.0):
+        self.directory = directory
+        self.options = options
+        self.on_event = on_event or (lambda event: None)
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.use_inotify = sys.platform.startswith('linux') if use_inotify is None else use_inotify
+        self.output_dir = os.path.join(directory, options.output_folder)
+        self.save_every = save_every
+        self.save_interval = save_interval
+        self.unsaved = 0
+        self.last_save = time.monotonic()
+        self.pending = {}
+        self.counts = {'total': 0, 'processed': 0, 'failed': 0, 'skipped': 0}
+
+    def open_source(self):
+        exclude = (self.output_dir,)
+        if self.use_inotify:
+            try:
+                return InotifySource(self.directory, self.options.recursive, exclude)
+            except (OSError, AttributeError, TypeError):
+                # No inotify (other platforms, or the instance limit was hit)
+                pass
+        return PollingSource(self.directory, self.options.recursive, exclude, self.poll_interval)
+
+    def catch_up(self):
+        """Convert whatever changed while nobody was watching, skipping up-to-date files"""
+        for event in convert_directory(self.directory, self.options):
+            if event.kind != 'start':
+                self.on_event(event)
+
+    def run(self, stop_event=None, catch_up=True):
+        """Watch until stop_event is set (or forever), converting files as they settle"""
+        os.makedirs(self.output_dir, exist_ok=True)
+        # Start watching before the catch-up pass so nothing dropped meanwhile is missed
+        source = self.open_source()
+        manifest = hashes = None
+        try:
+            if catch_up:
+                self.catch_up()
+            manifest = Manifest.load(self.output_dir) if self.options.incremental else None
+            hashes = self.load_hashes()
+            self.last_save = time.monotonic()
+            while stop_event is None or not stop_event.is_set():
+                now = time.monotonic()
+                wait = self.poll_interval
+                if self.pending:
+                    wait = max(0.0, min(self.pending.values()) - now)
+                for path, finished in source.read(wait):
+                    # A closed file only needs a short settle; one still growing waits the full window
+                    delay = self.debounce / 4 if finished else self.debounce
+                    self.pending[path] = time.monotonic() + delay
+                if source.overflowed:
+                    # Too many events were dropped; fall back to one incremental rescan
+                    source.overflowed = False
+                    self.save(manifest, hashes)
+                    self.catch_up()
+                    manifest = Manifest.load(self.output_dir) if self.options.incremental else None
+                    hashes = self.load_hashes()
+                self.convert_ready(manifest, hashes)
+                if self.unsaved and (self.unsaved >= self.save_every
+                                     or time.monotonic() - self.last_save >= self.save_interval):
+                    self.save(manifest, hashes)
+        finally:
+            source.close()
+            self.save(manifest, hashes)
+
+    def load_hashes(self):
+        """The output folder's duplicate store, as the catch-up pass left it, if dedupe is on"""
+        if not self.options.dedupe:
+            return None
+        return HashStore.load(self.output_dir, self.options.output_settings())
+
+    def save(self, manifest, hashes):
+        """Write out the manifest and duplicate store if any file changed them since the last save"""
+        if not self.unsaved:
+            return
+        if manifest is not None:
+            manifest.save()
+        if hashes is not None:
+            hashes.save()
+        self.unsaved = 0
+        self.last_save = time.monotonic()
+
+    def convert_ready(self, manifest, hashes=None):
+        now = time.monotonic()
+        ready = [path for path, deadline in self.pending.items() if deadline <= now]
+        for path in ready:
+            del self.pending[path]
+            # Saved in batches by run(); until then the manifest journal keeps each file's entry
+            if self.convert_path(path, manifest, hashes):
+                self.unsaved += 1
+
+    def convert_path(self, path, manifest, hashes=None):
+        """Convert one settled file, returning True if the manifest changed"""
+        name = os.path.relpath(path, self.directory).replace(os.sep, "/")
+        output_path = output_path_for(self.output_dir, name)
+        settings = self.options.output_settings()
+        try:
+            stat = os.stat(path)
+        except OSError:
+            # Deleted or renamed away before it settled
+            return False
+
+        self.counts['total'] += 1
+        content_hash = None
+        if manifest is not None:
+            try:
+                up_to_date, content_hash = manifest.check(name, path, output_path, settings, stat)
+            except OSError:
+                up_to_date, content_hash = False, None
+            if up_to_date:
+                self.counts['skipped'] += 1
+                self.on_event(ConversionEvent('skip', name=name, input_path=path, output_path=output_path,
+                                              **self.counts))
+                return True
+
+        error = None
+        stats = None
+        try:
+            stats = convert_file(path, output_path, self.options, stat.st_size)
+            self.counts['processed'] += 1
+            if hashes is not None:
+                # The PNG was just rewritten, so the store must not keep it for its old contents
+                try:
+                    content_hash = content_hash or hash_file(path)
+                    hashes.record(content_hash, name, output_path)
+                except OSError:
+                    hashes.forget_name(name)
+            if manifest is not None:
+                manifest.record(name, path, settings, content_hash, stat)
+        except Exception as e:
+            error = e
+            self.counts['failed'] += 1
+        self.on_event(ConversionEvent('file', name=name, input_path=path, output_path=output_path,
+                                      error=error, stats=stats, **self.counts))
+        return error is None
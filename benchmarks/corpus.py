@@ -0,0 +1,162 @@
+"""
+Deterministic synthetic BMP corpus for the benchmarks
+Writes BMP files byte by byte so every bit depth and RLE mode is covered, not just the ones Pillow can save
+"""
+import json
+import os
+import random
+import struct
+
+BI_RGB = 0
+BI_RLE8 = 1
+BI_RLE4 = 2
+
+# (bits, compression) combinations in the default corpus
+VARIANTS = [
+    (1, BI_RGB),
+    (4, BI_RGB),
+    (4, BI_RLE4),
+    (8, BI_RGB),
+    (8, BI_RLE8),
+    (24, BI_RGB),
+    (32, BI_RGB),
+]
+DEFAULT_SIZES = [(64, 64), (256, 256), (1024, 1024)]
+DEFAULT_FRACTIONS = [0.0, 0.25, 0.75]
+KEY_COLOR = (0, 0, 0)
+SPEC_NAME = "corpus.json"
+
+def variant_name(bits, compression):
+    return {BI_RLE8: "rle8", BI_RLE4: "rle4"}.get(compression, f"{bits}bit")
+
+def make_palette(colors, rng):
+    """Palette whose entry 0 is the key color and the rest are random opaque colors"""
+    palette = [KEY_COLOR]
+    while len(palette) < colors:
+        color = (rng.randrange(256), rng.randrange(256), rng.randrange(256))
+        if color != KEY_COLOR:
+            palette.append(color)
+    return palette
+
+def make_runs(width, height, colors, fraction, rng):
+    """Rows of (length, palette_index) runs where about fraction of the pixels use index 0"""
+    rows = []
+    for _ in range(height):
+        row = []
+        x = 0
+        while x < width:
+            length = min(width - x, rng.randint(1, 48))
+            index = 0 if rng.random() < fraction else rng.randrange(1, colors)
+            row.append((length, index))
+            x += length
+        rows.append(row)
+    return rows
+
+def pack_indices(indices, bits):
+    """Pack palette indices into bytes, most significant bits first"""
+    if bits == 8:
+        return bytes(indices)
+    per_byte = 8 // bits
+    indices = indices + [0] * (-len(indices) % per_byte)
+    packed = bytearray()
+    for i in range(0, len(indices), per_byte):
+        value = 0
+        for index in indices[i:i + per_byte]:
+            value = (value << bits) | index
+        packed.append(value)
+    return bytes(packed)
+
+def encode_row(row, bits, palette):
+    """Uncompressed bytes for one row of runs, padded to a multiple of 4"""
+    if bits in (24, 32):
+        data = b''.join(
+            bytes((b, g, r) if bits == 24 else (b, g, r, 0)) * length
+            for length, (r, g, b) in ((length, palette[index]) for length, index in row)
+        )
+    else:
+        data = pack_indices([index for length, index in row for _ in range(length)], bits)
+    return data + b'\0' * (-len(data) % 4)
+
+def encode_rle_row(row, bits):
+    """RLE8/RLE4 encoded bytes for one row of runs, including the end-of-line marker"""
+    data = bytearray()
+    for length, index in row:
+        value = index if bits == 8 else (index << 4) | index
+        while length:
+            count = min(length, 255)
+            data += bytes((count, value))
+            length -= count
+    return bytes(data) + b'\0\0'
+
+def write_bmp(path, width, height, bits, compression, fraction, seed):
+    """Write one deterministic BMP and return its pixel count"""
+    rng = random.Random(seed)
+    colors = 2 if bits == 1 else 16 if bits == 4 else 256
+    palette = make_palette(colors, rng)
+    rows = make_runs(width, height, colors, fraction, rng)
+
+    # BMP rows are stored bottom-up
+    if compression == BI_RGB:
+        pixels = b''.join(encode_row(row, bits, palette) for row in reversed(rows))
+    else:
+        pixels = b''.join(encode_rle_row(row, bits) for row in reversed(rows))[:-2] + b'\0\1'
+
+    palette_bytes = b'' if bits > 8 else b''.join(bytes((b, g, r, 0)) for r, g, b in palette)
+    offset = 14 + 40 + len(palette_bytes)
+    info_header = struct.pack("<IiiHHIIiiII", 40, width, height, 1, bits, compression, len(pixels),
+                              2835, 2835, 0 if bits > 8 else colors, 0)
+    with open(path, 'wb') as f:
+        f.write(b'BM' + struct.pack("<IHHI", offset + len(pixels), 0, 0, offset))
+        f.write(info_header)
+        f.write(palette_bytes)
+        f.write(pixels)
+    return width * height
+
+def build_spec(sizes=None, fractions=None, variants=None, seed=1):
+    return {
+        'seed': seed,
+        'sizes': [list(size) for size in (sizes or DEFAULT_SIZES)],
+        'fractions': list(fractions if fractions is not None else DEFAULT_FRACTIONS),
+        'variants': [list(variant) for variant in (variants or VARIANTS)],
+    }
+
+def generate_corpus(directory, spec):
+    """Create the corpus described by spec in directory, reusing it if it already matches
+
+    Returns a list of dicts describing each file (name, group, width, height, bits,
+    compression, fraction, pixels).
+    """
+    os.makedirs(directory, exist_ok=True)
+    files = []
+    index = 0
+    for width, height in spec['sizes']:
+        for bits, compression in spec['variants']:
+            for fraction in spec['fractions']:
+                name = f"{variant_name(bits, compression)}_{width}x{height}_{int(fraction * 100):02d}.bmp"
+                files.append({
+                    'name': name,
+                    'group': variant_name(bits, compression),
+                    'width': width,
+                    'height': height,
+                    'bits': bits,
+                    'compression': compression,
+                    'fraction': fraction,
+                    'pixels': width * height,
+                    'seed': spec['seed'] * 1000003 + index,
+                })
+                index += 1
+
+    spec_path = os.path.join(directory, SPEC_NAME)
+    try:
+        with open(spec_path, 'r') as f:
+            if json.load(f) == spec and all(os.path.exists(os.path.join(directory, item['name'])) for item in files):
+                return files
+    except (OSError, ValueError):
+        pass
+
+    for item in files:
+        write_bmp(os.path.join(directory, item['name']), item['width'], item['height'],
+                  item['bits'], item['compression'], item['fraction'], item['seed'])
+    with open(spec_path, 'w') as f:
+        json.dump(spec, f, indent=1)
+    return files
@@ -0,0 +1,139 @@
+"""
+Conversion benchmark
+Converts a synthetic BMP corpus through the same code path as the app and reports files/s,
+megapixels/s and peak memory, optionally as JSON for comparing commits
+
+Usage: python benchmarks/run.py [--sizes 64x64,1024x1024] [--json results.json]
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, "app"))
+sys.path.insert(0, BENCH_DIR)
+
+import PIL
+from converter import ConversionOptions, convert_file, output_path_for
+from corpus import build_spec, generate_corpus
+from encoder import ENCODER_PROFILES
+
+def peak_rss_mb():
+    """Peak resident memory of this process in MB, or None where it cannot be measured"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=ROOT_DIR,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def parse_sizes(text):
+    sizes = []
+    for item in text.split(','):
+        width, height = item.lower().split('x')
+        sizes.append((int(width), int(height)))
+    return sizes
+
+def rate(count, seconds):
+    return count / seconds if seconds > 0 else None
+
+def summarize(name, timings):
+    seconds = sum(t['seconds'] for t in timings)
+    pixels = sum(t['pixels'] for t in timings)
+    return {
+        'group': name,
+        'files': len(timings),
+        'megapixels': pixels / 1e6,
+        'seconds': seconds,
+        'files_per_s': rate(len(timings), seconds),
+        'megapixels_per_s': rate(pixels / 1e6, seconds),
+    }
+
+def run_benchmark(files, corpus_dir, output_dir, options, repeat):
+    """Convert every corpus file repeat times, returning per-file timings (best of the repeats)"""
+    timings = []
+    for item in files:
+        input_path = os.path.join(corpus_dir, item['name'])
+        output_path = output_path_for(output_dir, item['name'])
+        best = None
+        for _ in range(repeat):
+            started = time.perf_counter()
+            convert_file(input_path, output_path, options)
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        timings.append({'name': item['name'], 'group': item['group'], 'pixels': item['pixels'], 'seconds': best})
+    return timings
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark BMP to PNG conversion on a synthetic corpus.")
+    parser.add_argument("--sizes", type=parse_sizes, help="comma separated WIDTHxHEIGHT list")
+    parser.add_argument("--fractions", type=lambda text: [float(v) for v in text.split(',')],
+                        help="comma separated fractions of transparent-color pixels")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=1, help="convert each file this many times and keep the best")
+    parser.add_argument("--profile", choices=ENCODER_PROFILES, default="balanced")
+    parser.add_argument("--strip-budget-mb", type=float, default=64)
+    parser.add_argument("--corpus-dir", default=os.path.join(tempfile.gettempdir(), "bmp2png_bench_corpus"),
+                        help="where the corpus is generated (reused between runs when unchanged)")
+    parser.add_argument("--json", dest="json_path", help="write machine-readable results to this file")
+    args = parser.parse_args(argv)
+
+    spec = build_spec(args.sizes, args.fractions, seed=args.seed)
+    files = generate_corpus(args.corpus_dir, spec)
+    options = ConversionOptions(encoder_profile=args.profile, strip_budget_mb=args.strip_budget_mb, workers=1)
+
+    output_dir = tempfile.mkdtemp(prefix="bmp2png_bench_out_")
+    try:
+        timings = run_benchmark(files, args.corpus_dir, output_dir, options, max(1, args.repeat))
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+
+    groups = []
+    for group in dict.fromkeys(t['group'] for t in timings):
+        groups.append(summarize(group, [t for t in timings if t['group'] == group]))
+    total = summarize('total', timings)
+
+    results = {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'pillow': PIL.__version__,
+        'platform': platform.platform(),
+        'corpus': spec,
+        'options': {'encoder_profile': args.profile, 'strip_budget_mb': args.strip_budget_mb, 'repeat': args.repeat},
+        'groups': groups,
+        'total': total,
+        'peak_rss_mb': peak_rss_mb(),
+        'files': timings,
+    }
+
+    print(f"{'group':<8} {'files':>6} {'MPix':>8} {'seconds':>9} {'files/s':>9} {'MPix/s':>9}")
+    for row in groups + [total]:
+        print(f"{row['group']:<8} {row['files']:>6} {row['megapixels']:>8.2f} {row['seconds']:>9.3f} "
+              f"{row['files_per_s'] or 0:>9.1f} {row['megapixels_per_s'] or 0:>9.2f}")
+    if results['peak_rss_mb'] is not None:
+        print(f"Peak RSS: {results['peak_rss_mb']:.1f} MB")
+
+    if args.json_path:
+        with open(args.json_path, 'w') as f:
+            json.dump(results, f, indent=1)
+        print(f"Results written to {args.json_path}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,2 +1,2 @@
 @echo off
-.\app\python_embedded\python.exe app\start.py
\ No newline at end of file
+.\app\python_embedded\python.exe app\start.py %*
\ No newline at end of file
@@ -0,0 +1,83 @@
+"""
+Tests for zip and tar archives as conversion input and output
+"""
+import io
+import ntpath
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import unittest
+import zipfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app"))
+
+from PIL import Image
+from archive import convert_archive, safe_member_name
+from converter import ConversionOptions
+
+def bmp_bytes(size=(6, 4), color=(255, 0, 255)):
+    data = io.BytesIO()
+    Image.new("RGB", size, color).save(data, "BMP")
+    return data.getvalue()
+
+class SafeMemberName(unittest.TestCase):
+    def test_plain_names(self):
+        self.assertEqual(safe_member_name("sprites/a.bmp"), "sprites/a.bmp")
+        self.assertEqual(safe_member_name("sprites\\b.bmp"), "sprites/b.bmp")
+        self.assertEqual(safe_member_name("./sprites/../c.bmp"), "c.bmp")
+
+    def test_parent_directories(self):
+        for name in ("../evil.bmp", "a/../../evil.bmp", "..", "a\\..\\..\\evil.bmp"):
+            with self.assertRaises(IOError, msg=name):
+                safe_member_name(name)
+
+    def test_absolute_names_stay_inside(self):
+        for name in ("/etc/evil.bmp", "\\evil.bmp", "//server/share/evil.bmp"):
+            safe = safe_member_name(name)
+            self.assertFalse(safe.startswith("/"), name)
+            self.assertEqual(ntpath.join("out", safe).split("/")[0].split("\\")[0], "out")
+
+    def test_drive_letters(self):
+        for name in ("C:/x/evil.bmp", "C:\\x\\evil.bmp", "c:evil.bmp", "a/b:stream.bmp"):
+            with self.assertRaises(IOError, msg=name):
+                safe_member_name(name)
+
+class ConvertArchive(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.options = ConversionOptions(transparent_color=(255, 0, 255), workers=1)
+
+    def test_zip_to_folder_reports_unsafe_members(self):
+        archive_path = os.path.join(self.directory, "in.zip")
+        with zipfile.ZipFile(archive_path, 'w') as archive:
+            archive.writestr("sprites/a.bmp", bmp_bytes())
+            archive.writestr("C:/x/evil.bmp", bmp_bytes())
+            archive.writestr("readme.txt", b"not an image")
+        events = [event for event in convert_archive(archive_path, self.options) if event.kind == 'file']
+        errors = {event.name: event.error for event in events}
+        self.assertIsNone(errors["sprites/a.bmp"])
+        self.assertIsInstance(errors["C:/x/evil.bmp"], IOError)
+        output = os.path.join(self.directory, self.options.output_folder, "sprites", "a.png")
+        self.assertEqual(Image.open(output).getpixel((0, 0)), (255, 255, 255, 0))
+
+    def test_tar_to_zip(self):
+        archive_path = os.path.join(self.directory, "in.tar.gz")
+        with tarfile.open(archive_path, 'w:gz') as archive:
+            for name in ("a.bmp", "b.bmp"):
+                data = bmp_bytes(color=(1, 2, 3))
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                archive.addfile(info, io.BytesIO(data))
+        output_archive = os.path.join(self.directory, "out.zip")
+        events = list(convert_archive(archive_path, self.options, output_archive))
+        self.assertEqual(events[-1].processed, 2)
+        with zipfile.ZipFile(output_archive) as archive:
+            self.assertEqual(sorted(archive.namelist()), ["a.png", "b.png"])
+            self.assertEqual(Image.open(io.BytesIO(archive.read("a.png"))).size, (6, 4))
+        self.assertFalse(os.path.exists(output_archive + ".tmp"))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,92 @@
+"""
+Tests for sprite-atlas packing
+Every frame must get its own rectangle on its page unless it really is the same image as another
+"""
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app"))
+
+from PIL import Image
+from atlas import ATLAS_NAME, Frame, convert_to_atlas, frame_index, pack_frames
+from converter import ConversionOptions
+
+def solid_frame(name, size, color=(10, 20, 30, 255)):
+    pixels = bytes(color) * (size[0] * size[1])
+    return Frame(name, size, (0, 0), size, pixels)
+
+class PackFrames(unittest.TestCase):
+    def assertPackedCleanly(self, frames, pages, max_size, padding):
+        rectangles = {}
+        for frame in frames:
+            x, y = frame.position
+            width, height = frame.size
+            self.assertGreaterEqual(x, 0)
+            self.assertGreaterEqual(y, 0)
+            page = pages[frame.page]
+            self.assertLessEqual(x + width, min(page.used_width, max_size), frame.name)
+            self.assertLessEqual(y + height, min(page.used_height, max_size), frame.name)
+            rectangles.setdefault(frame.digest, (frame.page, x, y, width, height))
+        placed = list(rectangles.values())
+        for i, (page_a, xa, ya, wa, ha) in enumerate(placed):
+            for page_b, xb, yb, wb, hb in placed[i + 1:]:
+                if page_a != page_b:
+                    continue
+                apart = xa + wa + padding <= xb or xb + wb + padding <= xa or \
+                        ya + ha + padding <= yb or yb + hb + padding <= ya
+                self.assertTrue(apart, f"{(xa, ya, wa, ha)} overlaps {(xb, yb, wb, hb)}")
+
+    def test_same_bytes_different_shapes(self):
+        frames = [solid_frame("tall", (2, 8)), solid_frame("wide", (8, 2)), solid_frame("square", (4, 4))]
+        pages = pack_frames(frames, 64, 1)
+        self.assertEqual(len({frame.digest for frame in frames}), 3)
+        self.assertPackedCleanly(frames, pages, 64, 1)
+
+    def test_identical_frames_share_a_rectangle(self):
+        frames = [solid_frame("a", (5, 3)), solid_frame("b", (5, 3)), solid_frame("c", (5, 3), (1, 2, 3, 255))]
+        pages = pack_frames(frames, 64, 1)
+        self.assertEqual(frames[0].position, frames[1].position)
+        self.assertNotEqual(frames[0].position, frames[2].position)
+        self.assertPackedCleanly(frames, pages, 64, 1)
+
+    def test_overflow_starts_new_pages(self):
+        frames = [solid_frame(f"f{i}", (10, 10), (i, 0, 0, 255)) for i in range(12)]
+        pages = pack_frames(frames, 24, 1)
+        self.assertGreater(len(pages), 1)
+        self.assertPackedCleanly(frames, pages, 24, 1)
+
+    def test_too_large_frame(self):
+        with self.assertRaises(ValueError):
+            pack_frames([solid_frame("huge", (40, 4))], 32, 1)
+
+    def test_index_lists_every_frame(self):
+        frames = [solid_frame("a", (2, 8)), solid_frame("b", (8, 2))]
+        index = frame_index(frames, pack_frames(frames, 64, 1))
+        self.assertEqual(sorted(index['frames']), ["a", "b"])
+        self.assertEqual(index['frames']["b"]['frame']['w'], 8)
+
+class ConvertToAtlas(unittest.TestCase):
+    def test_writes_pages_and_index(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        for name, size in (("tall", (2, 8)), ("wide", (8, 2)), ("square", (4, 4))):
+            Image.new("RGB", size, (200, 10, 10)).save(os.path.join(directory, name + ".bmp"))
+        options = ConversionOptions(workers=1, atlas=True, atlas_max_size=64)
+        events = list(convert_to_atlas(directory, options))
+        self.assertEqual(events[-1].processed, 3)
+        output_dir = os.path.join(directory, options.output_folder)
+        with open(os.path.join(output_dir, ATLAS_NAME + ".json")) as f:
+            index = json.load(f)
+        page = Image.open(os.path.join(output_dir, ATLAS_NAME + ".png"))
+        for name, entry in index['frames'].items():
+            rect = entry['frame']
+            self.assertLessEqual(rect['x'] + rect['w'], page.width, name)
+            self.assertLessEqual(rect['y'] + rect['h'], page.height, name)
+            self.assertEqual(page.getpixel((rect['x'], rect['y']))[:3], (200, 10, 10))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+"""
+Tests for sharded conversion
+Leases are driven directly for the bookkeeping, and a real coordinator and worker talk over HTTP for a whole run
+"""
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app"))
+
+from PIL import Image
+from cluster import Coordinator, options_from_settings, parse_address, run_worker
+from converter import ConversionOptions
+
+def result(name, error=None):
+    return {'name': name, 'error': error, 'stats': {'input_bytes': 10}}
+
+class Leases(unittest.TestCase):
+    def coordinator(self, names, **kwargs):
+        coordinator = Coordinator("unused", ConversionOptions(), **kwargs)
+        for name in names:
+            coordinator.sizes[name] = 10
+            coordinator.pending.append(name)
+        coordinator.scanning = False
+        return coordinator
+
+    def test_batches_until_done(self):
+        coordinator = self.coordinator(["a", "b", "c"], batch_size=2)
+        first = coordinator.lease({'worker': "w1"})
+        self.assertEqual([job['name'] for job in first['files']], ["a", "b"])
+        second = coordinator.lease({'worker': "w2"})
+        self.assertEqual([job['name'] for job in second['files']], ["c"])
+        self.assertEqual(coordinator.lease({'worker': "w2"})['files'], [])
+        coordinator.complete({'worker': "w1", 'lease': first['lease'], 'results': [result("a"), result("b")]})
+        coordinator.complete({'worker': "w2", 'lease': second['lease'], 'results': [result("c", "bad file")]})
+        self.assertEqual(coordinator.lease({'worker': "w1"}), {'done': True})
+        summary = coordinator.worker_summary()
+        self.assertEqual((summary["w1"]['files'], summary["w2"]['failed']), (2, 1))
+
+    def test_expired_lease_goes_to_the_next_worker(self):
+        coordinator = self.coordinator(["a", "b"], lease_seconds=0.01)
+        lost = coordinator.lease({'worker': "slow"})
+        time.sleep(0.05)
+        retry = coordinator.lease({'worker': "fast"})
+        self.assertEqual([job['name'] for job in retry['files']], ["a", "b"])
+        self.assertEqual(coordinator.worker_summary()["slow"]['leases_expired'], 1)
+        self.assertFalse(coordinator.renew({'worker': "slow", 'lease': lost['lease']})['ok'])
+        # The first result for a file wins, even from the lease that expired
+        coordinator.complete({'worker': "slow", 'lease': lost['lease'], 'results': [result("a")]})
+        coordinator.complete({'worker': "fast", 'lease': retry['lease'], 'results': [result("a"), result("b")]})
+        self.assertEqual(coordinator.results.qsize(), 2)
+        self.assertEqual(coordinator.worker_summary()["fast"]['files'], 1)
+
+    def test_unreported_files_are_requeued(self):
+        coordinator = self.coordinator(["a", "b"])
+        lease = coordinator.lease({'worker': "w1"})
+        coordinator.complete({'worker': "w1", 'lease': lease['lease'], 'results': [result("b")]})
+        self.assertEqual(list(coordinator.pending), ["a"])
+
+class Settings(unittest.TestCase):
+    def test_parse_address(self):
+        self.assertEqual(parse_address("10.0.0.2:9000"), ("10.0.0.2", 9000))
+        self.assertEqual(parse_address("buildbox"), ("buildbox", 8765))
+
+    def test_worker_options_match_coordinator(self):
+        options = ConversionOptions(transparent_color=(255, 0, 255), key_colors=["00FF00:4:8"], background_only=True,
+                                    encoder_profile='fast')
+        rebuilt = options_from_settings(options.output_settings(), "out", 16)
+        self.assertEqual(rebuilt.output_settings(), options.output_settings())
+
+class ClusterRun(unittest.TestCase):
+    def test_worker_converts_every_file(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        for index in range(5):
+            Image.new("RGB", (6, 4), (255, 0, 255)).save(os.path.join(directory, f"{index}.bmp"))
+        options = ConversionOptions(transparent_color=(255, 0, 255), incremental=True)
+        coordinator = Coordinator(directory, options, port=0, batch_size=2)
+        events = []
+        thread = threading.Thread(target=lambda: events.extend(coordinator.run()))
+        thread.start()
+        try:
+            while coordinator.server is None and thread.is_alive():
+                time.sleep(0.01)
+            converted = run_worker(coordinator.address, directory, workers=1, name="worker-1")
+        finally:
+            thread.join()
+        self.assertEqual(converted, 5)
+        self.assertEqual(events[-1].kind, 'done')
+        self.assertEqual((events[-1].processed, events[-1].failed), (5, 0))
+        self.assertEqual({event.stats['worker'] for event in events if event.kind == 'file'}, {"worker-1"})
+        output = os.path.join(directory, options.output_folder, "0.png")
+        self.assertEqual(Image.open(output).getpixel((0, 0)), (255, 255, 255, 0))
+        # Recorded in the manifest, so a second run has nothing to hand out
+        rerun = list(Coordinator(directory, options, port=0).run())
+        self.assertEqual(rerun[-1].skipped, 5)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,176 @@
+"""
+Tests for the headless conversion core
+"""
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app"))
+
+from PIL import Image
+from bmp_reader import read_bmp_info
+from converter import (MEGABYTE, PARTIAL_SUFFIX, REGION_BYTES_PER_PIXEL, STALE_PARTIAL_SECONDS,
+                       ConversionOptions, MemoryBudget, convert_file, convert_pipelined, convert_serial,
+                       estimate_memory, needs_strips, open_output, plan_memory)
+from keying import BorderRegions
+
+class MemoryEstimates(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def bmp(self, size):
+        path = os.path.join(self.directory, "image.bmp")
+        Image.new("RGB", size).save(path)
+        return path
+
+    def test_border_regions_within_estimate(self):
+        # A checkerboard is the worst case: one run every two pixels
+        width = height = 400
+        rows = [bytes([255, 0]) * (width // 2), bytes([0, 255]) * (width // 2)]
+        mask = Image.frombytes("L", (width, height), b''.join(rows[y % 2] for y in range(height)))
+        strips = [mask.crop((0, top, width, top + 40)) for top in range(0, height, 40)]
+        tracemalloc.start()
+        try:
+            regions = BorderRegions(width, height)
+            for strip in strips:
+                regions.add(strip)
+            used = tracemalloc.get_traced_memory()[0]
+        finally:
+            tracemalloc.stop()
+        self.assertLess(used, width * height * REGION_BYTES_PER_PIXEL)
+
+    def test_background_only_strips_count_region_labels(self):
+        path = self.bmp((1000, 1000))
+        info = read_bmp_info(path)
+        options = ConversionOptions(strip_budget_mb=1)
+        keyed = ConversionOptions(strip_budget_mb=1, background_only=True)
+        self.assertEqual(estimate_memory(info, keyed) - estimate_memory(info, options),
+                         1000 * 1000 * REGION_BYTES_PER_PIXEL)
+
+    def test_plan_forces_strips_over_budget(self):
+        path = self.bmp((1000, 1000))
+        options = ConversionOptions(max_memory_mb=8, strip_budget_mb=64)
+        cost, job_options = plan_memory(path, None, None, options)
+        self.assertLessEqual(job_options.strip_budget_mb, 2)
+        self.assertLessEqual(cost, 8 * MEGABYTE)
+        self.assertEqual(options.strip_budget_mb, 64)
+
+    def test_no_budget(self):
+        self.assertEqual(plan_memory(self.bmp((10, 10)), None, None, ConversionOptions())[0], 0)
+
+class MemoryBudgetAdmission(unittest.TestCase):
+    def test_fits(self):
+        budget = MemoryBudget(1)
+        self.assertTrue(budget.fits(2 * MEGABYTE))
+        budget.take(MEGABYTE // 2)
+        self.assertTrue(budget.fits(MEGABYTE // 2))
+        self.assertFalse(budget.fits(MEGABYTE))
+        budget.release(MEGABYTE // 2)
+        self.assertTrue(budget.fits(2 * MEGABYTE))
+
+    def test_unlimited(self):
+        budget = MemoryBudget(0)
+        budget.take(10 ** 12)
+        self.assertTrue(budget.fits(10 ** 12))
+
+def framed_sprite(size, seed):
+    """Magenta background with a random picture inside that reuses the key color in places"""
+    rng = random.Random(seed)
+    colors = [(255, 0, 255), (0, 0, 0), (40, 200, 90), (250, 250, 10)]
+    img = Image.new("RGB", size, (255, 0, 255))
+    inner = Image.new("RGB", (size[0] - 8, size[1] - 8))
+    inner.putdata([rng.choice(colors) for _ in range(inner.width * inner.height)])
+    img.paste(inner, (4, 4))
+    return img
+
+class StripConversion(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def convert_both_ways(self, img, **options):
+        path = os.path.join(self.directory, "image.bmp")
+        img.save(path)
+        info = read_bmp_info(path)
+        outputs = []
+        for strip_budget_mb in (0, 0.01):
+            job_options = ConversionOptions(transparent_color=(255, 0, 255), strip_budget_mb=strip_budget_mb,
+                                            **options)
+            self.assertEqual(needs_strips(info, job_options), bool(strip_budget_mb))
+            output = os.path.join(self.directory, f"image-{strip_budget_mb}.png")
+            convert_file(path, output, job_options)
+            outputs.append(Image.open(output).convert("RGBA").tobytes())
+        return outputs
+
+    def test_strips_match_whole_image(self):
+        whole, strips = self.convert_both_ways(framed_sprite((64, 90), 1))
+        self.assertEqual(strips, whole)
+
+    def test_background_only_strips_match_whole_image(self):
+        whole, strips = self.convert_both_ways(framed_sprite((64, 90), 2), background_only=True)
+        self.assertEqual(strips, whole)
+
+class Pipeline(unittest.TestCase):
+    def test_matches_serial(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        jobs = []
+        for index in range(6):
+            path = os.path.join(directory, f"{index}.bmp")
+            framed_sprite((20 + index, 16), index).save(path)
+            jobs.append((f"{index}.bmp", path, os.path.join(directory, "{}", f"{index}.png"), None, None, None))
+        with open(os.path.join(directory, "broken.bmp"), 'wb') as f:
+            f.write(b"BM broken")
+        jobs.append(("broken.bmp", os.path.join(directory, "broken.bmp"),
+                     os.path.join(directory, "{}", "broken.png"), None, None, None))
+
+        results = {}
+        for kind, run in (("serial", convert_serial), ("pipelined", convert_pipelined)):
+            options = ConversionOptions(workers=1, read_ahead=2, write_behind=1)
+            kind_jobs = [(name, path, output.format(kind), size, profile, info)
+                         for name, path, output, size, profile, info in jobs]
+            results[kind] = {name: (error is None, None if error else Image.open(output).tobytes())
+                             for name, _, output, error, _ in run(kind_jobs, options)}
+        self.assertEqual(results["pipelined"], results["serial"])
+        self.assertFalse(results["serial"]["broken.bmp"][0])
+
+class OpenOutput(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.output = os.path.join(self.directory, "a[1].png")
+
+    def partial(self, name, age):
+        path = os.path.join(self.directory, name)
+        open(path, 'wb').close()
+        then = time.time() - age
+        os.utime(path, (then, then))
+        return path
+
+    def test_replaces_output_and_removes_stale_partials(self):
+        stale = self.partial("a[1].png.x1y2" + PARTIAL_SUFFIX, STALE_PARTIAL_SECONDS + 60)
+        live = self.partial("a[1].png.z3w4" + PARTIAL_SUFFIX, 1)
+        other = self.partial("b.png.x1y2" + PARTIAL_SUFFIX, STALE_PARTIAL_SECONDS + 60)
+        with open_output(self.output) as f:
+            f.write(b"png")
+        with open(self.output, 'rb') as f:
+            self.assertEqual(f.read(), b"png")
+        self.assertFalse(os.path.exists(stale))
+        self.assertTrue(os.path.exists(live))
+        self.assertTrue(os.path.exists(other))
+
+    def test_failure_leaves_nothing(self):
+        with self.assertRaises(ValueError):
+            with open_output(self.output) as f:
+                f.write(b"half")
+                raise ValueError
+        self.assertEqual(os.listdir(self.directory), [])
+
+if __name__ == "__main__":
+    unittest.main()
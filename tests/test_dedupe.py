@@ -0,0 +1,109 @@
+"""
+Tests for duplicate input detection
+Identical BMPs are converted once and the rest get the same PNG, but never a PNG that has changed since
+"""
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app"))
+
+from PIL import Image
+from converter import ConversionOptions, convert_directory
+from dedupe import HashStore, link_or_copy
+
+SETTINGS = {'transparent_color': '#000000', 'encoder_profile': 'balanced'}
+
+class HashStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.output = os.path.join(self.directory, "a.png")
+        with open(self.output, 'wb') as f:
+            f.write(b"png")
+
+    def test_record_and_holds(self):
+        hashes = HashStore(self.directory, SETTINGS)
+        hashes.record("h1", "a.bmp", self.output)
+        self.assertEqual(hashes.lookup("h1"), "a.bmp")
+        self.assertTrue(hashes.holds("a.bmp", self.output))
+        with open(self.output, 'wb') as f:
+            f.write(b"rewritten")
+        self.assertFalse(hashes.holds("a.bmp", self.output))
+
+    def test_new_contents_replace_old_hash(self):
+        hashes = HashStore(self.directory, SETTINGS)
+        hashes.record("h1", "a.bmp", self.output)
+        hashes.record("h2", "a.bmp", self.output)
+        self.assertIsNone(hashes.lookup("h1"))
+        self.assertEqual(hashes.lookup("h2"), "a.bmp")
+
+    def test_forget(self):
+        hashes = HashStore(self.directory, SETTINGS)
+        hashes.record("h1", "a.bmp", self.output)
+        hashes.forget_name("a.bmp")
+        self.assertIsNone(hashes.lookup("h1"))
+        self.assertFalse(hashes.holds("a.bmp", self.output))
+        hashes.record("h1", "a.bmp", os.path.join(self.directory, "missing.png"))
+        self.assertIsNone(hashes.lookup("h1"))
+
+    def test_save_and_load(self):
+        hashes = HashStore(self.directory, SETTINGS)
+        hashes.record("h1", "a.bmp", self.output)
+        hashes.save()
+        loaded = HashStore.load(self.directory, SETTINGS)
+        self.assertEqual(loaded.lookup("h1"), "a.bmp")
+        self.assertTrue(loaded.holds("a.bmp", self.output))
+        self.assertIsNone(HashStore.load(self.directory, dict(SETTINGS, encoder_profile='fast')).lookup("h1"))
+
+    def test_link_or_copy_replaces_destination(self):
+        destination = os.path.join(self.directory, "sub", "b.png")
+        os.makedirs(os.path.dirname(destination))
+        with open(destination, 'wb') as f:
+            f.write(b"old")
+        link_or_copy(self.output, destination)
+        with open(destination, 'rb') as f:
+            self.assertEqual(f.read(), b"png")
+
+class DedupeRun(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.options = ConversionOptions(workers=1, dedupe=True)
+
+    def save(self, name, color):
+        Image.new("RGB", (7, 5), color).save(os.path.join(self.directory, name))
+
+    def file_events(self):
+        return {event.name: event for event in convert_directory(self.directory, self.options)
+                if event.kind == 'file'}
+
+    def test_duplicates_share_one_conversion(self):
+        for name in ("a.bmp", "b.bmp", "c.bmp"):
+            self.save(name, (10, 20, 30))
+        self.save("d.bmp", (40, 50, 60))
+        events = self.file_events()
+        self.assertTrue(all(event.error is None for event in events.values()))
+        copies = sorted(name for name, event in events.items() if 'duplicate_of' in event.stats)
+        self.assertEqual(len(copies), 2)
+        self.assertNotIn("d.bmp", copies)
+        for name in copies:
+            source = events[events[name].stats['duplicate_of']]
+            self.assertNotIn('duplicate_of', source.stats)
+            self.assertEqual(Image.open(events[name].output_path).tobytes(), Image.open(source.output_path).tobytes())
+
+    def test_changed_png_is_not_copied(self):
+        self.save("a.bmp", (10, 20, 30))
+        first = self.file_events()["a.bmp"]
+        # Someone edits the PNG by hand; a new duplicate must be converted, not linked to it
+        Image.new("RGBA", (7, 5), (1, 1, 1, 255)).save(first.output_path)
+        os.remove(first.input_path)
+        self.save("b.bmp", (10, 20, 30))
+        second = self.file_events()
+        self.assertNotIn('duplicate_of', second["b.bmp"].stats)
+        self.assertEqual(Image.open(second["b.bmp"].output_path).getpixel((0, 0)), (10, 20, 30, 255))
+
+if __name__ == "__main__":
+    unittest.main()
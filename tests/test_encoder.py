@@ -0,0 +1,73 @@
+"""
+Tests for the PNG encoder profiles
+Every profile must decode back to exactly the pixels it was given
+"""
+import io
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app"))
+
+from PIL import Image
+from encoder import ENCODER_PROFILES, compact_palette, encode_png, to_indexed
+
+def decode(data):
+    return Image.open(io.BytesIO(data))
+
+def palette_image(size, used, seed=1, transparent=()):
+    """'P' image with a full random 256-entry palette of which only the indices in used appear"""
+    rng = random.Random(seed)
+    img = Image.frombytes("P", size, bytes(rng.choice(used) for _ in range(size[0] * size[1])))
+    img.putpalette(bytes(rng.randrange(256) for _ in range(768)))
+    if transparent:
+        img.info['transparency'] = bytes(0 if index in transparent else 255 for index in range(max(transparent) + 1))
+    return img
+
+class CompactPalette(unittest.TestCase):
+    def test_keeps_pixels_and_drops_unused_entries(self):
+        img = palette_image((31, 17), [3, 40, 200, 250], transparent=(200,))
+        compact = compact_palette(img)
+        self.assertEqual(len(compact.getpalette()), 4 * 3)
+        self.assertEqual(compact.convert("RGBA").tobytes(), img.convert("RGBA").tobytes())
+        # The transparent entry comes first, so tRNS is a single byte
+        self.assertEqual(compact.info['transparency'], b'\x00')
+
+    def test_already_compact(self):
+        img = Image.frombytes("P", (4, 1), bytes([0, 1, 0, 1]))
+        img.putpalette(b'\x00\x00\x00\xff\xff\xff')
+        self.assertIs(compact_palette(img), img)
+
+class EncodePng(unittest.TestCase):
+    def test_profiles_round_trip_rgba(self):
+        rng = random.Random(3)
+        img = Image.frombytes("RGBA", (40, 30), bytes(rng.randrange(256) for _ in range(40 * 30 * 4)))
+        for profile in ENCODER_PROFILES:
+            self.assertEqual(decode(encode_png(img, profile)).convert("RGBA").tobytes(), img.tobytes(), profile)
+
+    def test_palette_round_trips_and_stays_small(self):
+        img = palette_image((37, 23), list(range(0, 256, 7)), transparent=(7, 14))
+        rgba = img.convert("RGBA")
+        for profile in ENCODER_PROFILES:
+            data = encode_png(img, profile)
+            self.assertEqual(decode(data).convert("RGBA").tobytes(), rgba.tobytes(), profile)
+            self.assertLessEqual(len(data), len(encode_png(rgba, profile)), profile)
+
+    def test_large_palette_image_stays_indexed(self):
+        img = palette_image((300, 300), [1, 2, 3, 4, 5])
+        decoded = decode(encode_png(img))
+        self.assertEqual(decoded.mode, "P")
+        self.assertEqual(len(decoded.getpalette()), 5 * 3)
+
+    def test_to_indexed_separates_alpha(self):
+        img = Image.new("RGBA", (4, 4), (255, 255, 255, 255))
+        img.paste((255, 255, 255, 0), (0, 0, 2, 4))
+        indexed = to_indexed(img)
+        self.assertEqual(indexed.convert("RGBA").tobytes(), img.tobytes())
+        rng = random.Random(4)
+        many_colors = Image.frombytes("RGBA", (30, 30), bytes(rng.randrange(256) for _ in range(30 * 30 * 4)))
+        self.assertIsNone(to_indexed(many_colors))
+
+if __name__ == "__main__":
+    unittest.main()
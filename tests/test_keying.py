@@ -0,0 +1,163 @@
+"""
+Regression tests for color keying
+apply_color_key must give byte-for-byte the same image as the getdata()/putdata() loop it replaced,
+and BorderRegions must find the same border-connected areas as a plain flood fill, whole or in strips
+"""
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app"))
+
+from PIL import Image
+from keying import BorderRegions, KeyColor, apply_color_key, key_palette
+
+KEY = (255, 0, 255)
+
+def original_key(img, color_rgb):
+    """The per-pixel loop the app shipped with"""
+    img = img.convert("RGBA")
+    new_data = []
+    for item in img.getdata():
+        if item[0] == color_rgb[0] and item[1] == color_rgb[1] and item[2] == color_rgb[2]:
+            new_data.append((255, 255, 255, 0))
+        else:
+            new_data.append(item)
+    img.putdata(new_data)
+    return img
+
+def sample_rgb(width=37, height=23, seed=1):
+    """Random pixels from a small palette that includes the key and its near misses"""
+    rng = random.Random(seed)
+    colors = [KEY, (254, 0, 255), (255, 1, 255), (0, 0, 0), (255, 255, 255), (12, 200, 99)]
+    img = Image.new("RGB", (width, height))
+    img.putdata([rng.choice(colors) for _ in range(width * height)])
+    return img
+
+class ApplyColorKeyMatchesLoop(unittest.TestCase):
+    def assertSameAsLoop(self, img, color):
+        expected = original_key(img, color)
+        result = apply_color_key(img, color)
+        self.assertEqual(result.mode, "RGBA")
+        self.assertEqual(result.size, expected.size)
+        self.assertEqual(result.tobytes(), expected.tobytes())
+
+    def test_rgb(self):
+        self.assertSameAsLoop(sample_rgb(), KEY)
+
+    def test_rgba(self):
+        img = sample_rgb().convert("RGBA")
+        rng = random.Random(2)
+        img.putalpha(Image.frombytes("L", img.size, bytes(rng.randrange(256) for _ in range(img.width * img.height))))
+        self.assertSameAsLoop(img, KEY)
+
+    def test_palette(self):
+        img = sample_rgb().quantize(colors=8)
+        self.assertEqual(img.mode, "P")
+        self.assertSameAsLoop(img, KEY)
+
+    def test_grayscale(self):
+        img = sample_rgb().convert("L")
+        self.assertSameAsLoop(img, (0, 0, 0))
+        self.assertSameAsLoop(img, (255, 255, 255))
+
+    def test_one_bit(self):
+        img = sample_rgb().convert("1")
+        self.assertSameAsLoop(img, (0, 0, 0))
+        self.assertSameAsLoop(img, (255, 255, 255))
+
+    def test_no_matches(self):
+        self.assertSameAsLoop(sample_rgb(), (1, 2, 3))
+
+def random_palette_image(rng, size=(19, 13)):
+    """'P' image over a small random palette, some entries already partly or fully transparent"""
+    colors = [(rng.choice((0, 250, 255)), rng.randrange(256), rng.choice((0, 5, 255))) for _ in range(12)]
+    img = Image.frombytes("P", size, bytes(rng.randrange(len(colors)) for _ in range(size[0] * size[1])))
+    img.putpalette(bytes(channel for color in colors for channel in color))
+    if rng.random() < 0.7:
+        img.info['transparency'] = bytes(rng.choice((0, 0, 90, 255, 255, 255)) for _ in range(len(colors)))
+    return img, colors
+
+class KeyPaletteMatchesApplyColorKey(unittest.TestCase):
+    def assertSameAsApply(self, img, keys):
+        indexed = key_palette(img, keys)
+        self.assertEqual(indexed.mode, "P")
+        self.assertEqual(indexed.convert("RGBA").tobytes(), apply_color_key(img, keys).tobytes())
+
+    def test_random_soft_and_hard_keys(self):
+        rng = random.Random(5)
+        for _ in range(150):
+            img, colors = random_palette_image(rng)
+            keys = [KeyColor(rng.choice(colors), rng.choice((0, 0, 3, 20)), rng.choice((0, 4, 30)))
+                    for _ in range(rng.randint(1, 3))]
+            self.assertSameAsApply(img, keys)
+
+    def test_exact_key(self):
+        img, colors = random_palette_image(random.Random(6))
+        self.assertSameAsApply(img, colors[0])
+
+    def test_grayscale_and_one_bit(self):
+        gray = sample_rgb().convert("L")
+        self.assertSameAsApply(gray, [KeyColor((0, 0, 0), 10, 20)])
+        self.assertSameAsApply(sample_rgb().convert("1"), (255, 255, 255))
+
+    def test_truecolor_is_left_alone(self):
+        self.assertIsNone(key_palette(sample_rgb(), KEY))
+
+def flood_border(mask):
+    """Reference: keyed pixels reachable from the border through their four neighbours"""
+    width, height = mask.size
+    data = mask.tobytes()
+    seen = bytearray(width * height)
+    stack = [(x, y) for y in range(height) for x in range(width)
+             if (x in (0, width - 1) or y in (0, height - 1)) and data[y * width + x]]
+    while stack:
+        x, y = stack.pop()
+        if not (0 <= x < width and 0 <= y < height) or seen[y * width + x] or not data[y * width + x]:
+            continue
+        seen[y * width + x] = 255
+        stack.extend(((x + 1, y), (x - 1, y), (x, y + 1), (x, y - 1)))
+    return bytes(seen)
+
+def random_mask(width, height, seed, density):
+    rng = random.Random(seed)
+    return Image.frombytes("L", (width, height), bytes(255 if rng.random() < density else 0
+                                                       for _ in range(width * height)))
+
+class BorderRegionsMatchFloodFill(unittest.TestCase):
+    def check(self, mask, rows_per_strip):
+        regions = BorderRegions(mask.width, mask.height)
+        strips = [mask.crop((0, top, mask.width, min(mask.height, top + rows_per_strip)))
+                  for top in range(0, mask.height, rows_per_strip)]
+        for strip in strips:
+            regions.add(strip)
+        result = b''.join(regions.mask(strip, index * rows_per_strip).tobytes()
+                          for index, strip in enumerate(strips))
+        self.assertEqual(result, flood_border(mask))
+
+    def test_whole_and_strips(self):
+        for seed in range(12):
+            mask = random_mask(23 + seed, 17 + seed % 5, seed, (0.3, 0.55, 0.75)[seed % 3])
+            for rows in (mask.height, 1, 3, 7):
+                self.check(mask, rows)
+
+    def test_enclosed_area_is_kept(self):
+        mask = Image.new("L", (9, 9), 255)
+        mask.paste(0, (2, 2, 7, 7))
+        mask.paste(255, (4, 4, 5, 5))
+        self.check(mask, 2)
+        regions = BorderRegions(9, 9)
+        regions.add(mask)
+        self.assertEqual(regions.mask(mask).getpixel((4, 4)), 0)
+
+    def test_background_only_keeps_inner_key_color(self):
+        img = Image.new("RGB", (10, 10), KEY)
+        img.paste((0, 0, 0), (2, 2, 8, 8))
+        img.paste(KEY, (4, 4, 6, 6))
+        result = apply_color_key(img, KEY, background_only=True)
+        self.assertEqual(result.getpixel((0, 0)), (255, 255, 255, 0))
+        self.assertEqual(result.getpixel((5, 5)), KEY + (255,))
+
+if __name__ == "__main__":
+    unittest.main()
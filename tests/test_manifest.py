@@ -0,0 +1,113 @@
+"""
+Tests for the incremental manifest and its journal
+A run killed before save() must still remember every file it finished
+"""
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app"))
+
+from PIL import Image
+from converter import ConversionOptions, convert_directory
+from manifest import Manifest, hash_file, read_journal
+
+SETTINGS = {'transparent_color': '#FF00FF', 'encoder_profile': 'balanced'}
+
+class ManifestCheck(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.input = os.path.join(self.directory, "a.bmp")
+        self.output = os.path.join(self.directory, "a.png")
+        with open(self.input, 'wb') as f:
+            f.write(b"first contents")
+        open(self.output, 'wb').close()
+        self.manifest = Manifest(self.directory)
+        self.addCleanup(self.manifest.save)
+
+    def test_unknown_file(self):
+        self.assertEqual(self.manifest.check("a.bmp", self.input, self.output, SETTINGS), (False, None))
+
+    def test_unchanged_file_skips_without_hashing(self):
+        self.manifest.record("a.bmp", self.input, SETTINGS)
+        self.assertEqual(self.manifest.check("a.bmp", self.input, self.output, SETTINGS), (True, None))
+
+    def test_other_settings_or_missing_output(self):
+        self.manifest.record("a.bmp", self.input, SETTINGS)
+        self.assertFalse(self.manifest.check("a.bmp", self.input, self.output, dict(SETTINGS, encoder_profile='fast'))[0])
+        os.remove(self.output)
+        self.assertFalse(self.manifest.check("a.bmp", self.input, self.output, SETTINGS)[0])
+
+    def test_touched_but_identical(self):
+        self.manifest.record("a.bmp", self.input, SETTINGS)
+        stat = os.stat(self.input)
+        os.utime(self.input, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        self.assertEqual(self.manifest.check("a.bmp", self.input, self.output, SETTINGS),
+                         (True, hash_file(self.input)))
+        self.assertEqual(self.manifest.entries["a.bmp"]['mtime_ns'], os.stat(self.input).st_mtime_ns)
+
+    def test_same_size_new_contents(self):
+        self.manifest.record("a.bmp", self.input, SETTINGS)
+        with open(self.input, 'wb') as f:
+            f.write(b"other contents")
+        self.assertEqual(self.manifest.check("a.bmp", self.input, self.output, SETTINGS),
+                         (False, hash_file(self.input)))
+
+class Journal(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.input = os.path.join(self.directory, "a.bmp")
+        with open(self.input, 'wb') as f:
+            f.write(b"contents")
+
+    def test_replayed_without_save(self):
+        manifest = Manifest(self.directory)
+        manifest.record("a.bmp", self.input, SETTINGS)
+        manifest.record("b.bmp", self.input, SETTINGS)
+        # No save(): as if the process had been killed here
+        self.assertEqual(sorted(Manifest.load(self.directory).entries), ["a.bmp", "b.bmp"])
+        manifest.save()
+
+    def test_torn_last_line_is_ignored(self):
+        manifest = Manifest(self.directory)
+        manifest.record("a.bmp", self.input, SETTINGS)
+        manifest.journal.write('["b.bmp", {"size"')
+        manifest.journal.flush()
+        self.assertEqual([name for name, _ in read_journal(manifest.journal_path)], ["a.bmp"])
+        self.assertEqual(list(Manifest.load(self.directory).entries), ["a.bmp"])
+        manifest.save()
+
+    def test_save_folds_journal_in(self):
+        manifest = Manifest(self.directory)
+        manifest.record("a.bmp", self.input, SETTINGS)
+        manifest.save()
+        self.assertFalse(os.path.exists(manifest.journal_path))
+        with open(manifest.path) as f:
+            self.assertIn("a.bmp", json.load(f)['files'])
+        self.assertEqual(Manifest.load(self.directory).entries, manifest.entries)
+
+    def test_unreadable_manifest_starts_empty(self):
+        with open(os.path.join(self.directory, os.path.basename(Manifest(self.directory).path)), 'w') as f:
+            f.write("{not json")
+        self.assertEqual(Manifest.load(self.directory).entries, {})
+
+class IncrementalRun(unittest.TestCase):
+    def test_second_run_skips_everything(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        for name in ("a", "b"):
+            Image.new("RGB", (5, 5), (255, 0, 255)).save(os.path.join(directory, name + ".bmp"))
+        options = ConversionOptions(workers=1, incremental=True)
+        first = [event.kind for event in convert_directory(directory, options)]
+        second = [event.kind for event in convert_directory(directory, options)]
+        self.assertEqual(first.count('file'), 2)
+        self.assertEqual(second.count('skip'), 2)
+        self.assertNotIn('file', second)
+
+if __name__ == "__main__":
+    unittest.main()
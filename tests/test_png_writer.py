@@ -0,0 +1,52 @@
+"""
+Tests for the incremental PNG encoder
+A PNG written strip by strip must decode to exactly the image the strips were cut from
+"""
+import io
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app"))
+
+from PIL import Image
+from png_writer import PngStreamWriter
+
+def random_rgba(size, seed=1):
+    rng = random.Random(seed)
+    return Image.frombytes("RGBA", size, bytes(rng.randrange(256) for _ in range(size[0] * size[1] * 4)))
+
+def write_in_strips(img, rows_per_strip, compress_level=6):
+    data = io.BytesIO()
+    writer = PngStreamWriter(data, img.width, img.height, compress_level)
+    for top in range(0, img.height, rows_per_strip):
+        writer.write_strip(img.crop((0, top, img.width, min(img.height, top + rows_per_strip))))
+    writer.close()
+    return data.getvalue()
+
+class PngStreamWriterTest(unittest.TestCase):
+    def test_round_trips_for_any_strip_height(self):
+        img = random_rgba((29, 17))
+        for rows in (1, 2, 5, 17):
+            decoded = Image.open(io.BytesIO(write_in_strips(img, rows)))
+            self.assertEqual(decoded.mode, "RGBA")
+            self.assertEqual(decoded.tobytes(), img.tobytes(), rows)
+
+    def test_converts_other_modes(self):
+        img = random_rgba((8, 6), 2).convert("RGB")
+        decoded = Image.open(io.BytesIO(write_in_strips(img, 4, 1)))
+        self.assertEqual(decoded.tobytes(), img.convert("RGBA").tobytes())
+
+    def test_rejects_wrong_strips(self):
+        writer = PngStreamWriter(io.BytesIO(), 4, 4)
+        with self.assertRaises(ValueError):
+            writer.write_strip(Image.new("RGBA", (5, 1)))
+        writer.write_strip(Image.new("RGBA", (4, 3)))
+        with self.assertRaises(ValueError):
+            writer.write_strip(Image.new("RGBA", (4, 2)))
+        with self.assertRaises(ValueError):
+            writer.close()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,130 @@
+"""
+Tests for the HTTP conversion service
+Requests go over a real socket to a server on a free port with a one-process pool
+"""
+import asyncio
+import io
+import json
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app"))
+
+from PIL import Image
+from converter import ConversionOptions
+from keying import KeyColor
+from server import ConversionServer, HttpError, parse_key, request_options
+
+BOUNDARY = "testboundary"
+
+def bmp_bytes(size=(6, 4), color=(255, 0, 255)):
+    data = io.BytesIO()
+    Image.new("RGB", size, color).save(data, "BMP")
+    return data.getvalue()
+
+def multipart_body(files):
+    parts = [(f'--{BOUNDARY}\r\nContent-Disposition: form-data; name="file"; filename="{name}"\r\n'
+              f'Content-Type: image/bmp\r\n\r\n').encode() + data + b'\r\n' for name, data in files]
+    return b''.join(parts) + f'--{BOUNDARY}--\r\n'.encode()
+
+async def request(port, method, target, body=b'', content_type='image/bmp'):
+    """Send one request and return (status, headers, body) with the body still chunk-encoded"""
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write((f'{method} {target} HTTP/1.1\r\nHost: test\r\nContent-Type: {content_type}\r\n'
+                  f'Content-Length: {len(body)}\r\n\r\n').encode() + body)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    head, _, payload = response.partition(b'\r\n\r\n')
+    lines = head.decode('latin-1').split('\r\n')
+    headers = {name.strip().lower(): value.strip()
+               for name, _, value in (line.partition(':') for line in lines[1:])}
+    return int(lines[0].split()[1]), headers, payload
+
+class ConversionService(unittest.TestCase):
+    def run_server(self, scenario, **kwargs):
+        """Run scenario(server) against a started server, then shut it down"""
+        options = ConversionOptions(transparent_color=(255, 0, 255))
+        server = ConversionServer(options, port=0, workers=1, **kwargs)
+
+        async def main():
+            await server.start()
+            try:
+                return await scenario(server, server.server.sockets[0].getsockname()[1])
+            finally:
+                server.server.close()
+                await server.server.wait_closed()
+                server.executor.shutdown()
+        return asyncio.run(main())
+
+    def test_single_image(self):
+        async def scenario(server, port):
+            return await request(port, 'POST', '/convert', bmp_bytes())
+        status, headers, body = self.run_server(scenario)
+        self.assertEqual(status, 200)
+        self.assertEqual(headers['content-type'], 'image/png')
+        self.assertEqual(Image.open(io.BytesIO(body)).getpixel((0, 0)), (255, 255, 255, 0))
+
+    def test_batch_streams_every_part_in_order(self):
+        files = [("a.bmp", bmp_bytes()), ("broken.bmp", b"BM not really"), ("c.bmp", bmp_bytes(color=(1, 2, 3)))]
+        async def scenario(server, port):
+            result = await request(port, 'POST', '/convert', multipart_body(files),
+                                   f'multipart/form-data; boundary={BOUNDARY}')
+            return result, server.in_flight
+        (status, headers, body), in_flight = self.run_server(scenario, max_queue=4)
+        self.assertEqual(status, 200)
+        self.assertTrue(headers['content-type'].startswith('multipart/mixed'))
+        self.assertLess(body.index(b'filename="a.png"'), body.index(b'filename="broken.png"'))
+        self.assertLess(body.index(b'filename="broken.png"'), body.index(b'filename="c.png"'))
+        self.assertEqual(body.count(b'X-Conversion-Error: 422'), 1)
+        self.assertEqual(in_flight, 0)
+
+    def test_batch_larger_than_queue_is_refused(self):
+        files = [(f"{i}.bmp", bmp_bytes()) for i in range(3)]
+        async def scenario(server, port):
+            return await request(port, 'POST', '/convert', multipart_body(files),
+                                 f'multipart/form-data; boundary={BOUNDARY}')
+        status, headers, body = self.run_server(scenario, max_queue=2)
+        self.assertEqual(status, 413)
+        self.assertNotIn('retry-after', headers)
+        self.assertIn(b'smaller batches', body)
+
+    def test_full_queue_gets_503(self):
+        async def scenario(server, port):
+            server.in_flight = server.max_queue
+            result = await request(port, 'POST', '/convert', bmp_bytes())
+            server.in_flight = 0
+            metrics = await request(port, 'GET', '/metrics')
+            return result, metrics
+        (status, headers, _), (_, _, metrics) = self.run_server(scenario, max_queue=1)
+        self.assertEqual(status, 503)
+        self.assertEqual(headers['retry-after'], '1')
+        self.assertEqual(json.loads(metrics)['rejected'], 1)
+
+    def test_errors(self):
+        async def scenario(server, port):
+            return [(await request(port, method, target, body))[0] for method, target, body in
+                    (('GET', '/convert', b''), ('GET', '/nowhere', b''), ('POST', '/convert', b'not a bmp'))]
+        self.assertEqual(self.run_server(scenario), [405, 404, 422])
+
+class RequestOptions(unittest.TestCase):
+    def test_keys_and_profile(self):
+        options = request_options(ConversionOptions(), {'key': ['FF00FF:10:4', '000000'], 'profile': ['fast'],
+                                                        'background_only': ['1']})
+        self.assertEqual(list(options.key_colors),
+                         [KeyColor((255, 0, 255), 10, 4), KeyColor((0, 0, 0))])
+        self.assertEqual(options.encoder_profile, 'fast')
+        self.assertTrue(options.background_only)
+
+    def test_bad_values(self):
+        for query in ({'color': ['nothex']}, {'profile': ['best-ever']}, {'key': ['FF00FF:x']}):
+            with self.assertRaises(HttpError, msg=query) as caught:
+                request_options(ConversionOptions(), query)
+            self.assertEqual(caught.exception.status, 400)
+
+    def test_parse_key(self):
+        self.assertEqual(parse_key("0a0b0c"), KeyColor((10, 11, 12)))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,62 @@
+"""
+Tests for watch-folder mode
+Drives FolderWatcher.convert_path directly rather than waiting on real file system events
+"""
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app"))
+
+from PIL import Image
+from converter import ConversionOptions
+from dedupe import HashStore
+from manifest import Manifest, hash_file
+from watcher import FolderWatcher
+
+class ConvertPath(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, "sprite.bmp")
+        Image.new("RGB", (12, 9), (255, 0, 255)).save(self.path)
+        self.events = []
+
+    def watcher(self, **options):
+        watcher = FolderWatcher(self.directory, ConversionOptions(workers=1, **options), self.events.append)
+        os.makedirs(watcher.output_dir, exist_ok=True)
+        return watcher
+
+    def test_dedupe_without_manifest(self):
+        watcher = self.watcher(dedupe=True, incremental=False)
+        hashes = HashStore(watcher.output_dir, watcher.options.output_settings())
+        self.assertTrue(watcher.convert_path(self.path, None, hashes))
+        event = self.events[-1]
+        self.assertIsNone(event.error)
+        self.assertEqual((event.processed, event.failed), (1, 0))
+        self.assertEqual(hashes.lookup(hash_file(self.path)), "sprite.bmp")
+        self.assertTrue(hashes.holds("sprite.bmp", event.output_path))
+
+    def test_manifest_skips_unchanged_file(self):
+        watcher = self.watcher(incremental=True)
+        manifest = Manifest.load(watcher.output_dir)
+        watcher.convert_path(self.path, manifest)
+        watcher.convert_path(self.path, manifest)
+        self.assertEqual([event.kind for event in self.events], ['file', 'skip'])
+        self.assertIn("sprite.bmp", manifest.entries)
+
+    def test_save_batches_manifest_writes(self):
+        watcher = self.watcher(incremental=True)
+        manifest = Manifest.load(watcher.output_dir)
+        watcher.pending[self.path] = 0
+        watcher.convert_ready(manifest)
+        self.assertEqual(watcher.unsaved, 1)
+        self.assertFalse(os.path.exists(manifest.path))
+        watcher.save(manifest, None)
+        self.assertEqual(watcher.unsaved, 0)
+        self.assertIn("sprite.bmp", Manifest.load(watcher.output_dir).entries)
+
+if __name__ == "__main__":
+    unittest.main()